@@ -0,0 +1,1474 @@
+# Mục đích: Kiểm tra tính đúng đắn và đo hiệu năng các thành phần dự báo.
+# Cách dùng (chạy trong thư mục ai_weather_system, cần có các file mô hình):
+#   python benchmark.py rollout      # so khớp bit và đo thời gian rollout 72 giờ
+#   python benchmark.py batch        # dự báo từng tỉnh so với dự báo theo lô
+#   python benchmark.py coalesce     # N request miss đồng thời chỉ tải dữ liệu một lần
+#   python benchmark.py inference    # suy luận NumPy so với LightGBM
+#   python benchmark.py upstream     # thử lại, hạn chót, cầu dao và giữ kết nối với Open-Meteo giả lập
+#   python benchmark.py shared_cache # nhiều tiến trình dùng chung cache SQLite, mỗi tỉnh chỉ tính một lần
+#   python benchmark.py postprocess  # tạo JSON theo giờ/ngày: iterrows/apply so với bản vector
+#   python benchmark.py startup      # thời gian import, nạp mô hình và phản hồi đầu tiên
+#   python benchmark.py collector    # thu thập tuần tự, song song có giới hạn tốc độ và gộp nhiều tỉnh/request
+#   python benchmark.py history      # đọc/ghi thêm lịch sử: file CSV so với kho phân vùng theo tỉnh/tháng
+#   python benchmark.py incremental  # lên lịch tải theo mốc từng tỉnh và tải bù khoảng thiếu (máy chủ giả lập)
+#   python benchmark.py backfill     # tải 3 năm theo cửa sổ: bộ nhớ, dừng giữa chừng rồi chạy tiếp
+#   python benchmark.py features     # feature huấn luyện: groupby/lambda cũ so với feature_engineering, khớp với server
+#   python benchmark.py featurecache # cache ma trận feature: lần đầu, tải lại, thêm một ngày, sửa dữ liệu cũ
+#   python benchmark.py training     # huấn luyện 5 mô hình: vòng lặp LGBMRegressor cũ so với Dataset dùng chung
+#   python benchmark.py retrain      # cập nhật tăng dần (thêm cây / refit) so với huấn luyện lại toàn bộ
+#   python benchmark.py direct       # dự báo 72 giờ: mô hình trực tiếp so với rollout đệ quy (thời gian, sai số theo tầm)
+#   python benchmark.py samples      # mẫu cửa sổ trượt của server-ai/evaluate_models/WeatherAI: vòng lặp iloc cũ so với bản NumPy
+#   python benchmark.py forest       # dự báo 24 giờ của server-ai: predict của sklearn so với mảng phẳng (FlatForest)
+# Lệnh trả về mã lỗi 1 nếu kết quả kiểm tra không khớp.
+# ==============================================================================
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytz
+import requests
+
+# Cache của server trong các phép kiểm tra không được dùng lại kết quả của lần chạy trước
+os.environ.setdefault('CACHE_DB_PATH', os.path.join(tempfile.mkdtemp(), 'forecast_cache.sqlite3'))
+# Bộ làm mới nền tự chạy khi có request đầu tiên, tắt để số đo không bị nó chen vào
+os.environ.setdefault('CACHE_WARMER_ENABLED', '0')
+
+import server
+import model_store
+import open_meteo_collector as collector
+from cache_backends import MemoryBackend, SQLiteBackend
+from feature_engineering import add_features, build_feature_columns
+from feature_store import FeatureStore
+from forecast_cache import ForecastCache
+import model_training
+from history_store import HistoryStore, migrate_csv
+from open_meteo_standin import OpenMeteoStandIn
+from rollout_engine import RolloutEngine
+from upstream_client import CircuitOpenError, DeadlineExceededError, UpstreamClient
+from weather_common import OBSERVATION_COLUMNS, sliding_window_samples
+
+STEPS = 72
+
+
+def make_history(seed, hours=48):
+    """Tạo lịch sử giả lập giống dữ liệu Open-Meteo (có chuỗi 0 lặp lại và NaN)."""
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp.now(tz='UTC').floor('h')
+    times = pd.date_range(end=end, periods=hours, freq='h')
+    hour = times.hour.to_numpy()
+    precipitation = np.where(rng.random(hours) < 0.7, 0.0, rng.gamma(1.0, 1.5, hours).round(1))
+    df = pd.DataFrame({
+        'time': times,
+        'air_temperature': (27 + 4 * np.sin(2 * np.pi * (hour - 9) / 24) + rng.normal(0, 0.5, hours)).round(1),
+        'relative_humidity': rng.integers(55, 100, hours),
+        'precipitation_amount': precipitation,
+        'cloud_area_fraction': rng.integers(0, 101, hours),
+        'wind_speed': rng.gamma(2.0, 3.0, hours).round(1),
+    })
+    df.loc[rng.integers(0, hours - 6), 'wind_speed'] = np.nan
+    return df
+
+
+def clip_prediction(element, prediction):
+    if prediction < 0 and element != 'air_temperature':
+        prediction = 0
+    if element == 'relative_humidity':
+        prediction = np.clip(prediction, 0, 100)
+    return prediction
+
+
+def reference_rollout(history, province_name, replay=None):
+    # Cách làm cũ: tính lại rolling của pandas và pd.concat ở mỗi bước.
+    # Nếu có `replay` thì dùng lại các giá trị dự báo đã có thay vì gọi mô hình.
+    features, predictions = [], []
+    current_time = pd.to_datetime(history['time'].iloc[-1])
+    for step in range(STEPS):
+        current_time += timedelta(hours=1)
+        feature_df = server.create_features_for_prediction(history, province_name, current_time)
+        features.append(feature_df.to_numpy(dtype=np.float64)[0])
+        predicted_values = {"time": current_time}
+        for i, element in enumerate(server.ELEMENTS):
+            if replay is None:
+                predicted_values[element] = clip_prediction(element, server.get_models()[element].predict(feature_df)[0])
+            else:
+                predicted_values[element] = replay[step][i]
+        predictions.append([predicted_values[element] for element in server.ELEMENTS])
+        history = pd.concat([history, pd.DataFrame([predicted_values])], ignore_index=True)
+    return np.array(features), predictions
+
+
+def engine_rollout(history, province_name, replay=None):
+    features, current_time = [], pd.to_datetime(history['time'].iloc[-1])
+    engine = RolloutEngine.from_frames([history], [server.get_province_encoder()[province_name]], server.ELEMENTS)
+    for step in range(STEPS):
+        current_time += timedelta(hours=1)
+        row = engine.features(current_time)
+        features.append(row[0])
+        if replay is None:
+            feature_df = pd.DataFrame(row, columns=server.FEATURE_COLUMNS)
+            engine.push([[clip_prediction(element, server.get_models()[element].predict(feature_df)[0])
+                          for element in server.ELEMENTS]])
+        else:
+            engine.push([replay[step]])
+    return np.array(features)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def run_rollout(args):
+    provinces = list(server.PROVINCE_DATA)[:args.provinces]
+    ok, totals = True, np.zeros(4)
+    for seed, province_name in enumerate(provinces):
+        history = make_history(seed)
+        (expected, predictions), ref_time = timed(reference_rollout, history, province_name)
+        actual, new_time = timed(engine_rollout, history, province_name)
+        _, ref_feature_time = timed(reference_rollout, history, province_name, predictions)
+        _, new_feature_time = timed(engine_rollout, history, province_name, predictions)
+        totals += [ref_time, new_time, ref_feature_time, new_feature_time]
+        if not np.array_equal(expected.view(np.uint64), actual.view(np.uint64)):
+            ok = False
+            diff = np.argwhere(expected != actual)
+            print(f"KHÔNG KHỚP cho {province_name}: {len(diff)} giá trị khác, ví dụ bước/cột {diff[:3].tolist()}")
+    per_province = totals / len(provinces) * 1000
+    print(f"Rollout {STEPS} giờ, trung bình trên {len(provinces)} tỉnh (ms/tỉnh):")
+    print(f"  {'':16}{'toàn bộ':>12}{'chỉ feature':>14}")
+    print(f"  {'pandas + concat':16}{per_province[0]:12.1f}{per_province[2]:14.1f}")
+    print(f"  {'RolloutEngine':16}{per_province[1]:12.1f}{per_province[3]:14.1f}")
+    print("  Feature khớp từng bit." if ok else "  Feature KHÔNG khớp!")
+    return ok
+
+
+def run_batch(args):
+    # So sánh đúng phần gộp lô nên cố định cùng một bộ suy luận cho cả hai cách
+    server.INFERENCE_ENGINE = 'lightgbm'
+    province_names = list(server.PROVINCE_DATA)[:args.provinces]
+    histories = [make_history(seed) for seed in range(len(province_names))]
+
+    single, single_time = timed(lambda: [
+        server.rollout_forecast([name], [history])[0]
+        for name, history in zip(province_names, histories)
+    ])
+    batched, batch_time = timed(server.rollout_forecast, province_names, histories)
+
+    ok = all(
+        np.array_equal(a[server.ELEMENTS].to_numpy(), b[server.ELEMENTS].to_numpy())
+        for a, b in zip(single, batched)
+    )
+    print(f"Rollout {STEPS} giờ cho {len(province_names)} tỉnh:")
+    print(f"  từng tỉnh một : {single_time:.2f} s ({len(province_names) * STEPS * len(server.ELEMENTS)} lần gọi mô hình)")
+    print(f"  theo lô       : {batch_time:.2f} s ({STEPS * len(server.ELEMENTS)} lần gọi mô hình)")
+    print("  Kết quả hai cách trùng nhau." if ok else "  Kết quả hai cách KHÁC nhau!")
+    return ok
+
+
+def run_coalesce(args):
+    # Thay Open-Meteo bằng hàm giả lập chậm và đếm số lần được gọi
+    calls, calls_lock = [], threading.Lock()
+
+    def slow_upstream(lat, lon):
+        with calls_lock:
+            calls.append((lat, lon))
+        time.sleep(args.upstream_delay)
+        return make_history(0)
+
+    server.get_initial_features = slow_upstream
+    province_names = list(server.PROVINCE_DATA)[:args.provinces]
+    barrier = threading.Barrier(args.requests * len(province_names))
+    statuses = []
+
+    def client(province_name):
+        test_client = server.app.test_client()
+        barrier.wait()
+        response = test_client.get('/api/predict', query_string={'province': province_name})
+        statuses.append(response.status_code)
+
+    threads = [
+        threading.Thread(target=client, args=(name,))
+        for name in province_names for _ in range(args.requests)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    ok = len(calls) == len(province_names) and statuses.count(200) == len(threads)
+    print(f"{args.requests} request đồng thời x {len(province_names)} tỉnh chưa có trong cache:")
+    print(f"  số lần gọi upstream: {len(calls)} (mong đợi {len(province_names)})")
+    print(f"  số phản hồi 200    : {statuses.count(200)}/{len(threads)}")
+    print(f"  thời gian          : {elapsed:.2f} s")
+    return ok
+
+
+def run_inference(args):
+    rng = np.random.default_rng(0)
+    ensemble, build_time = timed(server.get_tree_ensemble)
+    print(f"Nạp {ensemble.num_trees} cây dạng mảng phẳng mất {build_time:.2f} s.")
+    ok = True
+    for n_rows in (1, 63):
+        # Lấy feature thật từ các lịch sử giả lập để đi đúng các nhánh thường gặp
+        histories = [make_history(int(seed)) for seed in rng.integers(0, 1000, n_rows)]
+        codes = rng.integers(0, len(server.get_province_encoder()), n_rows)
+        engine = RolloutEngine(
+            np.stack([h[server.ELEMENTS].to_numpy(dtype=np.float64) for h in histories]), codes
+        )
+        matrix = engine.features(pd.to_datetime(histories[0]['time'].iloc[-1]) + timedelta(hours=1))
+        feature_df = pd.DataFrame(matrix, columns=server.FEATURE_COLUMNS)
+
+        def lightgbm_path():
+            return np.column_stack([server.get_models()[element].predict(feature_df) for element in server.ELEMENTS])
+
+        expected = lightgbm_path()
+        actual = ensemble.predict(matrix)
+        max_error = np.abs(expected - actual).max()
+        ok = ok and max_error < 1e-9
+        times = []
+        for func in (lightgbm_path, lambda: ensemble.predict(matrix)):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                func()
+            times.append((time.perf_counter() - start) / args.repeat * 1000)
+        print(f"{n_rows:>3} dòng x 5 mô hình: LightGBM {times[0]:7.2f} ms, "
+              f"TreeEnsemble {times[1]:7.2f} ms, sai lệch lớn nhất {max_error:.2e}")
+    return ok
+
+
+def run_upstream(args):
+    params = {"latitude": 21.0285, "longitude": 105.8542, "past_days": 2, "forecast_days": 1,
+              "hourly": "temperature_2m,relative_humidity_2m,precipitation,cloud_cover,wind_speed_10m"}
+    checks = []
+
+    def check(name, passed, detail=''):
+        checks.append(passed)
+        print(f"  [{'OK' if passed else 'LỖI'}] {name}" + (f" ({detail})" if detail else ''))
+
+    def expect_error(client, url, error_type):
+        start = time.perf_counter()
+        try:
+            client.get_json(url, params=params)
+        except error_type:
+            return True, time.perf_counter() - start
+        except requests.exceptions.RequestException:
+            pass
+        return False, time.perf_counter() - start
+
+    print("Client Open-Meteo trên máy chủ giả lập:")
+    # 1. Lỗi 503 tạm thời: thử lại rồi thành công
+    with OpenMeteoStandIn(script=[503, 503], recordings_dir=args.recordings) as standin:
+        client = UpstreamClient(retries=3, backoff=0.05)
+        data = client.get_json(standin.url + '/v1/forecast', params=params)
+        counters = client.stats()['counters']
+        check("thử lại sau 503", 'hourly' in data and counters.get('retries') == 2,
+              f"{counters.get('attempts')} lần thử")
+
+    # 2. 429 kèm Retry-After: chờ đúng thời gian upstream yêu cầu
+    with OpenMeteoStandIn(script=[429], recordings_dir=args.recordings) as standin:
+        client = UpstreamClient(retries=1, backoff=0.01)
+        _, elapsed = timed(client.get_json, standin.url + '/v1/forecast', params)
+        check("tôn trọng Retry-After", elapsed >= 1.0, f"{elapsed:.2f} s")
+
+    # 3. Upstream treo: lần gọi dừng ở hạn chót thay vì chờ mãi
+    with OpenMeteoStandIn(script=[('delay', 3.0)] * 3, recordings_dir=args.recordings) as standin:
+        client = UpstreamClient(deadline=1.0, retries=3, backoff=0.05)
+        raised, elapsed = expect_error(client, standin.url + '/v1/forecast', DeadlineExceededError)
+        check("dừng ở hạn chót 1 s", raised and elapsed < 1.5, f"{elapsed:.2f} s")
+
+    # 4. Lỗi liên tiếp: cầu dao mở và không gửi thêm request
+    with OpenMeteoStandIn(script=[503] * 10, recordings_dir=args.recordings) as standin:
+        client = UpstreamClient(retries=0, failure_threshold=3, reset_timeout=60)
+        for _ in range(3):
+            expect_error(client, standin.url + '/v1/forecast', requests.exceptions.HTTPError)
+        raised, _ = expect_error(client, standin.url + '/v1/forecast', CircuitOpenError)
+        check("cầu dao mở sau 3 lỗi", raised and len(standin.requests) == 3 and client.breaker.state == 'open',
+              f"{len(standin.requests)} request tới upstream")
+
+    # 5. Giữ kết nối: N request tuần tự chỉ dùng một kết nối TCP
+    with OpenMeteoStandIn(latency=args.latency, recordings_dir=args.recordings) as standin:
+        url = standin.url + '/v1/forecast'
+        _, bare_time = timed(lambda: [requests.get(url, params=params).json() for _ in range(args.requests)])
+        bare_connections = len(standin.connections)
+        standin.connections.clear()
+        client = UpstreamClient()
+        _, pooled_time = timed(lambda: [client.get_json(url, params=params) for _ in range(args.requests)])
+        check("dùng lại kết nối", len(standin.connections) == 1,
+              f"{bare_connections} -> {len(standin.connections)} kết nối cho {args.requests} request")
+        print(f"       requests.get: {bare_time / args.requests * 1000:.2f} ms/request, "
+              f"UpstreamClient: {pooled_time / args.requests * 1000:.2f} ms/request")
+        latency = client.stats()['latency']
+        print(f"       độ trễ p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms")
+
+    # 6. Đường đi thật của server: get_initial_features qua client dùng chung
+    with OpenMeteoStandIn(recordings_dir=args.recordings) as standin:
+        server.OPEN_METEO_FORECAST_URL = standin.url + '/v1/forecast'
+        history = server.get_initial_features(21.0285, 105.8542)
+        check("server.get_initial_features", len(history) >= 24 and list(history.columns) == ['time'] + server.ELEMENTS,
+              f"{len(history)} giờ lịch sử")
+    return all(checks)
+
+
+def _shared_cache_worker(path, keys, delay, start_at, queue):
+    # Một "worker" riêng: tự mở file cache và tính các tỉnh còn thiếu
+    cache = ForecastCache(900, backend=SQLiteBackend(path), poll_seconds=0.02)
+    computed = []
+
+    def compute(names):
+        computed.extend(names)
+        time.sleep(delay)
+        return {name: {"province": name, "pid": os.getpid()} for name in names}, {}
+
+    time.sleep(max(0.0, start_at - time.time()))
+    results, errors = {}, {}
+    threads = []
+    for key in keys:
+        def request(key=key):
+            result, _ = cache.lookup(key)
+            if result is None:
+                new_results, new_errors = cache.compute([key], compute)
+                results.update(new_results)
+                errors.update(new_errors)
+            else:
+                results[key] = result
+        threads.append(threading.Thread(target=request))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.put((computed, len(results), errors, cache.stats()['counters']))
+
+
+def run_shared_cache(args):
+    path = os.path.join(tempfile.mkdtemp(), 'shared.sqlite3')
+    keys = list(server.PROVINCE_DATA)[:args.provinces]
+    SQLiteBackend(path)  # tạo bảng trước khi các worker cùng mở
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    start_at = time.time() + 0.5
+    workers = [
+        context.Process(target=_shared_cache_worker, args=(path, keys, args.compute_delay, start_at, queue))
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    reports = [queue.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    computed = [key for report in reports for key in report[0]]
+    served = sum(report[1] for report in reports)
+    errors = [error for report in reports for error in report[2].values()]
+    shared = sum(report[3].get('shared', 0) for report in reports)
+    ok = sorted(computed) == sorted(keys) and served == len(keys) * args.workers and not errors
+    print(f"{args.workers} tiến trình x {len(keys)} tỉnh, cùng lúc miss trên một file SQLite:")
+    print(f"  số lần tính       : {len(computed)} (mong đợi {len(keys)}, không chia sẻ sẽ là {len(keys) * args.workers})")
+    print(f"  nhận từ worker khác: {shared}")
+    print(f"  số kết quả trả về : {served}/{len(keys) * args.workers}, lỗi: {len(errors)}")
+
+    # Giới hạn kích thước: chỉ giữ các mục mới nhất
+    bounded = SQLiteBackend(os.path.join(os.path.dirname(path), 'bounded.sqlite3'), max_entries=5)
+    for i in range(12):
+        bounded.put(f"province-{i}", {"value": i}, timestamp=1000.0 + i)
+    stats = bounded.stats()
+    remaining = [key for key in (f"province-{i}" for i in range(12)) if bounded.get(key)[0] is not None]
+    evict_ok = stats['entries'] == 5 and stats['evictions'] == 7 and remaining == [f"province-{i}" for i in range(7, 12)]
+    print(f"  giới hạn 5 mục sau 12 lần ghi: còn {stats['entries']}, đã xóa {stats['evictions']} mục cũ nhất"
+          + ("" if evict_ok else " (SAI)"))
+
+    # Chi phí mỗi lần đọc cache (mục đã có) của hai backend
+    payload = server.build_forecast_response(keys[0], server.rollout_forecast([keys[0]], [make_history(0)])[0])
+    for backend in (MemoryBackend(), SQLiteBackend(path)):
+        cache = ForecastCache(900, backend=backend)
+        cache.set(keys[0], payload)
+        _, elapsed = timed(lambda: [cache.lookup(keys[0]) for _ in range(args.lookups)])
+        print(f"  lookup {backend.name:6}: {elapsed / args.lookups * 1e6:7.1f} µs/lần "
+              f"(hit ratio {cache.stats()['counters']['hit_ratio']})")
+    return ok and evict_ok
+
+
+def reference_forecast_response(province_name, forecast_df, now_vn):
+    # Cách làm cũ: iterrows cho từng giờ, lọc và apply cho từng ngày
+    vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
+    forecast_df = forecast_df.copy()
+    forecast_df['time_vn'] = forecast_df['time'].dt.tz_convert(vn_tz)
+    hourly_df = forecast_df[forecast_df['time_vn'] > now_vn].head(24)
+    hourly_forecast = []
+    for _, row in hourly_df.iterrows():
+        symbol_code = server.determine_weather_symbol(row['precipitation_amount'], row['cloud_area_fraction'], row['time_vn'].hour)
+        hourly_forecast.append({
+            "time": row['time_vn'].strftime('%H:%M'),
+            "temperature": round(row['air_temperature'], 1),
+            "precipitation": round(row['precipitation_amount'], 2),
+            "wind_speed": round(row['wind_speed'], 1),
+            "relative_humidity": round(row['relative_humidity'], 1),
+            "symbol_url": symbol_code
+        })
+    forecast_df['date'] = forecast_df['time_vn'].dt.date
+    daily_forecast = []
+    unique_days = sorted(forecast_df[forecast_df['date'] >= now_vn.date()]['date'].unique())
+    for date_val in unique_days[:3]:
+        group = forecast_df[forecast_df['date'] == date_val]
+        daytime_group = group[(group['time_vn'].dt.hour >= 7) & (group['time_vn'].dt.hour < 17)]
+        if not daytime_group.empty:
+            daily_symbols = daytime_group.apply(
+                lambda row: server.determine_weather_symbol(row['precipitation_amount'], row['cloud_area_fraction'], row['time_vn'].hour),
+                axis=1
+            )
+            daily_symbol_code = daily_symbols.mode()[0]
+        else:
+            daily_symbol_code = 'clearsky_day'
+        daily_forecast.append({
+            "date": date_val.strftime('%A, %d/%m'),
+            "temp_max": round(group['air_temperature'].max(), 1),
+            "temp_min": round(group['air_temperature'].min(), 1),
+            "total_precipitation": round(group['precipitation_amount'].sum(), 1),
+            "avg_wind_speed": round(group['wind_speed'].mean(), 1),
+            "avg_humidity": round(group['relative_humidity'].mean(), 1),
+            "symbol_url": daily_symbol_code
+        })
+    return {"province": province_name, "hourly": hourly_forecast, "daily": daily_forecast}
+
+
+def make_forecast(seed, start, hours=72):
+    """Kết quả rollout giả lập; lượng mưa/mây rời rạc để hay có ký hiệu hòa nhau trong ngày."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'time': pd.date_range(start=start, periods=hours, freq='h'),
+        'air_temperature': rng.normal(27, 4, hours),
+        'relative_humidity': rng.uniform(40, 100, hours),
+        'precipitation_amount': rng.choice([0.0, 0.1, 0.2, 0.5, 2.0, 3.7], hours) + rng.normal(0, 1e-3, hours) * (rng.random(hours) < 0.5),
+        'cloud_area_fraction': rng.choice([10.0, 40.0, 41.0, 80.0, 95.0], hours),
+        'wind_speed': rng.gamma(2.0, 3.0, hours),
+    })
+
+
+def run_postprocess(args):
+    vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
+    names = list(server.PROVINCE_DATA)
+    ok = True
+    for trial in range(args.trials):
+        # Thời điểm "bây giờ" ở nhiều giờ khác nhau trong ngày để có ngày đầu bị cắt
+        now_vn = vn_tz.localize(datetime(2025, 6, 1, 0, 30) + timedelta(hours=7 * trial))
+        start = pd.Timestamp(now_vn).tz_convert('UTC').floor('h') - pd.Timedelta(hours=trial % 3)
+        frames = [make_forecast(trial * 100 + i, start) for i in range(len(names))]
+        expected = [reference_forecast_response(name, df, now_vn) for name, df in zip(names, frames)]
+        actual = server.build_forecast_responses(names, frames, now_vn)
+        if expected != actual:
+            ok = False
+            bad = next(i for i in range(len(names)) if expected[i] != actual[i])
+            print(f"KHÔNG KHỚP (lần {trial}, {names[bad]}):\n  cũ : {expected[bad]['daily']}\n  mới: {actual[bad]['daily']}")
+
+    now_vn = datetime.now(vn_tz)
+    start = pd.Timestamp.now(tz='UTC').floor('h')
+    print(f"Tạo JSON dự báo (24 giờ + 3 ngày), ms:")
+    for n in (1, len(names)):
+        frames = [make_forecast(i, start) for i in range(n)]
+        _, ref_time = timed(lambda: [reference_forecast_response(name, df, now_vn) for name, df in zip(names, frames)])
+        _, new_time = timed(lambda: [server.build_forecast_response(name, df) for name, df in zip(names, frames)])
+        _, batch_time = timed(server.build_forecast_responses, names[:n], frames, now_vn)
+        print(f"  {n:>2} tỉnh: iterrows/apply {ref_time * 1000:8.1f}, vector từng tỉnh {new_time * 1000:7.1f}, "
+              f"vector theo lô {batch_time * 1000:7.1f}")
+    print(f"  Kết quả khớp với cách cũ qua {args.trials} lần thử." if ok else "  Kết quả KHÔNG khớp!")
+    return ok
+
+
+# Chạy trong một tiến trình Python mới để đo khởi động nguội
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import server
+imported = time.perf_counter()
+client = server.app.test_client()
+client.get('/api/provinces')
+first_response = time.perf_counter()
+from open_meteo_standin import OpenMeteoStandIn
+with OpenMeteoStandIn() as standin:
+    server.OPEN_METEO_FORECAST_URL = standin.url + '/v1/forecast'
+    before = time.perf_counter()
+    status = client.get('/api/predict', query_string={'province': sys.argv[1]}).status_code
+    first_forecast = time.perf_counter() - before
+print(json.dumps({'import': imported - started, 'first_response': first_response - started,
+                  'first_forecast': first_forecast, 'status': status}))
+"""
+
+
+def run_startup(args):
+    province_name = list(server.PROVINCE_DATA)[0]
+    ok = True
+
+    # Thời gian nạp riêng từng định dạng mô hình; import thư viện trước để chỉ đo phần đọc file
+    import joblib, lightgbm  # noqa: F401
+    legacy, legacy_time = timed(model_store.load_boosters, server.ELEMENTS, '.', False)
+    boosters, booster_time = timed(model_store.load_boosters, server.ELEMENTS, '.', True)
+    ensemble, npz_time = timed(model_store.load_tree_ensemble, server.ELEMENTS, server.FEATURE_COLUMNS)
+    histories = [make_history(seed) for seed in range(8)]
+    engine = RolloutEngine(np.stack([h[server.ELEMENTS].to_numpy(dtype=np.float64) for h in histories]), np.arange(8))
+    matrix = engine.features(pd.to_datetime(histories[0]['time'].iloc[-1]) + timedelta(hours=1))
+    feature_df = pd.DataFrame(matrix, columns=server.FEATURE_COLUMNS)
+    expected = np.column_stack([legacy[element].predict(feature_df) for element in server.ELEMENTS])
+    same_booster = np.array_equal(expected, np.column_stack([boosters[e].predict(feature_df) for e in server.ELEMENTS]))
+    native_error = np.abs(expected - ensemble.predict(matrix)).max()
+    ok = same_booster and native_error < 1e-9
+    print("Nạp 5 mô hình (s):")
+    print(f"  joblib (pickle LGBMRegressor) : {legacy_time:6.2f}")
+    print(f"  LightGBM .txt (Booster)       : {booster_time:6.2f}  {'kết quả trùng joblib' if same_booster else 'KHÁC joblib!'}")
+    print(f"  forecast_trees.npz (NumPy)    : {npz_time:6.2f}  sai lệch lớn nhất {native_error:.1e}")
+
+    modes = [
+        ('eager + joblib (như trước)', {'STARTUP_MODE': 'eager', 'MODEL_FORMAT': 'joblib'}),
+        ('eager + native', {'STARTUP_MODE': 'eager', 'MODEL_FORMAT': 'native'}),
+        ('lazy + native', {'STARTUP_MODE': 'lazy', 'MODEL_FORMAT': 'native'}),
+    ]
+    print(f"Khởi động nguội trong tiến trình mới, trung bình {args.repeat} lần (s):")
+    print(f"  {'':28}{'import':>8}{'phản hồi đầu':>14}{'dự báo đầu':>12}{'tổng tiến trình':>17}")
+    for label, env in modes:
+        totals = np.zeros(4)
+        for _ in range(args.repeat):
+            child_env = dict(os.environ, CACHE_DB_PATH=os.path.join(tempfile.mkdtemp(), 'cache.sqlite3'), **env)
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', STARTUP_PROBE, province_name], env=child_env,
+                                    capture_output=True, text=True, check=True).stdout
+            wall = time.perf_counter() - start
+            timings = json.loads(output.strip().splitlines()[-1])
+            ok = ok and timings['status'] == 200
+            totals += [timings['import'], timings['first_response'], timings['first_forecast'], wall]
+        totals /= args.repeat
+        print(f"  {label:28}{totals[0]:8.2f}{totals[1]:14.2f}{totals[2]:12.2f}{totals[3]:17.2f}")
+    return ok
+
+
+def run_collector(args):
+    provinces = dict(list(server.PROVINCE_DATA.items())[:args.provinces])
+    directory = tempfile.mkdtemp()
+    ok = True
+
+    def collect(concurrent, start_date, end_date, rate=None, script=(), batch_size=1, max_locations=None):
+        output = os.path.join(directory, f"run_{len(os.listdir(directory))}.csv")
+        with OpenMeteoStandIn(script=list(script), latency=args.latency, rate_limit=args.server_rate,
+                              max_locations=max_locations) as standin:
+            url = standin.url + '/v1/archive'
+            start = time.perf_counter()
+            if concurrent:
+                client = collector.make_client(args.workers, rate)
+                frames = collector.collect_concurrent(client, provinces, start_date, end_date, url,
+                                                      args.workers, retry_delay_seconds=0.5, batch_size=batch_size)
+            else:
+                client = collector.make_client()
+                frames = collector.collect_sequential(client, provinces, start_date, end_date, url,
+                                                      args.sequential_delay)
+            elapsed = time.perf_counter() - start
+            collector.merge_and_save(None, frames, output)
+            actions = [action for _, _, action in standin.requests]
+        with open(output, 'rb') as f:
+            csv = f.read()
+        return csv, {'elapsed': elapsed, 'collected': len(frames), 'requests': len(actions),
+                     'throttled': actions.count(429), 'rejected': actions.count(400),
+                     'failed': sum(1 for action in actions if action not in ('ok', 429, 400))}
+
+    errors = (503, 'ok', 'ok', 503, 'ok', 502)
+    pulls = [
+        (f'toàn bộ ({args.start_date} đến {args.end_date})', args.start_date, args.end_date, [
+            ('tuần tự', False, {}),
+            (f'song song, {args.rate:g} req/s', True, {'rate': args.rate}),
+            # Vượt giới hạn của máy chủ giả lập (429) và thêm vài lỗi 503 rải rác
+            (f'song song, {args.rate * 4:g} req/s + lỗi', True, {'rate': args.rate * 4, 'script': errors}),
+            (f'gộp {args.batch_size} tỉnh/request', True, {'rate': args.rate, 'batch_size': args.batch_size}),
+            (f'gộp {args.batch_size} + lỗi', True, {'rate': args.rate, 'batch_size': args.batch_size,
+                                                    'script': errors}),
+            # Máy chủ từ chối lô lớn (400): mọi lô phải tải lại từng tỉnh
+            ('gộp, máy chủ từ chối lô', True, {'rate': args.rate, 'batch_size': args.batch_size,
+                                              'max_locations': 1}),
+        ]),
+        # Cập nhật tăng dần: chỉ một ngày mới
+        (f'tăng dần ({args.end_date})', args.end_date, args.end_date, [
+            (f'song song, {args.rate:g} req/s', True, {'rate': args.rate}),
+            (f'gộp {args.batch_size} tỉnh/request', True, {'rate': args.rate, 'batch_size': args.batch_size}),
+        ]),
+    ]
+    print(f"Thu thập {len(provinces)} tỉnh, máy chủ giả lập trễ {args.latency * 1000:.0f} ms, "
+          f"giới hạn {args.server_rate} req/s:")
+    for title, start_date, end_date, runs in pulls:
+        print(f" {title}:")
+        reference = None
+        for label, concurrent, options in runs:
+            with contextlib.redirect_stdout(io.StringIO()):
+                csv, result = collect(concurrent, start_date, end_date, **options)
+            reference = csv if reference is None else reference
+            same = csv == reference
+            ok = ok and same and result['collected'] == len(provinces)
+            print(f"  {label:28}: {result['elapsed']:6.2f} s, {result['requests']:3} request, "
+                  f"{result['collected']}/{len(provinces)} tỉnh, {result['throttled']} lần 429, "
+                  f"{result['failed']} lần 5xx, {result['rejected']} lô bị từ chối, "
+                  f"{'CSV trùng bản đầu' if same else 'CSV KHÁC bản đầu!'}")
+    return ok
+
+
+def make_history_frame(provinces, start, hours, seed=0):
+    # Dữ liệu giờ giả lập cùng định dạng với vietnam_weather_history.csv
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start, periods=hours, freq='h')
+    frames = []
+    for province_name in provinces:
+        frames.append(pd.DataFrame({
+            'time': times.strftime('%Y-%m-%dT%H:%M'),
+            'air_temperature': np.round(rng.normal(26, 4, hours), 1),
+            'relative_humidity': rng.integers(40, 100, hours),
+            'precipitation_amount': np.round(rng.exponential(0.3, hours), 1),
+            'cloud_area_fraction': rng.integers(0, 100, hours),
+            'wind_speed': np.round(rng.gamma(2, 4, hours), 1),
+            'province': province_name
+        }))
+    return frames
+
+
+def run_history(args):
+    provinces = sorted(list(server.PROVINCE_DATA)[:args.provinces])
+    directory = tempfile.mkdtemp()
+    csv_path = os.path.join(directory, 'vietnam_weather_history.csv')
+    store = HistoryStore(os.path.join(directory, 'weather_history'))
+    start = pd.Timestamp('2022-01-01')
+    hours = args.days * 24
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        collector.merge_and_save(None, make_history_frame(provinces, start, hours), csv_path)
+    print(f"Lịch sử giả lập: {len(provinces)} tỉnh x {args.days} ngày = {len(provinces) * hours} dòng, "
+          f"CSV {os.path.getsize(csv_path) / 1e6:.1f} MB")
+
+    rows, elapsed = timed(migrate_csv, csv_path, store)
+    size = sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(store.directory) for name in names)
+    print(f"  chuyển CSV sang kho (một lần)      : {elapsed:7.2f} s, {rows} dòng, kho {size / 1e6:.1f} MB")
+
+    def same(expected, actual):
+        expected, actual = expected.reset_index(drop=True), actual.reset_index(drop=True)
+        try:
+            pd.testing.assert_frame_equal(expected, actual, check_dtype=False)
+            return True
+        except AssertionError:
+            return False
+
+    # 1. Đọc toàn bộ như train_weather_model.py
+    expected, csv_time = timed(lambda: pd.read_csv(csv_path, parse_dates=['time']))
+    actual, store_time = timed(store.read)
+    ok = same(expected, actual)
+    print(f"  đọc toàn bộ   : CSV {csv_time:7.3f} s | kho {store_time:7.3f} s "
+          f"({csv_time / store_time:5.1f}x), {'khớp' if ok else 'KHÔNG KHỚP!'}")
+
+    # 2. Đọc một cột của 30 ngày cuối
+    range_start = start + pd.Timedelta(days=args.days - 30)
+
+    def read_csv_range():
+        df = pd.read_csv(csv_path, usecols=['time', 'air_temperature', 'province'], parse_dates=['time'])
+        return df[df['time'] >= range_start]
+
+    expected, csv_time = timed(read_csv_range)
+    actual, store_time = timed(store.read, ['air_temperature'], None, range_start)
+    matched = same(expected, actual)
+    ok = ok and matched
+    print(f"  1 cột, 30 ngày: CSV {csv_time:7.3f} s | kho {store_time:7.3f} s "
+          f"({csv_time / store_time:5.1f}x), {'khớp' if matched else 'KHÔNG KHỚP!'}")
+
+    # 3. Ghi thêm một ngày mới (có 1 giờ trùng với dữ liệu cũ) như open_meteo_collector.py
+    new_frames = make_history_frame(provinces, start + pd.Timedelta(hours=hours - 1), 25, seed=1)
+
+    def append_csv():
+        with contextlib.redirect_stdout(io.StringIO()):
+            existing_df, _, _ = collector.determine_date_range(csv_path)
+            collector.merge_and_save(existing_df, new_frames, csv_path)
+
+    _, csv_time = timed(append_csv)
+    written, store_time = timed(store.append, pd.concat(new_frames, ignore_index=True))
+    matched = same(pd.read_csv(csv_path, parse_dates=['time']), store.read())
+    ok = ok and matched
+    print(f"  ghi thêm 1 ngày: CSV {csv_time:7.3f} s | kho {store_time:7.3f} s "
+          f"({csv_time / store_time:5.1f}x, {written} phân vùng), {'khớp' if matched else 'KHÔNG KHỚP!'}")
+    return ok
+
+
+def run_incremental(args):
+    provinces = dict(list(server.PROVINCE_DATA.items())[:args.provinces])
+    names = list(provinces)
+    directory = tempfile.mkdtemp()
+    csv_path = os.path.join(directory, 'vietnam_weather_history.csv')
+    store = HistoryStore(os.path.join(directory, 'weather_history'))
+    start = pd.Timestamp('2024-01-01')
+    hours = args.days * 24
+    end_date = (start + pd.Timedelta(days=args.days + args.new_days - 1)).strftime('%Y-%m-%d')
+
+    # Lịch sử có sẵn; tỉnh đầu tiên lỗi ở lần chạy trước (thiếu 3 ngày cuối),
+    # tỉnh thứ hai thiếu 30 giờ ở giữa
+    frames = make_history_frame(names, start, hours)
+    frames[0] = frames[0].iloc[:-3 * 24]
+    hole = slice(hours // 2, hours // 2 + 30)
+    frames[1] = frames[1].drop(frames[1].index[hole])
+    with contextlib.redirect_stdout(io.StringIO()):
+        collector.merge_and_save(None, frames, csv_path)
+        migrate_csv(csv_path, store)
+    lagging, holed = names[0], names[1]
+    expected_gap = (pd.Timestamp(frames[1]['time'].iloc[hours // 2 - 1]) + pd.Timedelta(hours=1),
+                    pd.Timestamp(frames[1]['time'].iloc[hours // 2]) - pd.Timedelta(hours=1))
+
+    # Cách cũ: đọc cả file để lấy một mốc chung
+    with contextlib.redirect_stdout(io.StringIO()):
+        (_, old_start, _), old_time = timed(collector.determine_date_range, csv_path)
+    _, watermark_time = timed(collector.plan_collection, store, provinces, '2020-01-01', end_date, False)
+    plan, plan_time = timed(collector.plan_collection, store, provinces, '2020-01-01', end_date)
+    print(f"{len(provinces)} tỉnh x {args.days} ngày, tải tới {end_date}:")
+    print(f"  cách cũ (đọc CSV, mốc chung)   : {old_time * 1000:8.1f} ms, tải từ {old_start} cho mọi tỉnh "
+          f"-> bỏ sót 3 ngày của {lagging} và khoảng thiếu của {holed}")
+    print(f"  lịch theo manifest             : {watermark_time * 1000:8.1f} ms")
+    print(f"  lịch theo manifest + tìm khoảng: {plan_time * 1000:8.1f} ms")
+    for range_start, range_end, group in plan:
+        print(f"    {range_start} đến {range_end}: {len(group)} tỉnh")
+
+    ok = store.find_gaps(holed) == [expected_gap]
+    # Khoảng thiếu (30 giờ, qua 2 ngày) cũng phải chia theo cửa sổ như phần tải tiếp
+    windowed = collector.plan_collection(store, provinces, '2020-01-01', end_date, window_days=1)
+    gap_last_day = expected_gap[1].strftime('%Y-%m-%d')
+    gap_days = [range_start for range_start, _, group in windowed if holed in group and range_start <= gap_last_day]
+    expected_days = (expected_gap[1].normalize() - expected_gap[0].normalize()).days + 1
+    split_ok = (all(range_start == range_end for range_start, range_end, _ in windowed)
+                and len(gap_days) == expected_days)
+    ok = ok and split_ok
+    print(f"  cửa sổ 1 ngày: {len(windowed)} khoảng, khoảng thiếu của {holed} chia thành "
+          f"{len(gap_days)} ngày ({'đúng' if split_ok else 'SAI!'})")
+    with OpenMeteoStandIn(latency=args.latency) as standin:
+        client = collector.make_client(args.workers, args.rate)
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, collect_time = timed(lambda: collector.collect_plan(
+                client, plan, standin.url + '/v1/archive', args.workers,
+                on_frames=lambda frames: collector.save_to_store(store, frames)))
+        request_count = len(standin.requests)
+
+    watermarks = store.watermarks()
+    final = pd.Timestamp(end_date) + pd.Timedelta(hours=23)
+    caught_up = all(watermarks.get(name) == final for name in names)
+    gaps = {name: store.find_gaps(name) for name in names}
+    no_gaps = not any(gaps.values())
+    ok = ok and caught_up and no_gaps
+    print(f"  tải: {collect_time:.2f} s, {request_count} request; mốc mọi tỉnh = {final}: "
+          f"{'đúng' if caught_up else 'SAI!'}; còn khoảng thiếu: {'không' if no_gaps else gaps}")
+
+    replan = collector.plan_collection(store, provinces, '2020-01-01', end_date)
+    ok = ok and not replan
+    print(f"  lên lịch lại ngay sau đó: {len(replan)} khoảng cần tải ({'đúng' if not replan else 'SAI!'})")
+    return ok
+
+
+def _serve_standin(connection, options):
+    with OpenMeteoStandIn(**options) as standin:
+        connection.send(standin.url)
+        connection.recv()
+        connection.send(len(standin.requests))
+
+
+@contextlib.contextmanager
+def standin_process(**options):
+    """Máy chủ giả lập ở tiến trình riêng, để bộ nhớ đo được chỉ là của bộ thu thập.
+
+    Trả về dict có 'url'; sau khi thoát có thêm 'requests' (số request đã nhận).
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve_standin, args=(child, options), daemon=True)
+    process.start()
+    info = {'url': parent.recv()}
+    try:
+        yield info
+    finally:
+        parent.send('stop')
+        info['requests'] = parent.recv()
+        process.join()
+
+
+def run_backfill(args):
+    provinces = dict(list(server.PROVINCE_DATA.items())[:args.provinces])
+    end = datetime(2025, 1, 1)
+    start_date = (end - timedelta(days=args.days - 1)).strftime('%Y-%m-%d')
+    end_date = end.strftime('%Y-%m-%d')
+    directory = tempfile.mkdtemp()
+    print(f"Tải lần đầu {len(provinces)} tỉnh, {start_date} đến {end_date} (máy chủ giả lập ở tiến trình riêng):")
+
+    def measure(func):
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result, elapsed = timed(func)
+            return result, elapsed, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    # 1. Cách cũ: một khoảng cho cả 3 năm, giữ mọi DataFrame rồi mới ghi
+    one_shot = HistoryStore(os.path.join(directory, 'one_shot'))
+    with standin_process() as standin:
+        client = collector.make_client(args.workers, args.rate)
+        _, elapsed, peak = measure(lambda: collector.save_to_store(one_shot, collector.collect_concurrent(
+            client, provinces, start_date, end_date, standin['url'] + '/v1/archive', args.workers)))
+    print(f"  một lần, ghi cuối cùng  : {elapsed:6.2f} s, {standin['requests']:3} request, "
+          f"bộ nhớ đỉnh {peak / 1e6:7.1f} MB")
+    expected = one_shot.read()
+
+    def windowed_run(store, url, crash_after=None):
+        plan = collector.plan_collection(store, provinces, start_date, end_date, window_days=args.window_days)
+        if crash_after is not None:
+            # Giả lập tiến trình bị dừng sau khi đã ghi `crash_after` lô
+            append, saved = store.append, [0]
+
+            def crashing_append(df):
+                if saved[0] == crash_after:
+                    raise KeyboardInterrupt
+                saved[0] += 1
+                return append(df)
+            store.append = crashing_append
+        client = collector.make_client(args.workers, args.rate)
+        try:
+            return collector.run_plan(client, store, plan, url + '/v1/archive', args.workers), len(plan)
+        except KeyboardInterrupt:
+            return None, len(plan)
+        finally:
+            store.__dict__.pop('append', None)
+
+    # 2. Theo cửa sổ, ghi ngay từng cửa sổ
+    windowed = HistoryStore(os.path.join(directory, 'windowed'))
+    with standin_process() as standin:
+        (_, windows), elapsed, peak = measure(lambda: windowed_run(windowed, standin['url']))
+    matched = expected.equals(windowed.read())
+    ok = matched
+    print(f"  theo cửa sổ {args.window_days:3} ngày    : {elapsed:6.2f} s, {standin['requests']:3} request, "
+          f"bộ nhớ đỉnh {peak / 1e6:7.1f} MB, {windows} cửa sổ, "
+          f"{'dữ liệu khớp' if matched else 'dữ liệu KHÁC!'}")
+
+    # 3. Dừng giữa chừng rồi chạy lại: chỉ tải phần còn thiếu
+    resumed = HistoryStore(os.path.join(directory, 'resumed'))
+    crash_after = args.crash_after
+    with standin_process() as first:
+        (result, windows), _, _ = measure(lambda: windowed_run(resumed, first['url'], crash_after))
+    stopped_at = resumed.last_time()
+    with standin_process() as second:
+        (result, remaining), elapsed, _ = measure(lambda: windowed_run(resumed, second['url']))
+    matched = expected.equals(resumed.read())
+    no_gaps = not any(resumed.find_gaps(name) for name in provinces)
+    ok = ok and matched and no_gaps and result is not None and not result[1]
+    print(f"  dừng sau {crash_after} lô (mốc {stopped_at}), chạy lại: {remaining}/{windows} khoảng, "
+          f"{first['requests']} + {second['requests']} request, "
+          f"{'dữ liệu khớp' if matched else 'dữ liệu KHÁC!'}, {'không' if no_gaps else 'CÒN'} khoảng thiếu")
+    return ok
+
+
+def reference_training_features(df, elements):
+    # Cách tạo feature cũ của train_weather_model.py, giữ lại để so sánh
+    df = df.copy()
+    df['hour_sin'] = np.sin(2 * np.pi * df['time'].dt.hour / 24)
+    df['hour_cos'] = np.cos(2 * np.pi * df['time'].dt.hour / 24)
+    df['day_of_year_sin'] = np.sin(2 * np.pi * df['time'].dt.dayofyear / 366)
+    df['day_of_year_cos'] = np.cos(2 * np.pi * df['time'].dt.dayofyear / 366)
+    df['month_sin'] = np.sin(2 * np.pi * df['time'].dt.month / 12)
+    df['month_cos'] = np.cos(2 * np.pi * df['time'].dt.month / 12)
+    for element in elements:
+        for i in range(1, 4):
+            df[f'{element}_lag_{i}'] = df.groupby('province')[element].shift(i)
+        df[f'{element}_rolling_mean_6'] = df.groupby('province')[element].transform(
+            lambda x: x.shift(1).rolling(window=6, min_periods=1).mean())
+        df[f'{element}_rolling_mean_24'] = df.groupby('province')[element].transform(
+            lambda x: x.shift(1).rolling(window=24, min_periods=1).mean())
+        df[f'{element}_rolling_std_6'] = df.groupby('province')[element].transform(
+            lambda x: x.shift(1).rolling(window=6, min_periods=1).std())
+    return df
+
+
+def run_features(args):
+    provinces = sorted(list(server.PROVINCE_DATA)[:args.provinces])
+    df = pd.concat(make_history_frame(provinces, pd.Timestamp('2022-01-01'), args.days * 24), ignore_index=True)
+    df['time'] = pd.to_datetime(df['time'])
+    # Vài giá trị thiếu để kiểm tra cách xử lý NaN (trước bước ffill/bfill của trình huấn luyện)
+    rng = np.random.default_rng(3)
+    for element in server.ELEMENTS:
+        df.loc[rng.integers(0, len(df), 200), element] = np.nan
+    df = df.sort_values(by=['province', 'time']).reset_index(drop=True)
+    columns = [c for c in build_feature_columns(server.ELEMENTS) if c != 'province_encoded']
+    print(f"Tạo feature huấn luyện cho {len(provinces)} tỉnh x {args.days} ngày = {len(df)} dòng:")
+
+    expected, old_time = timed(reference_training_features, df, server.ELEMENTS)
+    actual, new_time = timed(add_features, df, server.ELEMENTS)
+    matched = all(np.array_equal(expected[c].to_numpy(), actual[c].to_numpy(), equal_nan=True) for c in columns)
+    ok = matched
+    print(f"  groupby + lambda (cũ)  : {old_time:6.2f} s")
+    print(f"  feature_engineering    : {new_time:6.2f} s ({old_time / new_time:.1f}x), "
+          f"{'khớp từng bit' if matched else 'KHÁC!'}")
+
+    # Cùng một đoạn lịch sử: dòng feature lúc huấn luyện so với feature server tạo khi dự báo
+    encoder = server.get_province_encoder()
+    trials, mismatches = 0, 0
+    for province_name in provinces[:args.parity_provinces]:
+        if province_name not in encoder:
+            continue
+        group = df[df['province'] == province_name].reset_index(drop=True)
+        for end in rng.integers(args.history_hours, len(group), args.parity_points):
+            window = group.iloc[end - args.history_hours:end + 1].reset_index(drop=True)
+            history, target_time = window.iloc[:-1], window['time'].iloc[-1]
+            training_row = add_features(window, server.ELEMENTS)[columns].iloc[-1].fillna(0).to_numpy()
+            serving = server.create_features_for_prediction(history, province_name, target_time)
+            engine = RolloutEngine.from_frames([history], [encoder[province_name]], server.ELEMENTS)
+            engine_row = engine.features(target_time)[0][:len(columns)]
+            trials += 1
+            if not (np.array_equal(training_row, serving[columns].to_numpy()[0])
+                    and np.array_equal(training_row, engine_row)):
+                mismatches += 1
+    ok = ok and trials > 0 and mismatches == 0
+    print(f"  huấn luyện vs server ({args.history_hours} giờ lịch sử): {trials - mismatches}/{trials} điểm "
+          f"khớp từng bit (create_features_for_prediction và RolloutEngine)")
+    return ok
+
+
+def run_feature_cache(args):
+    provinces = sorted(list(server.PROVINCE_DATA)[:args.provinces])
+    elements = server.ELEMENTS
+    hours = args.days * 24
+    frames = make_history_frame(provinces, pd.Timestamp('2022-01-01'), hours + 24)
+    df_all = pd.concat(frames, ignore_index=True)
+    df_all['time'] = pd.to_datetime(df_all['time'])
+    rng = np.random.default_rng(5)
+    for element in elements:
+        df_all.loc[rng.integers(0, len(df_all), 200), element] = np.nan
+    is_old = df_all['time'] < pd.Timestamp('2022-01-01') + pd.Timedelta(hours=hours)
+    df, df_next_day = df_all[is_old].reset_index(drop=True), df_all.reset_index(drop=True)
+    columns = [c for c in build_feature_columns(elements) if c != 'province_encoded'] + elements
+
+    def without_cache(frame):
+        # Cách của train_weather_model.py khi chưa có cache (điền chỗ thiếu theo từng tỉnh)
+        frame = frame.sort_values(by=['province', 'time']).reset_index(drop=True)
+        frame[elements] = frame.groupby('province')[elements].transform(lambda x: x.ffill().bfill())
+        return add_features(frame, elements)
+
+    def same(a, b):
+        return all(np.array_equal(a[c].to_numpy(), b[c].to_numpy(), equal_nan=True) for c in columns)
+
+    print(f"Feature cho {len(provinces)} tỉnh x {args.days} ngày = {len(df)} dòng:")
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        store = FeatureStore(os.path.join(directory, 'feature_cache'))
+        expected, plain_time = timed(without_cache, df)
+        (cold, counts), cold_time = timed(store.build, df, elements)
+        (warm, warm_counts), warm_time = timed(store.build, df, elements)
+        matched = same(expected, cold) and same(cold, warm)
+        ok = ok and matched and warm_counts['hit'] == len(provinces)
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(store.directory) for name in names)
+        print(f"  không cache              : {plain_time:6.2f} s")
+        print(f"  lần đầu (tính + ghi)     : {cold_time:6.2f} s ({size / 1e6:.0f} MB)")
+        print(f"  lần sau (tải lại)        : {warm_time:6.2f} s ({plain_time / warm_time:.1f}x), "
+              f"{warm_counts['hit']} tỉnh từ cache, {'khớp từng bit' if matched else 'KHÁC!'}")
+
+        # Thêm một ngày: chỉ tính phần đuôi, so với tính lại toàn bộ
+        expected, plain_time = timed(without_cache, df_next_day)
+        (tail, tail_counts), tail_time = timed(store.build, df_next_day, elements)
+        exact = [c for c in columns if 'rolling' not in c]
+        rolling = [c for c in columns if 'rolling' in c]
+        exact_ok = all(np.array_equal(expected[c].to_numpy(), tail[c].to_numpy(), equal_nan=True) for c in exact)
+        max_diff = max(np.nanmax(np.abs(expected[c].to_numpy() - tail[c].to_numpy())) for c in rolling)
+        ok = ok and exact_ok and max_diff < 1e-9 and tail_counts['tail'] == len(provinces)
+        print(f"  thêm 1 ngày (không cache): {plain_time:6.2f} s")
+        print(f"  thêm 1 ngày (phần đuôi)  : {tail_time:6.2f} s, {tail_counts['tail']} tỉnh tính phần đuôi; "
+              f"lag/giá trị {'khớp từng bit' if exact_ok else 'KHÁC!'}, rolling lệch tối đa {max_diff:.1e}")
+
+        # Sửa một giờ cũ của một tỉnh: chỉ tỉnh đó tính lại
+        edited = df_next_day.copy()
+        edited.loc[edited.index[edited['province'] == provinces[0]][100], 'air_temperature'] += 1.0
+        (result, edit_counts), edit_time = timed(store.build, edited, elements)
+        expected = without_cache(edited)
+        matched = all(np.array_equal(expected[c].to_numpy(), result[c].to_numpy(), equal_nan=True) for c in exact)
+        matched = matched and max(np.nanmax(np.abs(expected[c].to_numpy() - result[c].to_numpy()))
+                                  for c in rolling) < 1e-9
+        ok = ok and matched and edit_counts['full'] == 1 and edit_counts['hit'] == len(provinces) - 1
+        print(f"  sửa dữ liệu cũ 1 tỉnh    : {edit_time:6.2f} s, {edit_counts['full']} tỉnh tính lại, "
+              f"{edit_counts['hit']} tỉnh từ cache, {'khớp' if matched else 'KHÁC!'}")
+        files = [name for name in os.listdir(store.directory) if name.endswith('.cols')]
+        ok = ok and len(files) == len(provinces)
+        print(f"  số file cache: {len(files)} (file cũ đã xóa)")
+    return ok
+
+
+def training_frame(provinces, days):
+    # Ma trận feature giống train_weather_model.py trên dữ liệu giả lập
+    df = pd.concat(make_history_frame(provinces, pd.Timestamp('2022-01-01'), days * 24), ignore_index=True)
+    df['time'] = pd.to_datetime(df['time'])
+    with tempfile.TemporaryDirectory() as directory:
+        df, _ = FeatureStore(directory).build(df, server.ELEMENTS)
+    df = df.dropna().reset_index(drop=True)
+    df['province_encoded'] = df['province'].map({name: i for i, name in enumerate(provinces)})
+    return df[build_feature_columns(server.ELEMENTS)], df
+
+
+def make_weather_frame(provinces, start, hours, seed=0):
+    # Dữ liệu giả lập có quy luật (chu kỳ ngày, mùa, nhiễu tự tương quan) để mô hình học được
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start, periods=hours, freq='h')
+    i = np.arange(hours)
+    phase = np.sin(2 * np.pi * (times.hour.to_numpy() - 9) / 24)
+    season = np.sin(2 * np.pi * times.dayofyear.to_numpy() / 365.25)
+    frames = []
+    for k, province_name in enumerate(provinces):
+        noise = np.zeros((hours, 3))
+        shocks = rng.normal(0, [0.4, 0.25, 0.3], (hours, 3))
+        for t in range(1, hours):
+            noise[t] = 0.95 * noise[t - 1] + shocks[t]
+        temperature = 24 + k % 5 + 5 * season + 4 * phase + 2 * noise[:, 0]
+        frames.append(pd.DataFrame({
+            'time': times.strftime('%Y-%m-%dT%H:%M'),
+            'air_temperature': np.round(temperature, 1),
+            'relative_humidity': np.clip(np.round(80 - 12 * phase - 3 * noise[:, 0] + 5 * noise[:, 1]), 20, 100),
+            'precipitation_amount': np.round(np.maximum(0, 2 * noise[:, 1] - 1 + 0.3 * np.sin(i / 11)), 1),
+            'cloud_area_fraction': np.clip(np.round(55 + 25 * noise[:, 1] + 10 * season), 0, 100),
+            'wind_speed': np.round(np.maximum(0, 9 + 3 * noise[:, 2] + 2 * phase), 1),
+            'province': province_name
+        }))
+    return frames
+
+
+def run_retrain(args):
+    provinces = sorted(list(server.PROVINCE_DATA)[:args.provinces])
+    df = pd.concat(make_weather_frame(provinces, pd.Timestamp('2023-01-01'), (args.days + args.new_days) * 24),
+                   ignore_index=True)
+    df['time'] = pd.to_datetime(df['time'])
+    with tempfile.TemporaryDirectory() as directory:
+        df, _ = FeatureStore(directory).build(df, server.ELEMENTS)
+    df = df.dropna().reset_index(drop=True)
+    df['province_encoded'] = df['province'].map({name: i for i, name in enumerate(provinces)})
+    features = build_feature_columns(server.ELEMENTS)
+
+    end = df['time'].max()
+    holdout_start = end - pd.Timedelta(hours=args.holdout_hours - 1)
+    old_end = end - pd.Timedelta(days=args.new_days)
+    holdout = (df['time'] >= holdout_start).to_numpy()
+    seen = (df['time'] <= old_end).to_numpy()
+    recent = ~holdout & (df['time'] >= holdout_start - pd.Timedelta(days=args.recent_days)).to_numpy()
+    X = df[features]
+    targets = {element: df[element].to_numpy() for element in server.ELEMENTS}
+
+    def subset(mask):
+        return X[mask], {element: y[mask] for element, y in targets.items()}
+
+    print(f"{len(provinces)} tỉnh, mô hình cũ học {args.days} ngày; thêm {args.new_days} ngày mới, "
+          f"kiểm tra trên {args.holdout_hours} giờ cuối ({int(holdout.sum())} dòng):")
+    (baseline, _), base_time = timed(lambda: model_training.train_models(*subset(seen),
+                                                                         num_boost_round=args.rounds))
+    (full, _), full_time = timed(lambda: model_training.train_models(*subset(~holdout),
+                                                                     num_boost_round=args.rounds))
+    continued, continue_time = timed(lambda: model_training.update_models(
+        baseline, *subset(recent), method='continue', num_boost_round=args.incremental_rounds,
+        time_budget=args.time_budget))
+    refitted, refit_time = timed(lambda: model_training.update_models(baseline, *subset(recent), method='refit'))
+
+    X_holdout, y_holdout = subset(holdout)
+    rows = [('mô hình cũ (không cập nhật)', baseline, None), ('huấn luyện lại toàn bộ', full, full_time),
+            (f'continue {args.recent_days} ngày', continued, continue_time),
+            (f'refit {args.recent_days} ngày', refitted, refit_time)]
+    scores = {label: model_training.holdout_rmse(models, X_holdout, y_holdout) for label, models, _ in rows}
+    print(f"  {'':<30}{'giây':>7}  " + '  '.join(f"{element[:12]:>12}" for element in server.ELEMENTS))
+    for label, _, elapsed in rows:
+        seconds = '' if elapsed is None else f"{elapsed:.2f}"
+        print(f"  {label:<30}{seconds:>7}  " + '  '.join(f"{scores[label][e]:12.4f}" for e in server.ELEMENTS))
+    print(f"  (mô hình cũ huấn luyện trong {base_time:.2f} s)")
+
+    # Phiên bản: lưu, chép ra thư mục server, theo dõi lần huấn luyện toàn bộ gần nhất
+    encoder = {name: i for i, name in enumerate(provinces)}
+    with tempfile.TemporaryDirectory() as directory:
+        versions = os.path.join(directory, 'model_versions')
+        full_version = model_store.save_version(full, encoder, features, {'mode': 'full'}, versions)
+        model_store.publish_version(full_version, directory, versions)
+        update_version = model_store.save_version(continued, encoder, features, {'mode': 'incremental'}, versions)
+        model_store.publish_version(update_version, directory, versions)
+        index = model_store.load_version_index(versions)
+        served = model_store.load_boosters(server.ELEMENTS, directory)
+        same = all(np.array_equal(served[e].predict(X_holdout), continued[e].predict(X_holdout))
+                   for e in server.ELEMENTS)
+        versions_ok = (index['current'] == update_version and index['last_full'] == full_version
+                       and len(index['versions']) == 2 and same)
+        print(f"  phiên bản: {len(index['versions'])} bản, đang dùng '{index['current']}', "
+              f"toàn bộ gần nhất '{index['last_full']}', mô hình server đọc "
+              f"{'khớp bản cập nhật' if same else 'KHÁC!'}")
+
+    # Cập nhật tăng dần phải nhanh hơn và không kém hơn mô hình cũ trên cửa sổ kiểm tra
+    improved = all(scores[rows[2][0]][e] <= scores[rows[0][0]][e] * 1.02 for e in server.ELEMENTS)
+    return versions_ok and improved and continue_time < full_time
+
+
+def run_training(args):
+    import lightgbm as lgb
+    from sklearn.metrics import mean_squared_error
+    from sklearn.model_selection import train_test_split
+
+    provinces = sorted(list(server.PROVINCE_DATA)[:args.provinces])
+    X, df = training_frame(provinces, args.days)
+    targets = {element: df[element] for element in server.ELEMENTS}
+    print(f"Huấn luyện {len(targets)} mô hình trên {len(X)} dòng x {X.shape[1]} feature, "
+          f"tối đa {args.rounds} cây, {os.cpu_count()} lõi CPU:")
+
+    def sequential_loop():
+        # Vòng lặp cũ của train_weather_model.py: mỗi yếu tố chia bin lại X
+        import warnings
+        models = {}
+        for element, y in targets.items():
+            X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+            model = lgb.LGBMRegressor(objective='regression_l1', n_estimators=args.rounds, learning_rate=0.05,
+                                      num_leaves=31, random_state=42, n_jobs=-1, verbosity=-1)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # eval_set đã cũ trên LightGBM mới, giữ đúng lời gọi cũ
+                model.fit(X_train, y_train, eval_set=[(X_test, y_test)], eval_metric='rmse',
+                          callbacks=[lgb.early_stopping(100, verbose=False)])
+            np.sqrt(mean_squared_error(y_test, model.predict(X_test)))
+            models[element] = model
+        return models
+
+    _, test_index = model_training.split_indices(len(X))
+    X_test = X.iloc[test_index]
+    expected, old_time = timed(sequential_loop)
+    print(f"  vòng lặp LGBMRegressor (cũ)        : {old_time:6.2f} s")
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        runs = [('Dataset chung, lần lượt', 1, ''), ('Dataset chung, song song', None, ''),
+                ('  + ghi Dataset nhị phân', None, directory), ('  + tải Dataset nhị phân', None, directory)]
+        for label, parallel, dataset_dir in runs:
+            (models, _), elapsed = timed(lambda: model_training.train_models(
+                X, targets, num_boost_round=args.rounds, parallel=parallel, dataset_dir=dataset_dir))
+            workers, threads = model_training.thread_plan(len(targets), parallel)
+            diff = max(np.abs(models[e].predict(X_test) - expected[e].predict(X_test)).max() for e in targets)
+            same_trees = all(models[e].best_iteration == expected[e].best_iteration_ for e in targets)
+            ok = ok and same_trees and diff < 1e-9
+            print(f"  {label:<34}: {elapsed:6.2f} s ({old_time / elapsed:.2f}x), {workers}x{threads} luồng, "
+                  f"{'cùng số cây' if same_trees else 'KHÁC số cây!'}, dự báo lệch tối đa {diff:.1e}")
+    return ok
+
+
+def run_direct(args):
+    from tree_inference import TreeEnsemble
+
+    provinces = sorted(list(server.PROVINCE_DATA)[:args.provinces])
+    raw = pd.concat(make_weather_frame(provinces, pd.Timestamp('2023-01-01'), (args.days + args.test_days) * 24),
+                    ignore_index=True)
+    raw['time'] = pd.to_datetime(raw['time'])
+    with tempfile.TemporaryDirectory() as directory:
+        df, _ = FeatureStore(directory).build(raw, server.ELEMENTS)
+    df = df.dropna().reset_index(drop=True)
+    encoder = {name: i for i, name in enumerate(provinces)}
+    df['province_encoded'] = df['province'].map(encoder)
+    features = build_feature_columns(server.ELEMENTS)
+    cutoff = pd.Timestamp('2023-01-01') + pd.Timedelta(days=args.days)
+    train = df[df['time'] < cutoff].reset_index(drop=True)
+
+    (recursive, _), recursive_time = timed(lambda: model_training.train_models(
+        train[features], {e: train[e] for e in server.ELEMENTS}, num_boost_round=args.rounds))
+    (X_direct, y_direct), sample_time = timed(lambda: model_training.direct_samples(
+        train, features, server.ELEMENTS))
+    (direct, _), direct_time = timed(lambda: model_training.train_models(
+        X_direct, y_direct, num_boost_round=args.rounds))
+    print(f"{len(provinces)} tỉnh, huấn luyện trên {args.days} ngày: đệ quy {len(train)} mẫu {recursive_time:.1f} s; "
+          f"trực tiếp {len(X_direct)} mẫu ({sample_time:.1f} s tạo mẫu) {direct_time:.1f} s")
+
+    server._RESOURCES.update({
+        'province_encoder': encoder,
+        'lightgbm_models': recursive, 'tree_ensemble': TreeEnsemble(recursive, features),
+        'direct_lightgbm_models': direct,
+        'direct_tree_ensemble': TreeEnsemble(direct, server.DIRECT_FEATURE_COLUMNS),
+    })
+    server.load_libraries()
+
+    # Các giờ gốc trong giai đoạn kiểm tra: 48 giờ quan sát trước đó, so với 72 giờ thực tế sau đó
+    raw['time'] = raw['time'].dt.tz_localize('UTC')
+    by_province = {name: group.reset_index(drop=True) for name, group in raw.groupby('province')}
+    origins = pd.date_range(cutoff + pd.Timedelta(hours=48), periods=args.origins,
+                            freq=f'{(args.test_days * 24 - 48 - STEPS) // args.origins}h', tz='UTC')
+    buckets = [(1, 24), (25, 48), (49, 72)]
+    errors = {mode: np.zeros((len(buckets), len(server.ELEMENTS))) for mode in ('recursive', 'direct')}
+    elapsed = {mode: 0.0 for mode in errors}
+    for origin in origins:
+        histories, actuals = [], []
+        for name in provinces:
+            frame = by_province[name]
+            end = int(np.searchsorted(frame['time'], origin))
+            histories.append(frame.iloc[end - 48:end].reset_index(drop=True))
+            actuals.append(frame[server.ELEMENTS].to_numpy(dtype=np.float64)[end:end + STEPS])
+        for mode, forecast in (('recursive', server.rollout_forecast), ('direct', server.direct_forecast)):
+            frames, seconds = timed(forecast, provinces, histories)
+            elapsed[mode] += seconds
+            for frame, actual in zip(frames, actuals):
+                squared = (frame[server.ELEMENTS].to_numpy() - actual) ** 2
+                for b, (first, last) in enumerate(buckets):
+                    errors[mode][b] += squared[first - 1:last].sum(axis=0)
+    rows_per_bucket = [len(origins) * len(provinces) * (last - first + 1) for first, last in buckets]
+
+    single = {mode: timed(forecast, provinces[:1], histories[:1])[1]
+              for mode, forecast in (('recursive', server.rollout_forecast), ('direct', server.direct_forecast))}
+    print(f"Dự báo {STEPS} giờ cho {len(provinces)} tỉnh, {len(origins)} giờ gốc:")
+    for mode, label in (('recursive', 'đệ quy (rollout)'), ('direct', 'trực tiếp')):
+        print(f"  {label:<18}: 1 tỉnh {single[mode] * 1000:7.1f} ms, {len(provinces)} tỉnh "
+              f"{elapsed[mode] / len(origins) * 1000:7.1f} ms/lần")
+    print(f"  RMSE theo tầm dự báo (đệ quy / trực tiếp):")
+    print(f"  {'giờ':<8}" + ''.join(f"{element[:18]:>22}" for element in server.ELEMENTS))
+    for b, (first, last) in enumerate(buckets):
+        cells = [f"{np.sqrt(errors['recursive'][b, j] / rows_per_bucket[b]):10.3f} /"
+                 f"{np.sqrt(errors['direct'][b, j] / rows_per_bucket[b]):9.3f}" for j in range(len(server.ELEMENTS))]
+        print(f"  {f'{first}-{last}':<8}" + ''.join(f"{cell:>22}" for cell in cells))
+
+    # JSON /api/predict phải tạo được từ kết quả của mô hình trực tiếp như từ rollout
+    now_vn = origins[-1].tz_convert('Asia/Ho_Chi_Minh').to_pydatetime()
+    responses = server.build_forecast_responses(provinces, server.direct_forecast(provinces, histories), now_vn)
+    expected = server.build_forecast_responses(provinces, server.rollout_forecast(provinces, histories), now_vn)
+    same_shape = all(len(a['hourly']) == len(b['hourly']) == 24 and len(a['daily']) == len(b['daily'])
+                     and a['hourly'][0].keys() == b['hourly'][0].keys() for a, b in zip(responses, expected))
+    print(f"  JSON dự báo từ mô hình trực tiếp: {'cùng cấu trúc với rollout' if same_shape else 'KHÁC cấu trúc!'}")
+    return same_shape and elapsed['direct'] < elapsed['recursive']
+
+
+def reference_window_samples(df, lags, next_hour_target=False):
+    # Vòng lặp cũ: create_training_samples của server-ai/evaluate_models.py, hoặc bản trong
+    # WeatherAI.py (next_hour_target: feature thời gian của giờ sau cửa sổ, nhãn là giờ kế tiếp nữa)
+    X_list, y_temp_list, y_cond_list = [], [], []
+    for i in range(lags, len(df) - 1 if next_hour_target else len(df)):
+        past = df.iloc[i - lags:i]
+        target = df.iloc[i + 1] if next_hour_target else df.iloc[i]
+        feat = []
+        for j in range(lags):
+            feat.extend([past[column].iloc[j] for column in OBSERVATION_COLUMNS])
+        feat.extend([df["sin_hour"].iloc[i], df["cos_hour"].iloc[i], df["is_night"].iloc[i]])
+        X_list.append(feat)
+        y_temp_list.append(target["temp"])
+        y_cond_list.append(target["condition"])
+    return np.array(X_list), np.array(y_temp_list), np.array(y_cond_list)
+
+
+def make_city_observations(cities, hours, seed=0):
+    # Bảng đã tiền xử lý như preprocess_met_df của server-ai (index thời gian, có condition)
+    rng = np.random.default_rng(seed)
+    frames = []
+    for city in cities:
+        times = pd.date_range('2025-01-01', periods=hours, freq='h', tz='UTC')
+        frame = pd.DataFrame({
+            'temp': np.round(rng.normal(27, 3, hours), 1), 'rhum': np.round(rng.uniform(50, 100, hours), 1),
+            'pres': np.round(rng.normal(1008, 3, hours), 1), 'wind_speed': np.round(rng.gamma(2, 1.5, hours), 1),
+            'cloud_frac': np.round(rng.uniform(0, 100, hours), 1),
+            'precip_1h': np.where(rng.random(hours) < 0.05, np.nan, np.round(rng.exponential(0.3, hours), 1)),
+            'city_name': city,
+        }, index=times)
+        frame['sin_hour'] = np.sin(2 * np.pi * times.hour / 24)
+        frame['cos_hour'] = np.cos(2 * np.pi * times.hour / 24)
+        frame['is_night'] = ((times.hour < 6) | (times.hour > 18)).astype(int)
+        frame['condition'] = rng.choice(['Mưa', 'Nắng', 'Trời mây'], hours)
+        frames.append(frame)
+    # Các thành phố xen kẽ theo giờ như all_cities_weather_data.csv
+    return pd.concat(frames).sort_index(kind='stable')
+
+
+def run_samples(args):
+    cities = [f'city_{i}' for i in range(args.cities)]
+    df_all = make_city_observations(cities, args.hours)
+
+    def same(expected, X, targets):
+        X_old, y_temp, y_cond = expected
+        return (X.shape == X_old.reshape(X.shape).shape
+                and np.array_equal(X, X_old.reshape(X.shape), equal_nan=True)
+                and np.array_equal(targets['temp'].to_numpy(), y_temp)
+                and np.array_equal(targets['condition'].to_numpy(), y_cond))
+
+    ok = True
+    # Các trường hợp biên: ít dòng hơn cửa sổ, vừa đủ một mẫu, thành phố nhiều dòng
+    for city, rows in (('city_0', 3), ('city_0', 7), ('city_0', 8), ('city_1', None)):
+        df_city = df_all[df_all['city_name'] == city].iloc[:rows]
+        for lags, next_hour in ((6, False), (5, True), (1, False)):
+            if next_hour:
+                X, targets = sliding_window_samples(df_city, lags, horizon=2, time_horizon=1)
+            else:
+                X, targets = sliding_window_samples(df_city, lags)
+            ok = ok and same(reference_window_samples(df_city, lags, next_hour), X, targets)
+
+    # Theo từng thành phố: vòng lặp cũ cho mỗi thành phố so với một lần gọi có chia nhóm
+    def old_all():
+        return [reference_window_samples(df_all[df_all['city_name'] == city], 6) for city in cities]
+
+    expected, old_time = timed(old_all)
+    (X, targets), new_time = timed(sliding_window_samples, df_all, 6, 1, None, 'city_name')
+    expected = tuple(np.concatenate([part[k] for part in expected]) for k in range(3))
+    grouped_ok = same(expected, X, targets) and (targets['city_name'].to_numpy()
+                                                 == np.repeat(cities, args.hours - 6)).all()
+    ok = ok and grouped_ok
+    print(f"{len(cities)} thành phố x {args.hours} giờ, lags=6 -> {len(X)} mẫu x {X.shape[1]} feature:")
+    print(f"  vòng lặp iloc (cũ)      : {old_time:8.3f} s")
+    print(f"  sliding_window_samples  : {new_time:8.3f} s ({old_time / new_time:.0f}x)")
+    print(f"  kết quả {'khớp' if ok else 'KHÁC'} với vòng lặp cũ (cả các trường hợp biên và horizon=2 của WeatherAI)")
+    return ok
+
+
+def load_server_ai():
+    # server-ai/server.py trùng tên module với server.py ở đây nên nạp theo đường dẫn
+    import importlib.util
+    directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'server-ai')
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location('server_ai', os.path.join(directory, 'server.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_forest(args):
+    server_ai = load_server_ai()
+    from model_cache import fit_city_models
+
+    df_all = pd.read_csv(server_ai.DATA_FILE, index_col='time', parse_dates=True)
+    cities = list(df_all['city_name'].unique())[:args.cities]
+    server_ai.city_windows.update(df_all, None)
+    start_time = datetime(2025, 6, 12, 1)
+    ok = True
+    timings = {'sklearn': [], 'compact': []}
+    for city in cities:
+        X, targets = sliding_window_samples(server_ai.preprocess_met_df(df_all[df_all['city_name'] == city]),
+                                            lags=server_ai.LAGS)
+        # Như lúc huấn luyện trong server: n_jobs=-1
+        models = server_ai.attach_flat_forests(fit_city_models(
+            X, targets['temp'].to_numpy(), targets['condition'].to_numpy(), n_jobs=-1))
+        X = np.nan_to_num(X)
+        temp_diff = np.abs(models['reg_flat'].predict(X) - models['reg'].predict(X)).max()
+        same_labels = np.array_equal(models['clf_flat'].predict(X),
+                                     models['le'].inverse_transform(models['clf'].predict(X)))
+        results = {}
+        for engine in timings:
+            results[engine], _ = timed(server_ai.forecast_city, models, server_ai.city_windows.get(city),
+                                       start_time, 24, engine)
+            for _ in range(args.repeat):
+                timings[engine].append(timed(server_ai.forecast_city, models, server_ai.city_windows.get(city),
+                                             start_time, 24, engine)[1])
+        same_forecast = results['sklearn'] == results['compact']
+        ok = ok and temp_diff < 1e-9 and same_labels and same_forecast
+        print(f"  {city:<18}: {len(X)} mẫu, nhiệt độ lệch tối đa {temp_diff:.1e}, "
+              f"tình trạng {'khớp' if same_labels else 'KHÁC'}, dự báo 24 giờ {'khớp' if same_forecast else 'KHÁC'}")
+
+    old, new = np.median(timings['sklearn']), np.median(timings['compact'])
+    print(f"Dự báo 24 giờ cho một request ({os.cpu_count()} lõi CPU, trung vị):")
+    print(f"  predict của sklearn (n_jobs=-1)   : {old * 1000:8.1f} ms")
+    print(f"  FlatForest (một luồng, bảng nhãn) : {new * 1000:8.1f} ms ({old / new:.0f}x)")
+    return ok and new < old
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    rollout_parser = subparsers.add_parser('rollout', help='So khớp và đo thời gian rollout 72 giờ')
+    rollout_parser.add_argument('--provinces', type=int, default=5)
+    rollout_parser.set_defaults(func=run_rollout)
+    batch_parser = subparsers.add_parser('batch', help='So sánh dự báo từng tỉnh với dự báo theo lô')
+    batch_parser.add_argument('--provinces', type=int, default=len(server.PROVINCE_DATA))
+    batch_parser.set_defaults(func=run_batch)
+    coalesce_parser = subparsers.add_parser('coalesce', help='Kiểm tra gộp các request miss đồng thời')
+    coalesce_parser.add_argument('--requests', type=int, default=32)
+    coalesce_parser.add_argument('--provinces', type=int, default=3)
+    coalesce_parser.add_argument('--upstream-delay', type=float, default=0.3)
+    coalesce_parser.set_defaults(func=run_coalesce)
+    inference_parser = subparsers.add_parser('inference', help='So sánh bộ suy luận NumPy với LightGBM')
+    inference_parser.add_argument('--repeat', type=int, default=50)
+    inference_parser.set_defaults(func=run_inference)
+    upstream_parser = subparsers.add_parser('upstream', help='Kiểm tra client Open-Meteo với máy chủ giả lập')
+    upstream_parser.add_argument('--requests', type=int, default=50)
+    upstream_parser.add_argument('--latency', type=float, default=0.0)
+    upstream_parser.add_argument('--recordings', help='Thư mục phản hồi Open-Meteo đã ghi (forecast*.json)')
+    upstream_parser.set_defaults(func=run_upstream)
+    shared_parser = subparsers.add_parser('shared_cache', help='Kiểm tra cache dùng chung giữa nhiều tiến trình')
+    shared_parser.add_argument('--workers', type=int, default=4)
+    shared_parser.add_argument('--provinces', type=int, default=8)
+    shared_parser.add_argument('--compute-delay', type=float, default=0.3)
+    shared_parser.add_argument('--lookups', type=int, default=2000)
+    shared_parser.set_defaults(func=run_shared_cache)
+    postprocess_parser = subparsers.add_parser('postprocess', help='So sánh cách tạo JSON dự báo cũ và bản vector')
+    postprocess_parser.add_argument('--trials', type=int, default=8)
+    postprocess_parser.set_defaults(func=run_postprocess)
+    startup_parser = subparsers.add_parser('startup', help='Đo thời gian khởi động nguội của server')
+    startup_parser.add_argument('--repeat', type=int, default=3)
+    startup_parser.set_defaults(func=run_startup)
+    collector_parser = subparsers.add_parser('collector', help='So sánh thu thập tuần tự và song song')
+    collector_parser.add_argument('--provinces', type=int, default=len(server.PROVINCE_DATA))
+    collector_parser.add_argument('--start-date', default='2025-01-01')
+    collector_parser.add_argument('--end-date', default='2025-01-07')
+    collector_parser.add_argument('--latency', type=float, default=0.2)
+    collector_parser.add_argument('--server-rate', type=int, default=10, help='Giới hạn của máy chủ giả lập (req/s)')
+    collector_parser.add_argument('--rate', type=float, default=8.0)
+    collector_parser.add_argument('--workers', type=int, default=8)
+    collector_parser.add_argument('--batch-size', type=int, default=collector.BATCH_SIZE)
+    collector_parser.add_argument('--sequential-delay', type=float, default=1.0)
+    collector_parser.set_defaults(func=run_collector)
+    history_parser = subparsers.add_parser('history', help='So sánh file CSV lịch sử với kho phân vùng')
+    history_parser.add_argument('--provinces', type=int, default=len(server.PROVINCE_DATA))
+    history_parser.add_argument('--days', type=int, default=3 * 365)
+    history_parser.set_defaults(func=run_history)
+    incremental_parser = subparsers.add_parser('incremental', help='Kiểm tra tải theo mốc từng tỉnh và tải bù')
+    incremental_parser.add_argument('--provinces', type=int, default=len(server.PROVINCE_DATA))
+    incremental_parser.add_argument('--days', type=int, default=365)
+    incremental_parser.add_argument('--new-days', type=int, default=2)
+    incremental_parser.add_argument('--latency', type=float, default=0.05)
+    incremental_parser.add_argument('--rate', type=float, default=20.0)
+    incremental_parser.add_argument('--workers', type=int, default=8)
+    incremental_parser.set_defaults(func=run_incremental)
+    backfill_parser = subparsers.add_parser('backfill', help='Tải lần đầu theo cửa sổ, dừng giữa chừng rồi chạy tiếp')
+    backfill_parser.add_argument('--provinces', type=int, default=len(server.PROVINCE_DATA))
+    backfill_parser.add_argument('--days', type=int, default=3 * 365)
+    backfill_parser.add_argument('--window-days', type=int, default=collector.BACKFILL_WINDOW_DAYS)
+    backfill_parser.add_argument('--crash-after', type=int, default=20, help='Số lô đã ghi trước khi giả lập dừng')
+    backfill_parser.add_argument('--rate', type=float, default=50.0)
+    backfill_parser.add_argument('--workers', type=int, default=8)
+    backfill_parser.set_defaults(func=run_backfill)
+    features_parser = subparsers.add_parser('features', help='So sánh cách tạo feature huấn luyện cũ và mới')
+    features_parser.add_argument('--provinces', type=int, default=len(server.PROVINCE_DATA))
+    features_parser.add_argument('--days', type=int, default=3 * 365)
+    features_parser.add_argument('--history-hours', type=int, default=48)
+    features_parser.add_argument('--parity-provinces', type=int, default=10)
+    features_parser.add_argument('--parity-points', type=int, default=20)
+    features_parser.set_defaults(func=run_features)
+    feature_cache_parser = subparsers.add_parser('featurecache', help='Cache ma trận feature cho huấn luyện')
+    feature_cache_parser.add_argument('--provinces', type=int, default=len(server.PROVINCE_DATA))
+    feature_cache_parser.add_argument('--days', type=int, default=3 * 365)
+    feature_cache_parser.set_defaults(func=run_feature_cache)
+    training_parser = subparsers.add_parser('training', help='Huấn luyện nhiều mô hình trên Dataset dùng chung')
+    training_parser.add_argument('--provinces', type=int, default=20)
+    training_parser.add_argument('--days', type=int, default=365)
+    training_parser.add_argument('--rounds', type=int, default=200)
+    training_parser.set_defaults(func=run_training)
+    retrain_parser = subparsers.add_parser('retrain', help='Cập nhật tăng dần so với huấn luyện lại toàn bộ')
+    retrain_parser.add_argument('--provinces', type=int, default=10)
+    retrain_parser.add_argument('--days', type=int, default=365)
+    retrain_parser.add_argument('--new-days', type=int, default=7)
+    retrain_parser.add_argument('--recent-days', type=int, default=30)
+    retrain_parser.add_argument('--holdout-hours', type=int, default=24)
+    retrain_parser.add_argument('--rounds', type=int, default=300)
+    retrain_parser.add_argument('--incremental-rounds', type=int, default=50)
+    retrain_parser.add_argument('--time-budget', type=float, default=60.0)
+    retrain_parser.set_defaults(func=run_retrain)
+    direct_parser = subparsers.add_parser('direct', help='Mô hình trực tiếp so với rollout đệ quy 72 giờ')
+    direct_parser.add_argument('--provinces', type=int, default=10)
+    direct_parser.add_argument('--days', type=int, default=365)
+    direct_parser.add_argument('--test-days', type=int, default=30)
+    direct_parser.add_argument('--origins', type=int, default=20)
+    direct_parser.add_argument('--rounds', type=int, default=300)
+    direct_parser.set_defaults(func=run_direct)
+    samples_parser = subparsers.add_parser('samples', help='Mẫu cửa sổ trượt: vòng lặp iloc cũ so với bản NumPy')
+    samples_parser.add_argument('--cities', type=int, default=10)
+    samples_parser.add_argument('--hours', type=int, default=2000)
+    samples_parser.set_defaults(func=run_samples)
+    forest_parser = subparsers.add_parser('forest', help='Dự báo 24 giờ của server-ai: sklearn so với FlatForest')
+    forest_parser.add_argument('--cities', type=int, default=10)
+    forest_parser.add_argument('--repeat', type=int, default=5)
+    forest_parser.set_defaults(func=run_forest)
+
+    args = parser.parse_args()
+    sys.exit(0 if args.func(args) else 1)
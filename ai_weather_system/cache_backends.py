@@ -0,0 +1,212 @@
+# Mục đích: Nơi lưu các mục của ForecastCache (xem forecast_cache.py).
+# - MemoryBackend: dict trong bộ nhớ, chỉ dùng chung giữa các luồng của một tiến trình.
+# - SQLiteBackend: file SQLite ở chế độ WAL, dùng chung giữa nhiều tiến trình worker
+#   trên cùng máy: kết quả JSON, thời điểm lưu, khóa liên tiến trình có hạn (lease)
+#   để chỉ một worker tính mỗi tỉnh, và giới hạn kích thước (xóa mục cũ nhất).
+# Mỗi backend có: get, stored_at, put, try_lock, unlock, stats.
+# ==============================================================================
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class MemoryBackend:
+    """Lưu trong bộ nhớ của tiến trình, chia sọc để giảm tranh chấp khóa."""
+
+    name = 'memory'
+
+    def __init__(self, stripes=16, max_entries=None):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._entries = [{} for _ in range(stripes)]
+
+    def _stripe(self, key):
+        return hash(key) % len(self._locks)
+
+    def get(self, key):
+        # Trả về (kết quả, thời điểm lưu) hoặc (None, None)
+        stripe = self._stripe(key)
+        with self._locks[stripe]:
+            return self._entries[stripe].get(key, (None, None))
+
+    def stored_at(self, key):
+        return self.get(key)[1]
+
+    def put(self, key, result, timestamp=None):
+        stripe = self._stripe(key)
+        with self._locks[stripe]:
+            self._entries[stripe][key] = (result, time.time() if timestamp is None else timestamp)
+        if self.max_entries is not None:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for stripe, lock in enumerate(self._locks):
+            with lock:
+                entries.extend((timestamp, stripe, key) for key, (_, timestamp) in self._entries[stripe].items())
+        for _, stripe, key in sorted(entries)[:max(0, len(entries) - self.max_entries)]:
+            with self._locks[stripe]:
+                if self._entries[stripe].pop(key, None) is not None:
+                    self.evictions += 1
+
+    def try_lock(self, keys, lease_seconds):
+        # Trong một tiến trình, ForecastCache đã gộp các lần tính (single-flight)
+        return list(keys)
+
+    def unlock(self, keys):
+        pass
+
+    def stats(self):
+        entries = sum(len(stripe) for stripe in self._entries)
+        return {'backend': self.name, 'entries': entries, 'evictions': self.evictions,
+                'max_entries': self.max_entries}
+
+
+class SQLiteBackend:
+    """Lưu trong một file SQLite (WAL) mà mọi worker trên máy cùng mở.
+
+    Khóa liên tiến trình là một dòng trong bảng `locks` với thời hạn
+    `lease_seconds`: nếu worker giữ khóa chết giữa chừng, khóa tự hết hạn.
+    Khi tổng kích thước vượt `max_bytes` hoặc số mục vượt `max_entries`,
+    các mục lưu lâu nhất bị xóa.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, max_entries=None, busy_timeout=30.0):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        # Bản đã giải mã của mục gần nhất mỗi khóa: chỉ đọc lại JSON khi mục đổi
+        self._decoded = {}
+        self._decoded_lock = threading.Lock()
+        connection = self._connect()
+        try:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY, value TEXT NOT NULL,
+                    stored_at REAL NOT NULL, size INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS entries_stored_at ON entries (stored_at);
+                CREATE TABLE IF NOT EXISTS locks (
+                    key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            """)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @property
+    def _connection(self):
+        # Mỗi luồng một kết nối; mở lại sau khi fork (gunicorn --preload)
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = self._connect()
+            local.pid = os.getpid()
+            local.owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        return local.connection
+
+    def get(self, key):
+        with self._decoded_lock:
+            known_at, known_result = self._decoded.get(key, (None, None))
+        # Chỉ lấy lại chuỗi JSON khi mục trong file khác bản đã giải mã
+        row = self._connection.execute(
+            "SELECT stored_at, CASE WHEN stored_at = ? THEN NULL ELSE value END FROM entries WHERE key = ?",
+            (known_at, key)
+        ).fetchone()
+        if row is None:
+            return None, None
+        stored_at, value = row
+        if value is None:
+            return known_result, stored_at
+        result = json.loads(value)
+        with self._decoded_lock:
+            self._decoded[key] = (stored_at, result)
+        return result, stored_at
+
+    def stored_at(self, key):
+        row = self._connection.execute("SELECT stored_at FROM entries WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, result, timestamp=None):
+        value = json.dumps(result, ensure_ascii=False, separators=(',', ':'))
+        stored_at = time.time() if timestamp is None else timestamp
+        connection = self._connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, stored_at, size) VALUES (?, ?, ?, ?)",
+                (key, value, stored_at, len(value.encode('utf-8')))
+            )
+            self._evict(connection)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        with self._decoded_lock:
+            self._decoded[key] = (stored_at, result)
+
+    def _evict(self, connection):
+        count, total = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if ((self.max_entries is None or count <= self.max_entries)
+                and (self.max_bytes is None or total <= self.max_bytes)):
+            return
+        evicted = 0
+        for key, size in connection.execute("SELECT key, size FROM entries ORDER BY stored_at").fetchall():
+            if ((self.max_entries is None or count <= self.max_entries)
+                    and (self.max_bytes is None or total <= self.max_bytes)):
+                break
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            count, total, evicted = count - 1, total - size, evicted + 1
+        connection.execute(
+            "INSERT INTO counters (name, value) VALUES ('evictions', ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (evicted,)
+        )
+
+    def try_lock(self, keys, lease_seconds):
+        """Nhận khóa cho các tỉnh chưa bị worker khác giữ; trả về các tỉnh đã khóa."""
+        connection = self._connection
+        owner, now = self._local.owner, time.time()
+        acquired = []
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for key in keys:
+                connection.execute("DELETE FROM locks WHERE key = ? AND expires_at <= ?", (key, now))
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO locks (key, owner, expires_at) VALUES (?, ?, ?)",
+                    (key, owner, now + lease_seconds)
+                )
+                if cursor.rowcount:
+                    acquired.append(key)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return acquired
+
+    def unlock(self, keys):
+        connection = self._connection
+        connection.executemany(
+            "DELETE FROM locks WHERE key = ? AND owner = ?", [(key, self._local.owner) for key in keys]
+        )
+
+    def stats(self):
+        connection = self._connection
+        count, total = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        row = connection.execute("SELECT value FROM counters WHERE name = 'evictions'").fetchone()
+        locked = connection.execute("SELECT COUNT(*) FROM locks WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+        return {'backend': self.name, 'path': self.path, 'entries': count, 'bytes': total,
+                'evictions': row[0] if row else 0, 'locked': locked,
+                'max_entries': self.max_entries, 'max_bytes': self.max_bytes}
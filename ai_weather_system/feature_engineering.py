@@ -0,0 +1,182 @@
+# Mục đích: Định nghĩa và cách tính feature dùng chung cho huấn luyện
+# (train_weather_model.py) và phục vụ (server.py, rollout_engine.py).
+# - Feature thời gian: sin/cos của giờ, ngày trong năm, tháng.
+# - Feature lịch sử theo từng tỉnh, chỉ dùng giá trị các giờ trước (shift 1):
+#   lag 1..3, rolling mean 6/24 và rolling std 6.
+# - Tính cho mọi tỉnh cùng lúc: lag bằng cắt mảng NumPy, rolling bằng một lần gọi
+#   rolling của pandas với cửa sổ không vượt qua đầu mỗi tỉnh (thay cho 15 lần
+#   groupby().transform(lambda ...)). Kết quả trùng từng bit với cách cũ vì
+#   pandas tính lại từ đầu mỗi khi cửa sổ nhảy sang tỉnh mới.
+# - Mô hình trực tiếp (dự báo thẳng giờ thứ h, không đệ quy): feature của giờ kế tiếp
+#   như trên, thêm tầm dự báo 'horizon' và feature thời gian của giờ cần dự báo.
+# ==============================================================================
+import functools
+
+import numpy as np
+
+# pandas được import trong từng hàm (như model_store.py) để server.py vẫn khởi động
+# mà không import pandas (xem STARTUP_MODE)
+
+LAGS = 3
+MEAN_WINDOWS = (6, 24)
+STD_WINDOW = 6
+
+TIME_FEATURES = [
+    'hour_sin', 'hour_cos', 'day_of_year_sin', 'day_of_year_cos', 'month_sin', 'month_cos'
+]
+
+DIRECT_HORIZON = 72  # số giờ dự báo của mô hình trực tiếp
+DIRECT_TIME_FEATURES = [f'target_{column}' for column in TIME_FEATURES]
+
+
+def element_feature_columns(element):
+    columns = [f'{element}_lag_{i}' for i in range(1, LAGS + 1)]
+    columns += [f'{element}_rolling_mean_{window}' for window in MEAN_WINDOWS]
+    columns.append(f'{element}_rolling_std_{STD_WINDOW}')
+    return columns
+
+
+def build_feature_columns(elements):
+    """Thứ tự cột feature đúng như lúc huấn luyện mô hình."""
+    columns = list(TIME_FEATURES)
+    for element in elements:
+        columns += element_feature_columns(element)
+    columns.append('province_encoded')
+    return columns
+
+
+def build_direct_feature_columns(elements):
+    """Cột feature của mô hình trực tiếp: build_feature_columns, 'horizon', feature thời gian của giờ dự báo."""
+    return build_feature_columns(elements) + ['horizon'] + DIRECT_TIME_FEATURES
+
+
+def time_features(prediction_time):
+    # Biểu thức vô hướng cho một thời điểm; cho cùng giá trị với time_feature_frame
+    return [
+        np.sin(2 * np.pi * prediction_time.hour / 24),
+        np.cos(2 * np.pi * prediction_time.hour / 24),
+        np.sin(2 * np.pi * prediction_time.dayofyear / 366),
+        np.cos(2 * np.pi * prediction_time.dayofyear / 366),
+        np.sin(2 * np.pi * prediction_time.month / 12),
+        np.cos(2 * np.pi * prediction_time.month / 12),
+    ]
+
+
+def time_feature_frame(times):
+    """Feature thời gian cho một cột thời gian (Series datetime)."""
+    import pandas as pd
+    return pd.DataFrame({
+        'hour_sin': np.sin(2 * np.pi * times.dt.hour / 24),
+        'hour_cos': np.cos(2 * np.pi * times.dt.hour / 24),
+        'day_of_year_sin': np.sin(2 * np.pi * times.dt.dayofyear / 366),
+        'day_of_year_cos': np.cos(2 * np.pi * times.dt.dayofyear / 366),
+        'month_sin': np.sin(2 * np.pi * times.dt.month / 12),
+        'month_cos': np.cos(2 * np.pi * times.dt.month / 12),
+    }, index=times.index)
+
+
+def direct_feature_matrix(base_features, base_times, horizons):
+    """Ma trận feature của mô hình trực tiếp.
+
+    base_features: (n, số cột của build_feature_columns), feature cho giờ kế tiếp
+    sau cửa sổ quan sát (giờ base_times); horizons: tầm dự báo 1..DIRECT_HORIZON,
+    giờ cần dự báo là base_times + (horizon - 1) giờ.
+    """
+    import pandas as pd
+    horizons = np.asarray(horizons, dtype=np.int64)
+    target_times = pd.Series(pd.DatetimeIndex(base_times) + pd.to_timedelta(horizons - 1, unit='h'))
+    target_block = time_feature_frame(target_times).to_numpy(dtype=np.float64)
+    return np.concatenate([np.asarray(base_features, dtype=np.float64),
+                           horizons[:, None].astype(np.float64), target_block], axis=1)
+
+
+@functools.lru_cache(maxsize=None)
+def _group_window_indexer_class():
+    import pandas as pd
+
+    class GroupWindowIndexer(pd.api.indexers.BaseIndexer):
+        # Cửa sổ `window_size` dòng kết thúc tại mỗi dòng, không vượt qua dòng đầu của nhóm
+        def get_window_bounds(self, num_values=0, min_periods=None, center=None, closed=None, step=None):
+            end = np.arange(1, num_values + 1, dtype=np.int64)
+            start = np.maximum(end - self.window_size, self.group_starts)
+            return start, end
+    return GroupWindowIndexer
+
+
+def _group_starts(group_keys):
+    """Vị trí dòng đầu của nhóm chứa mỗi dòng; các nhóm phải nằm liền nhau."""
+    import pandas as pd
+    codes, uniques = pd.factorize(np.asarray(group_keys))
+    n = len(codes)
+    firsts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if n else np.array([], dtype=np.int64)
+    if len(firsts) != len(uniques):
+        raise ValueError("Dữ liệu phải được sắp theo tỉnh (mỗi tỉnh là một khối dòng liền nhau)")
+    return np.repeat(firsts, np.diff(np.r_[firsts, n])).astype(np.int64)
+
+
+def lag_arrays(values, position=None):
+    """Lag 1..LAGS của mảng (số dòng, số yếu tố); `position` là thứ tự của dòng trong nhóm."""
+    n = len(values)
+    position = np.arange(n) if position is None else position
+    lags = []
+    for i in range(1, LAGS + 1):
+        lag = np.full_like(values, np.nan)
+        lag[i:] = values[:n - i]
+        lag[position < i] = np.nan
+        lags.append(lag)
+    return lags
+
+
+def history_feature_frame(values, elements, group_keys=None, index=None):
+    """Feature lịch sử (lag, rolling mean, rolling std) cho mảng giá trị (số dòng, số yếu tố).
+
+    Dòng i chỉ dùng các dòng trước nó trong cùng nhóm `group_keys` (mặc định
+    một nhóm); cột theo thứ tự của build_feature_columns.
+    """
+    import pandas as pd
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    group_starts = np.zeros(n, dtype=np.int64) if group_keys is None else _group_starts(group_keys)
+    position = np.arange(n) - group_starts
+
+    lags = lag_arrays(values, position)
+
+    # Rolling trên lag 1 (giá trị giờ trước) cho mọi yếu tố trong một lần gọi
+    shifted = pd.DataFrame(lags[0])
+    rolled = {}
+    for window in set(MEAN_WINDOWS) | {STD_WINDOW}:
+        indexer = _group_window_indexer_class()(window_size=window, group_starts=group_starts)
+        rolling = shifted.rolling(indexer, min_periods=1)
+        if window in MEAN_WINDOWS:
+            rolled[('mean', window)] = rolling.mean().to_numpy()
+        if window == STD_WINDOW:
+            rolled[('std', window)] = rolling.std().to_numpy()
+
+    columns = {}
+    for j, element in enumerate(elements):
+        blocks = [lag[:, j] for lag in lags]
+        blocks += [rolled[('mean', window)][:, j] for window in MEAN_WINDOWS]
+        blocks.append(rolled[('std', STD_WINDOW)][:, j])
+        columns.update(zip(element_feature_columns(element), blocks))
+    return pd.DataFrame(columns, index=index)
+
+
+def add_features(df, elements, group_column='province', time_column='time'):
+    """Thêm feature thời gian và lịch sử vào DataFrame đã sắp theo (tỉnh, thời gian).
+
+    Trả về DataFrame mới; không có cột province_encoded (tùy bảng mã tỉnh).
+    """
+    import pandas as pd
+    history = history_feature_frame(df[elements].to_numpy(dtype=np.float64), elements,
+                                    df[group_column].to_numpy(), df.index)
+    return pd.concat([df, time_feature_frame(df[time_column]), history], axis=1)
+
+
+def next_hour_features(df_history, elements, prediction_time):
+    """Feature (dict) cho giờ ngay sau dòng cuối của lịch sử một tỉnh, như một dòng của add_features."""
+    values = df_history[elements].to_numpy(dtype=np.float64)
+    values = np.vstack([values, np.full((1, len(elements)), np.nan)])
+    history = history_feature_frame(values, elements).iloc[-1]
+    features = dict(zip(TIME_FEATURES, time_features(prediction_time)))
+    features.update(history.to_dict())
+    return features
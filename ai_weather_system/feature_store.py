@@ -0,0 +1,195 @@
+# Mục đích: Lưu ma trận feature đã tính (feature_engineering.py) để các lần huấn luyện
+# sau chỉ cần tải lại thay vì tiền xử lý và tính lại từ đầu.
+# - Mỗi tỉnh một file .cols (cùng định dạng nhị phân với history_store.py) gồm giờ,
+#   giá trị đã điền chỗ thiếu và các feature rolling; lag (giá trị dịch xuống) và
+#   feature thời gian (tính một lần cho mỗi giờ) được tạo lại khi tải.
+# - Khóa theo nội dung: mã băm dữ liệu gốc của tỉnh và mã băm định nghĩa feature
+#   (danh sách yếu tố, số lag, cửa sổ rolling, FEATURE_VERSION). Tên file chứa cả hai mã.
+# - Dữ liệu chỉ thêm giờ mới ở cuối (mã băm phần đầu vẫn khớp): chỉ tính phần đuôi,
+#   dùng lại CONTEXT_ROWS dòng cuối đã lưu làm ngữ cảnh cho lag/rolling.
+#   Dữ liệu cũ bị sửa, ghi bù ở giữa hoặc đổi định nghĩa feature: tính lại cả tỉnh.
+# ==============================================================================
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from feature_engineering import (
+    LAGS, MEAN_WINDOWS, STD_WINDOW, TIME_FEATURES,
+    element_feature_columns, history_feature_frame, lag_arrays, time_feature_frame
+)
+from history_store import (
+    PARTITION_SUFFIX, province_slug, read_partition, write_partition,
+    _read_json, _write_atomic, _write_json
+)
+
+FEATURE_CACHE_DIR = os.environ.get('FEATURE_CACHE_DIR', 'feature_cache')
+INDEX_FILENAME = 'features.json'
+# Tăng khi đổi cách tiền xử lý hoặc cách tính feature mà các tham số bên dưới không đổi
+FEATURE_VERSION = 1
+# Số dòng trước đó mà feature của một dòng cần tới (lag xa nhất, cửa sổ rolling dài nhất)
+CONTEXT_ROWS = max(LAGS, *MEAN_WINDOWS, STD_WINDOW)
+
+
+def definition_key(elements):
+    definition = {
+        'version': FEATURE_VERSION, 'elements': list(elements), 'lags': LAGS,
+        'mean_windows': list(MEAN_WINDOWS), 'std_window': STD_WINDOW, 'time_features': TIME_FEATURES,
+    }
+    return hashlib.sha256(json.dumps(definition, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _row_digests(times, values, prefix_rows):
+    """Mã băm (của `prefix_rows` dòng đầu, của cả bảng) theo từng dòng (giờ, các giá trị gốc)."""
+    rows = np.ascontiguousarray(np.column_stack([times.astype('datetime64[ns]').view(np.int64).view(np.float64), values]))
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(rows[:prefix_rows])
+    prefix = digest.hexdigest()
+    digest.update(rows[prefix_rows:])
+    return prefix, digest.hexdigest()
+
+
+def fill_missing(values):
+    """Điền chỗ thiếu trong lịch sử một tỉnh: giá trị giờ trước, rồi giá trị giờ sau cho các dòng đầu."""
+    return pd.DataFrame(values).ffill().bfill().to_numpy(dtype=np.float64)
+
+
+def _rolling_columns(elements):
+    # Chỉ lưu các cột rolling; lag là giá trị đã lưu dịch xuống nên cắt lại khi tải
+    return [column for element in elements for column in element_feature_columns(element)[LAGS:]]
+
+
+def _province_bounds(df):
+    """(tên tỉnh, vị trí bắt đầu) nếu df đã sắp theo (tỉnh, giờ), ngược lại None."""
+    provinces = df['province'].to_numpy()
+    changes = np.r_[True, provinces[1:] != provinces[:-1]] if len(provinces) else np.array([], dtype=bool)
+    starts = np.flatnonzero(changes)
+    names = provinces[starts]
+    times = df['time'].to_numpy(dtype='datetime64[ns]')
+    if any(a >= b for a, b in zip(names[:-1], names[1:])) or not ((np.diff(times) > np.timedelta64(0)) | changes[1:]).all():
+        return None
+    return names, starts
+
+
+class FeatureStore:
+    """Bộ nhớ đệm ma trận feature theo tỉnh cho train_weather_model.py."""
+
+    def __init__(self, directory=FEATURE_CACHE_DIR):
+        self.directory = directory
+
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_FILENAME)
+
+    def _province_features(self, entry, key, times, raw, elements):
+        """Trả về (mảng theo cột để lưu, cách lấy: 'hit' | 'tail' | 'full', mã băm dữ liệu gốc)."""
+        columns = _rolling_columns(elements)
+        cached_rows = entry['rows'] if entry and entry['definition'] == key and entry['rows'] <= len(times) else 0
+        prefix_digest, digest = _row_digests(times, raw, cached_rows)
+        path = os.path.join(self.directory, entry['file']) if cached_rows else None
+
+        # Các dòng đã lưu phải là phần đầu không đổi của dữ liệu hiện tại
+        if cached_rows and prefix_digest == entry['digest'] and os.path.exists(path):
+            cached = read_partition(path)
+            if cached_rows == len(times):
+                return cached, 'hit', digest
+            cached_values = np.column_stack([cached[element] for element in elements])
+            if cached_rows >= CONTEXT_ROWS and not np.isnan(cached_values).any():
+                # Chỉ tính phần đuôi: nối CONTEXT_ROWS dòng cuối đã xử lý với các dòng mới
+                values = fill_missing(np.vstack([cached_values[-CONTEXT_ROWS:], raw[cached_rows:]]))
+                tail = history_feature_frame(values, elements).iloc[CONTEXT_ROWS:]
+                arrays = {'time': times}
+                for j, element in enumerate(elements):
+                    arrays[element] = np.concatenate([cached[element], values[CONTEXT_ROWS:, j]])
+                for column in columns:
+                    arrays[column] = np.concatenate([cached[column], tail[column].to_numpy()])
+                return arrays, 'tail', digest
+
+        values = fill_missing(raw)
+        history = history_feature_frame(values, elements)
+        arrays = {'time': times}
+        arrays.update({element: values[:, j] for j, element in enumerate(elements)})
+        arrays.update({column: history[column].to_numpy() for column in columns})
+        return arrays, 'full', digest
+
+    def build(self, df, elements):
+        """Feature của toàn bộ `df` (cột time, province và các yếu tố), dùng lại cache khi có thể.
+
+        Kết quả như add_features trên dữ liệu đã sắp theo (tỉnh, giờ) và điền chỗ thiếu
+        theo từng tỉnh (fill_missing); chưa bỏ dòng NaN. Trả về (DataFrame, số tỉnh theo
+        cách lấy {'hit', 'tail', 'full'}).
+        """
+        elements = list(elements)
+        key = definition_key(elements)
+        bounds = _province_bounds(df)
+        if bounds is None:
+            # Giờ trùng trong cùng tỉnh thì giữ dòng sau cùng (như HistoryStore.append)
+            df = df.sort_values(by=['province', 'time'], kind='stable')
+            df = df.drop_duplicates(['province', 'time'], keep='last').reset_index(drop=True)
+            bounds = _province_bounds(df)
+        names, starts = bounds
+        ends = list(starts[1:]) + [len(df)]
+        all_times = df['time'].to_numpy(dtype='datetime64[ns]')
+        all_raw = df[elements].to_numpy(dtype=np.float64)
+
+        os.makedirs(self.directory, exist_ok=True)
+        provinces = _read_json(self._index_path()).get('provinces', {})
+        counts = {'hit': 0, 'tail': 0, 'full': 0}
+        parts, stale = [], []
+        for province_name, start, end in zip(names, starts, ends):
+            times, raw = all_times[start:end], all_raw[start:end]
+            entry = provinces.get(province_name)
+            arrays, source, digest = self._province_features(entry, key, times, raw, elements)
+            counts[source] += 1
+            if source != 'hit':
+                filename = f"{province_slug(province_name) or 'province'}-{key}-{digest}{PARTITION_SUFFIX}"
+                _write_atomic(os.path.join(self.directory, filename), lambda f: write_partition(f, arrays))
+                provinces[province_name] = {'file': filename, 'rows': len(times), 'definition': key,
+                                            'digest': digest}
+                if entry and entry['file'] != filename:
+                    stale.append(entry['file'])
+            parts.append(arrays)
+
+        _write_json(self._index_path(), {'provinces': dict(sorted(provinces.items()))})
+        # Xóa file cũ sau khi index đã trỏ sang file mới
+        for filename in stale:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+        return self._assemble(parts, names, elements), counts
+
+    @staticmethod
+    def _assemble(parts, names, elements):
+        # Ghi thẳng vào một khối float theo cột (order='F'): DataFrame dùng lại khối này,
+        # không phải nối từng cột rồi gộp khối thêm một lần nữa
+        history_columns = [column for element in elements for column in element_feature_columns(element)]
+        columns = elements + TIME_FEATURES + history_columns
+        position = {column: i for i, column in enumerate(columns)}
+        sizes = [len(part['time']) for part in parts]
+        offsets = np.r_[0, np.cumsum(sizes)].astype(np.int64)
+        matrix = np.empty((offsets[-1], len(columns)), dtype=np.float64, order='F')
+        times = np.empty(offsets[-1], dtype='datetime64[ns]')
+        for part, start, end in zip(parts, offsets[:-1], offsets[1:]):
+            times[start:end] = part['time']
+            values = np.column_stack([part[element] for element in elements])
+            matrix[start:end, :len(elements)] = values
+            lags = lag_arrays(values)
+            for j, element in enumerate(elements):
+                element_columns = element_feature_columns(element)
+                for i, column in enumerate(element_columns[:LAGS]):
+                    matrix[start:end, position[column]] = lags[i][:, j]
+                for column in element_columns[LAGS:]:
+                    matrix[start:end, position[column]] = part[column]
+
+        # Feature thời gian chỉ phụ thuộc giờ: tính một lần cho mỗi giờ khác nhau
+        codes, unique_times = pd.factorize(times)
+        hourly = time_feature_frame(pd.Series(unique_times))
+        for column in TIME_FEATURES:
+            matrix[:, position[column]] = hourly[column].to_numpy()[codes]
+
+        frame = pd.DataFrame(matrix, columns=columns, copy=False)
+        frame.insert(0, 'time', pd.to_datetime(times))
+        frame.insert(len(elements) + 1, 'province', np.repeat(np.asarray(names, dtype=object), sizes))
+        return frame
@@ -0,0 +1,306 @@
+# Mục đích: Cache kết quả dự báo trong bộ nhớ và bộ làm mới cache chạy nền.
+# - Phục vụ bản hơi cũ (stale-while-revalidate) trong lúc làm mới ở nền.
+# - Làm mới các tỉnh trước khi hết hạn theo từng nhóm nhỏ, tỉnh được hỏi nhiều nhất trước:
+#   mỗi nhóm được ghi vào cache ngay khi xong, không chờ cả lượt.
+# - An toàn khi Flask chạy nhiều luồng: khóa chia sọc và gộp các lần miss đồng thời.
+# - Dùng chung giữa nhiều tiến trình worker qua backend SQLite (cache_backends.py).
+# ==============================================================================
+import os
+import threading
+import time
+from collections import Counter
+
+from cache_backends import MemoryBackend
+
+FRESH = 'fresh'
+STALE = 'stale'
+DEFAULT_STRIPES = 16
+DEFAULT_LOCK_SECONDS = 120  # thời hạn khóa liên tiến trình, dài hơn một lần dự báo theo lô
+DEFAULT_POLL_SECONDS = 0.1
+COMPUTE_ERROR = "Đã xảy ra lỗi phía server."
+
+
+class _Flight:
+    # Một lần tính đang diễn ra cho một khóa; các request khác chờ kết quả của nó
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ForecastCache:
+    """Cache dự báo theo tỉnh: mỗi mục là (kết quả JSON, thời điểm lưu).
+
+    Các mục nằm trong `backend` (mặc định MemoryBackend; SQLiteBackend để
+    nhiều tiến trình worker dùng chung, xem cache_backends.py).
+    compute() gộp các lần miss đồng thời (single-flight): request đầu tiên
+    tính, các request khác cho cùng tỉnh chờ và dùng chung kết quả. Giữa các
+    tiến trình, khóa của backend bảo đảm chỉ một worker tính mỗi tỉnh; worker
+    khác chờ kết quả được ghi vào backend.
+    """
+
+    def __init__(self, ttl_seconds, stale_seconds=0, stripes=DEFAULT_STRIPES, backend=None,
+                 lock_seconds=DEFAULT_LOCK_SECONDS, poll_seconds=DEFAULT_POLL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.backend = MemoryBackend(stripes) if backend is None else backend
+        self.lock_seconds = lock_seconds
+        self.poll_seconds = poll_seconds
+        self.request_counts = Counter()
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._flights = [{} for _ in range(stripes)]
+        self._counts_lock = threading.Lock()
+        self._stats = Counter()
+
+    def _stripe(self, key):
+        return hash(key) % len(self._locks)
+
+    def _count(self, name, amount=1):
+        with self._counts_lock:
+            self._stats[name] += amount
+
+    def _state(self, timestamp):
+        if timestamp is None:
+            return None
+        age = time.time() - timestamp
+        if age < self.ttl_seconds:
+            return FRESH
+        if age < self.ttl_seconds + self.stale_seconds:
+            return STALE
+        return None
+
+    def _lookup(self, key):
+        result, timestamp = self.backend.get(key)
+        state = self._state(timestamp)
+        return (result, state) if state is not None else (None, None)
+
+    def lookup(self, key):
+        # Trả về (kết quả, FRESH/STALE) hoặc (None, None) nếu không dùng được
+        result, state = self._lookup(key)
+        self._count({FRESH: 'hits', STALE: 'stale_hits', None: 'misses'}[state])
+        return result, state
+
+    def set(self, key, result):
+        self.backend.put(key, result)
+
+    def age(self, key):
+        timestamp = self.backend.stored_at(key)
+        return float('inf') if timestamp is None else time.time() - timestamp
+
+    def _claim(self, keys, only_missing):
+        # Nhận quyền tính các khóa chưa có luồng nào tính; trả về khóa tự tính,
+        # các lần tính đang chạy cần chờ, và các kết quả vừa có sẵn trong cache.
+        owned, waiting, cached = [], {}, {}
+        for key in keys:
+            stripe = self._stripe(key)
+            with self._locks[stripe]:
+                if only_missing:
+                    result, state = self._lookup(key)
+                    if state == FRESH:
+                        cached[key] = result
+                        continue
+                flight = self._flights[stripe].get(key)
+                if flight is None:
+                    self._flights[stripe][key] = _Flight()
+                    owned.append(key)
+                else:
+                    waiting[key] = flight
+        return owned, waiting, cached
+
+    def _release(self, key, result=None, error=None):
+        # Kết quả đã được ghi vào backend trước khi gỡ flight
+        stripe = self._stripe(key)
+        with self._locks[stripe]:
+            flight = self._flights[stripe].pop(key)
+        flight.result, flight.error = result, error
+        flight.done.set()
+
+    def _compute_shared(self, keys, compute_fn):
+        """Tính các khóa dưới khóa liên tiến trình của backend.
+
+        Khóa đang bị worker khác giữ thì chờ worker đó ghi kết quả mới
+        (hoặc nhả khóa mà không có kết quả, khi đó tự tính).
+        """
+        baseline = {key: self.backend.stored_at(key) or 0.0 for key in keys}
+        results, errors = {}, {}
+        pending = list(keys)
+        give_up_at = time.monotonic() + self.lock_seconds
+        while pending:
+            locked = self.backend.try_lock(pending, self.lock_seconds)
+            if locked:
+                try:
+                    # Kiểm tra lại: worker khác có thể vừa ghi xong trước khi nhả khóa
+                    mine = []
+                    for key in locked:
+                        result, timestamp = self.backend.get(key)
+                        if timestamp is not None and timestamp > baseline[key]:
+                            results[key] = result
+                            self._count('shared')
+                        else:
+                            mine.append(key)
+                    if mine:
+                        new_results, new_errors = compute_fn(mine)
+                        self._count('computed', len(mine))
+                        for key in mine:
+                            if key in new_results:
+                                self.backend.put(key, new_results[key])
+                                results[key] = new_results[key]
+                            else:
+                                errors[key] = new_errors.get(key, COMPUTE_ERROR)
+                finally:
+                    self.backend.unlock(locked)
+                pending = [key for key in pending if key not in results and key not in errors]
+                if not pending:
+                    break
+            if time.monotonic() >= give_up_at:
+                errors.update((key, COMPUTE_ERROR) for key in pending)
+                break
+            self._count('lock_waits')
+            time.sleep(self.poll_seconds)
+            for key in pending:
+                result, timestamp = self.backend.get(key)
+                if timestamp is not None and timestamp > baseline[key]:
+                    results[key] = result
+                    self._count('shared')
+            pending = [key for key in pending if key not in results]
+        return results, errors
+
+    def compute(self, keys, compute_fn, wait=True, only_missing=True):
+        """Tính và lưu kết quả cho các khóa, mỗi khóa chỉ được tính một lần.
+
+        `compute_fn(keys)` trả về (kết quả, lỗi) dạng dict theo khóa.
+        Với only_missing=False (bộ làm mới nền), khóa còn mới vẫn được tính lại.
+        Với wait=False, khóa đang được luồng khác tính sẽ bị bỏ qua.
+        """
+        owned, waiting, results = self._claim(keys, only_missing)
+        errors = {}
+        released = set()
+        try:
+            if owned:
+                new_results, new_errors = self._compute_shared(owned, compute_fn)
+                for key in owned:
+                    if key in new_results:
+                        results[key] = new_results[key]
+                        self._release(key, result=new_results[key])
+                    else:
+                        errors[key] = new_errors.get(key, COMPUTE_ERROR)
+                        self._release(key, error=errors[key])
+                    released.add(key)
+        finally:
+            for key in owned:
+                if key not in released:
+                    self._release(key, error=COMPUTE_ERROR)
+        if wait:
+            for key, flight in waiting.items():
+                flight.done.wait()
+                if flight.error is None:
+                    results[key] = flight.result
+                else:
+                    errors[key] = flight.error
+        return results, errors
+
+    def stats(self):
+        """Số lần hit/miss của tiến trình này và thông tin của backend."""
+        with self._counts_lock:
+            counters = dict(self._stats)
+        lookups = sum(counters.get(name, 0) for name in ('hits', 'stale_hits', 'misses'))
+        counters['hit_ratio'] = round((counters.get('hits', 0) + counters.get('stale_hits', 0)) / lookups, 3) if lookups else None
+        return {'pid': os.getpid(), 'counters': counters, 'backend': self.backend.stats()}
+
+    def record_request(self, key):
+        with self._counts_lock:
+            self.request_counts[key] += 1
+
+    def by_popularity(self, keys, requested_only=False):
+        with self._counts_lock:
+            counts = dict(self.request_counts)
+        if requested_only:
+            keys = [key for key in keys if counts.get(key, 0)]
+        return sorted(keys, key=lambda key: counts.get(key, 0), reverse=True)
+
+
+class CacheWarmer:
+    """Luồng nền làm mới các mục sắp hết hạn (hoặc đã cũ) của ForecastCache.
+
+    `refresh(keys)` trả về (kết quả, lỗi) cho danh sách tỉnh truyền vào; việc
+    ghi cache và gộp với các request đang tính cùng tỉnh do cache.compute() lo.
+    `warm_set` là None (mọi tỉnh trong `all_keys`), một danh sách tỉnh,
+    hoặc một số nguyên N (N tỉnh được hỏi nhiều nhất, chỉ tính tỉnh đã có người hỏi).
+    Mỗi lượt làm mới theo nhóm `max_batch` tỉnh (None: một nhóm cho tất cả).
+    """
+
+    def __init__(self, cache, refresh, all_keys, warm_set=None,
+                 refresh_ahead_seconds=120, interval_seconds=30, max_batch=None):
+        self.cache = cache
+        self.refresh = refresh
+        self.all_keys = list(all_keys)
+        self.warm_set = warm_set
+        self.refresh_ahead_seconds = refresh_ahead_seconds
+        self.interval_seconds = interval_seconds
+        self.max_batch = max_batch
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def start(self):
+        if self._pid != os.getpid():
+            # Tiến trình con sau fork (worker gunicorn): luồng và khóa của tiến trình cha
+            # không dùng được, tạo lại
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._wake = threading.Event()
+            self._stop = threading.Event()
+            self._thread = None
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='cache-warmer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def request_refresh(self, key):
+        # Được gọi khi vừa phục vụ một bản cũ: làm mới sớm nhất có thể
+        with self._lock:
+            self._pending.add(key)
+        self._wake.set()
+
+    def warm_keys(self):
+        if self.warm_set is None:
+            return list(self.all_keys)
+        if isinstance(self.warm_set, int):
+            return self.cache.by_popularity(self.all_keys, requested_only=True)[:self.warm_set]
+        return list(self.warm_set)
+
+    def due_keys(self):
+        """Các tỉnh cần làm mới ngay, tỉnh được yêu cầu nhiều xếp trước."""
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        threshold = self.cache.ttl_seconds - self.refresh_ahead_seconds
+        due = pending | {key for key in self.warm_keys() if self.cache.age(key) >= threshold}
+        return self.cache.by_popularity(due)
+
+    def run_once(self):
+        keys = self.due_keys()
+        size = self.max_batch or len(keys) or 1
+        for start in range(0, len(keys), size):
+            if self._stop.is_set():
+                break
+            chunk = keys[start:start + size]
+            try:
+                self.cache.compute(chunk, self.refresh, wait=False, only_missing=False)
+            except Exception as e:
+                print(f"Lỗi khi làm mới cache nền cho {len(chunk)} tỉnh: {e}")
+        return keys
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_once()
+            self._wake.wait(self.interval_seconds)
+            self._wake.clear()
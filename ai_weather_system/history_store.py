@@ -0,0 +1,379 @@
+# Mục đích: Kho dữ liệu thời tiết lịch sử thay cho file vietnam_weather_history.csv.
+# - Chia theo tỉnh và tháng: <thư mục>/<tỉnh>/<YYYY-MM>.cols. Mỗi file gồm một
+#   header JSON (số dòng, tên và kiểu từng cột) rồi tới dữ liệu nhị phân của từng
+#   cột nối tiếp nhau; chỉ cần NumPy để đọc/ghi, đọc một cột không phải đọc cả file.
+#   Các cột được thu gọn không mất mát (giờ -> số phút, 24.3 -> 243 kiểu int16...).
+#   (.npz chậm hơn cả CSV khi có hàng nghìn phân vùng nhỏ vì phải mở file zip.)
+# - Ghi thêm chỉ chạm tới các phân vùng có dữ liệu mới (thường là tháng hiện tại),
+#   không đọc và ghi lại toàn bộ lịch sử như file CSV.
+# - Đọc có thể chọn cột, chọn tỉnh và khoảng thời gian (bỏ qua các tháng không cần).
+# - manifest.json giữ mốc (watermark) giờ mới nhất của từng tỉnh, cập nhật nguyên tử
+#   sau mỗi lần ghi, để bộ thu thập biết cần tải từ đâu mà không đọc dữ liệu.
+# - find_gaps() tìm các khoảng giờ bị thiếu của một tỉnh (chỉ đọc cột time).
+# Chạy trực tiếp (python history_store.py) để chuyển file CSV cũ sang kho một lần.
+# ==============================================================================
+import argparse
+import json
+import os
+import re
+import threading
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+HISTORY_DIR = os.environ.get('HISTORY_STORE_DIR', 'weather_history')
+LEGACY_CSV_FILENAME = 'vietnam_weather_history.csv'
+INDEX_FILENAME = 'provinces.json'
+MANIFEST_FILENAME = 'manifest.json'
+PARTITION_SUFFIX = '.cols'
+_MAGIC = b'WXCOLS1\n'
+
+
+def province_slug(province_name):
+    # Tên thư mục không dấu, an toàn trên mọi hệ điều hành ("Bà Rịa - Vũng Tàu" -> "ba_ria_vung_tau")
+    name = province_name.replace('Đ', 'D').replace('đ', 'd')
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+
+def _month_key(timestamp):
+    return f"{timestamp.year:04d}-{timestamp.month:02d}"
+
+
+def _smallest_int(values):
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if values.min() >= info.min and values.max() <= info.max:
+            return values.astype(dtype)
+    return values.astype(np.int64)
+
+
+def _encode(values):
+    """Thu gọn một cột mà không mất giá trị; trả về (mảng lưu, hệ số).
+
+    - thời gian tròn phút: số phút (giá trị = mảng lưu * hệ số nano giây);
+    - số nguyên: kiểu nguyên nhỏ nhất đủ chứa;
+    - số thực có ít chữ số thập phân (như 24.3): số nguyên (giá trị = mảng lưu / hệ số),
+      chỉ khi chia lại cho ra đúng từng bit giá trị cũ (NaN thì giữ nguyên float).
+    """
+    if not len(values):
+        return values, None
+    if values.dtype.kind == 'M':
+        nanoseconds = values.astype('datetime64[ns]').astype(np.int64)
+        if not (nanoseconds % 60_000_000_000).any():
+            return _smallest_int(nanoseconds // 60_000_000_000), 60_000_000_000
+    elif values.dtype.kind in 'iu':
+        return _smallest_int(values), None
+    elif values.dtype.kind == 'f' and np.isfinite(values).all():
+        for scale in (1, 10, 100, 1000):
+            scaled = np.round(values * scale)
+            if np.abs(scaled).max() < 2 ** 31 and np.array_equal(scaled / scale, values):
+                return _smallest_int(scaled.astype(np.int64)), scale
+    return values, None
+
+
+def _decode(stored, dtype, scale):
+    if stored.dtype == dtype:
+        return stored
+    if dtype.kind == 'M':
+        return (stored.astype(np.int64) * scale).view('datetime64[ns]').astype(dtype)
+    if dtype.kind == 'f':
+        return stored.astype(dtype) / scale
+    return stored.astype(dtype)
+
+
+def write_partition(f, arrays):
+    """Ghi {tên cột: mảng 1 chiều cùng độ dài} theo định dạng .cols."""
+    rows = len(next(iter(arrays.values()))) if arrays else 0
+    columns, buffers = [], []
+    for name, values in arrays.items():
+        values = np.asarray(values)
+        # Chuỗi (object) lưu dạng unicode độ dài cố định để ghi được thành byte
+        if values.dtype.kind == 'O':
+            values = values.astype(str)
+        stored, scale = _encode(values)
+        columns.append([name, values.dtype.str, stored.dtype.str, scale])
+        buffers.append(np.ascontiguousarray(stored).tobytes())
+    header = json.dumps({'rows': rows, 'columns': columns}).encode('utf-8')
+    f.write(_MAGIC + len(header).to_bytes(4, 'little') + header)
+    for buffer in buffers:
+        f.write(buffer)
+
+
+def read_partition(path, columns=None):
+    """Đọc file .cols; `columns` giới hạn các cột cần đọc (giữ thứ tự trong file)."""
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"'{path}' không phải file phân vùng lịch sử")
+        header = json.loads(f.read(int.from_bytes(f.read(4), 'little')))
+        rows, offset = header['rows'], f.tell()
+        if columns is None:
+            buffer = f.read()
+        arrays = {}
+        position = 0
+        for name, dtype, stored_dtype, scale in header['columns']:
+            stored_dtype = np.dtype(stored_dtype)
+            size = rows * stored_dtype.itemsize
+            if columns is None:
+                stored = np.frombuffer(buffer, dtype=stored_dtype, count=rows, offset=position)
+            elif name in columns:
+                f.seek(offset + position)
+                stored = np.frombuffer(f.read(size), dtype=stored_dtype, count=rows)
+            else:
+                position += size
+                continue
+            arrays[name] = _decode(stored, np.dtype(dtype), scale)
+            position += size
+    return arrays
+
+
+def _concat_columns(old, new):
+    # Ghép hai phân vùng theo cột; cột chỉ có ở một bên được điền NaN ở bên kia
+    merged = {}
+    for column in list(old) + [c for c in new if c not in old]:
+        parts = [side[column] if column in side else np.full(len(side['time']), np.nan) for side in (old, new)]
+        merged[column] = np.concatenate(parts)
+    return merged
+
+
+def _write_atomic(path, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_json(path, payload):
+    data = json.dumps(payload, ensure_ascii=False, indent=2).encode('utf-8')
+    _write_atomic(path, lambda f: f.write(data))
+
+
+class HistoryStore:
+    """Dữ liệu giờ của các tỉnh, chia phân vùng theo tỉnh và tháng.
+
+    Cột 'time' đọc ra dạng datetime64[ns], các cột số giữ nguyên kiểu khi ghi;
+    cột 'province' không lưu theo dòng mà suy ra từ phân vùng.
+    """
+
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    # --- Danh mục tỉnh và phân vùng ---
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_FILENAME)
+
+    def provinces(self):
+        """{tên tỉnh: tên thư mục} của các tỉnh đã có dữ liệu."""
+        return _read_json(self._index_path())
+
+    def exists(self):
+        return bool(self.provinces())
+
+    def partitions(self, province_name):
+        """Các tháng ('YYYY-MM') đã có của một tỉnh, theo thứ tự thời gian."""
+        slug = self.provinces().get(province_name)
+        if slug is None:
+            return []
+        return sorted(name[:-len(PARTITION_SUFFIX)] for name in os.listdir(os.path.join(self.directory, slug))
+                      if name.endswith(PARTITION_SUFFIX))
+
+    def _partition_path(self, slug, month):
+        return os.path.join(self.directory, slug, f"{month}{PARTITION_SUFFIX}")
+
+    def _register(self, province_names):
+        index = self.provinces()
+        missing = [name for name in province_names if name not in index]
+        if not missing:
+            return index
+        for name in missing:
+            slug = province_slug(name) or 'province'
+            if slug in index.values():
+                raise ValueError(f"Tên thư mục '{slug}' của '{name}' trùng với tỉnh khác")
+            index[name] = slug
+            os.makedirs(os.path.join(self.directory, slug), exist_ok=True)
+        _write_json(self._index_path(), dict(sorted(index.items())))
+        return index
+
+    # --- Ghi ---
+    def append(self, df):
+        """Ghi thêm các dòng (cột 'time', 'province' và các cột số); dòng trùng (tỉnh, giờ) thì lấy bản mới.
+
+        Chỉ các phân vùng (tỉnh, tháng) có trong `df` được đọc và ghi lại.
+        Trả về số phân vùng đã ghi.
+        """
+        if df.empty:
+            return 0
+        times = pd.to_datetime(df['time']).to_numpy(dtype='datetime64[ns]')
+        value_columns = [c for c in df.columns if c not in ('time', 'province')]
+        values = {column: df[column].to_numpy() for column in value_columns}
+        province_codes, province_names = pd.factorize(df['province'])
+        months = times.astype('datetime64[M]')
+        # Một lần sắp xếp theo (tỉnh, tháng); trong mỗi phân vùng giữ thứ tự ban đầu của các dòng
+        order = np.lexsort((months, province_codes))
+        keys = np.stack([province_codes[order], months[order].astype(np.int64)])
+        bounds = np.flatnonzero((keys[:, 1:] != keys[:, :-1]).any(axis=0)) + 1
+        written = 0
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            index = self._register(list(province_names))
+            for rows in np.split(order, bounds):
+                province_name = province_names[province_codes[rows[0]]]
+                path = self._partition_path(index[province_name], str(months[rows[0]]))
+                part = {'time': times[rows]}
+                part.update({column: values[column][rows] for column in value_columns})
+                if os.path.exists(path):
+                    part = _concat_columns(read_partition(path), part)
+                # Sắp theo giờ; giờ trùng thì lấy dòng sau cùng (dữ liệu mới)
+                part_order = np.argsort(part['time'], kind='stable')
+                sorted_times = part['time'][part_order]
+                keep = part_order[np.append(sorted_times[1:] != sorted_times[:-1], True)]
+                arrays = {column: column_values[keep] for column, column_values in part.items()}
+                _write_atomic(path, lambda f: write_partition(f, arrays))
+                written += 1
+            # Chỉ nâng mốc sau khi mọi phân vùng đã ghi xong; ghi bù khoảng cũ không làm lùi mốc
+            latest = pd.Series(times).groupby(province_codes).max()
+            self._advance_watermarks({province_names[code]: value for code, value in latest.items()})
+        return written
+
+    # --- Mốc (watermark) theo tỉnh ---
+    def _manifest_path(self):
+        return os.path.join(self.directory, MANIFEST_FILENAME)
+
+    def _advance_watermarks(self, latest):
+        manifest = _read_json(self._manifest_path())
+        changed = False
+        for province_name, timestamp in latest.items():
+            timestamp = pd.Timestamp(timestamp)
+            entry = manifest.get(province_name)
+            if entry is None or pd.Timestamp(entry['watermark']) < timestamp:
+                manifest[province_name] = {'watermark': timestamp.strftime('%Y-%m-%dT%H:%M'),
+                                           'updated_at': pd.Timestamp.now().strftime('%Y-%m-%dT%H:%M:%S')}
+                changed = True
+        if changed:
+            _write_json(self._manifest_path(), dict(sorted(manifest.items())))
+
+    def _province_last_time(self, province_name):
+        slug = self.provinces()[province_name]
+        for month in reversed(self.partitions(province_name)):
+            times = read_partition(self._partition_path(slug, month), ['time'])['time']
+            if len(times):
+                return pd.Timestamp(times.max())
+        return None
+
+    def watermarks(self):
+        """{tên tỉnh: giờ mới nhất đã lưu} đọc từ manifest, không đọc dữ liệu.
+
+        Tỉnh có trong kho mà chưa có trong manifest (kho tạo trước khi có manifest)
+        được tính lại từ tháng cuối của tỉnh đó rồi ghi vào manifest.
+        """
+        manifest = _read_json(self._manifest_path())
+        missing = [name for name in self.provinces() if name not in manifest]
+        if missing:
+            with self._lock:
+                latest = {name: self._province_last_time(name) for name in missing}
+                self._advance_watermarks({name: value for name, value in latest.items() if value is not None})
+            manifest = _read_json(self._manifest_path())
+        return {name: pd.Timestamp(entry['watermark']) for name, entry in manifest.items()}
+
+    def find_gaps(self, province_name, freq='h'):
+        """Các khoảng giờ bị thiếu [(đầu, cuối)] (tính cả hai đầu) giữa giờ đầu tiên và mốc của tỉnh."""
+        slug = self.provinces().get(province_name)
+        if slug is None:
+            return []
+        times = [read_partition(self._partition_path(slug, month), ['time'])['time']
+                 for month in self.partitions(province_name)]
+        times = np.concatenate(times) if times else np.array([], dtype='datetime64[ns]')
+        if len(times) < 2:
+            return []
+        step = pd.Timedelta(1, unit=freq).to_timedelta64()
+        # Các phân vùng đã sắp theo thời gian và không trùng nhau
+        jumps = np.flatnonzero(np.diff(times) > step)
+        return [(pd.Timestamp(times[i] + step), pd.Timestamp(times[i + 1] - step)) for i in jumps]
+
+    # --- Đọc ---
+    def read(self, columns=None, provinces=None, start=None, end=None):
+        """Đọc dữ liệu thành DataFrame (cột time, các cột số, province), sắp theo tỉnh rồi thời gian.
+
+        columns: chỉ đọc các cột này (luôn có 'time' và 'province').
+        provinces: chỉ đọc các tỉnh này. start/end: giới hạn thời gian (tính cả hai đầu).
+        """
+        start = None if start is None else pd.Timestamp(start)
+        end = None if end is None else pd.Timestamp(end)
+        wanted = None if columns is None else [c for c in columns if c not in ('time', 'province')]
+        index = self.provinces()
+        names = sorted(index) if provinces is None else sorted(p for p in provinces if p in index)
+
+        chunks, counts, order = {}, [], None
+        for province_name in names:
+            count = 0
+            for month in self.partitions(province_name):
+                # Bỏ qua cả phân vùng nằm ngoài khoảng thời gian mà không mở file
+                if start is not None and month < _month_key(start):
+                    continue
+                if end is not None and month > _month_key(end):
+                    continue
+                arrays = read_partition(self._partition_path(index[province_name], month),
+                                        None if wanted is None else ['time'] + wanted)
+                if start is not None or end is not None:
+                    times = arrays['time']
+                    mask = np.ones(len(times), dtype=bool)
+                    if start is not None:
+                        mask &= times >= start.to_datetime64()
+                    if end is not None:
+                        mask &= times <= end.to_datetime64()
+                    arrays = {name: values[mask] for name, values in arrays.items()}
+                if order is None:
+                    order = list(arrays)
+                for name, values in arrays.items():
+                    chunks.setdefault(name, []).append(values)
+                count += len(arrays['time'])
+            counts.append(count)
+
+        if order is None:
+            order = ['time'] + (wanted or [])
+        data = {name: np.concatenate(chunks[name]) if name in chunks else np.array([], dtype='datetime64[ns]'
+                                                                                    if name == 'time' else float)
+                for name in order}
+        if wanted is not None:
+            data = {name: data[name] for name in ['time'] + wanted if name in data}
+        data['province'] = np.repeat(np.array(names, dtype=object), counts) if names else np.array([], dtype=object)
+        df = pd.DataFrame(data)
+        df['time'] = pd.to_datetime(df['time'])
+        return df
+
+    def last_time(self):
+        """Thời điểm mới nhất trong kho (theo manifest), hoặc None."""
+        return max(self.watermarks().values(), default=None)
+
+
+def migrate_csv(csv_path=LEGACY_CSV_FILENAME, store=None, chunksize=500_000):
+    """Chuyển file CSV cũ sang kho (một lần). Trả về số dòng đã chuyển."""
+    store = store or HistoryStore()
+    rows = 0
+    # Đọc theo khúc để không phải giữ cả file trong bộ nhớ; CSV đã sắp theo tỉnh rồi thời gian
+    for chunk in pd.read_csv(csv_path, parse_dates=['time'], chunksize=chunksize):
+        store.append(chunk)
+        rows += len(chunk)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chuyển vietnam_weather_history.csv sang kho phân vùng')
+    parser.add_argument('--csv', default=LEGACY_CSV_FILENAME)
+    parser.add_argument('--dir', default=HISTORY_DIR)
+    args = parser.parse_args()
+
+    store = HistoryStore(args.dir)
+    rows = migrate_csv(args.csv, store)
+    print(f"Đã chuyển {rows} dòng của '{args.csv}' sang '{args.dir}' "
+          f"({len(store.provinces())} tỉnh, {sum(len(store.partitions(p)) for p in store.provinces())} phân vùng).")
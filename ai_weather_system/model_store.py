@@ -0,0 +1,197 @@
+# Mục đích: Lưu và tải các mô hình dự báo ở định dạng gốc thay cho pickle (joblib).
+# - forecast_trees.npz: cây của cả 5 mô hình dưới dạng mảng phẳng (TreeEnsemble),
+#   chỉ cần NumPy để tải, không phải import LightGBM/scikit-learn.
+# - model_{element}.txt: định dạng văn bản của LightGBM, dùng cho các lô lớn.
+# - province_encoder.json: bảng mã tỉnh thành.
+# - direct_forecast_trees.npz, direct_model_{element}.txt: mô hình trực tiếp 72 giờ
+#   (train_weather_model.py --direct), nếu có.
+# Nếu chưa có file định dạng mới thì tự dùng lại các file .joblib cũ.
+# - Phiên bản: mỗi lần huấn luyện ghi vào model_versions/<phiên bản>/ (kèm metadata.json),
+#   rồi mới chép sang thư mục server đọc (publish_version); versions.json ghi lịch sử,
+#   phiên bản đang dùng và lần huấn luyện lại toàn bộ gần nhất.
+# Chạy trực tiếp (python model_store.py) để chuyển các file .joblib hiện có.
+# ==============================================================================
+import json
+import os
+import shutil
+from datetime import datetime
+
+from tree_inference import TreeEnsemble
+
+TREES_FILENAME = 'forecast_trees.npz'
+DIRECT_TREES_FILENAME = 'direct_forecast_trees.npz'
+ENCODER_FILENAME = 'province_encoder.json'
+LEGACY_ENCODER_FILENAME = 'province_encoder.joblib'
+VERSIONS_DIR = os.environ.get('MODEL_VERSIONS_DIR', 'model_versions')
+VERSION_INDEX_FILENAME = 'versions.json'
+METADATA_FILENAME = 'metadata.json'
+
+
+def booster_filename(element):
+    return f'model_{element}.txt'
+
+
+def legacy_model_filename(element):
+    return f'model_{element}.joblib'
+
+
+def direct_booster_filename(element):
+    return f'direct_model_{element}.txt'
+
+
+def _save_boosters(models, filename, directory):
+    for element, model in models.items():
+        booster = model.booster_ if hasattr(model, 'booster_') else model
+        # Giữ đúng số cây mà LGBMRegressor.predict dùng khi có early stopping
+        best_iteration = getattr(model, 'best_iteration_', None) or booster.best_iteration
+        booster.save_model(
+            os.path.join(directory, filename(element)),
+            num_iteration=best_iteration if best_iteration and best_iteration > 0 else None
+        )
+
+
+def export_models(models, province_encoder, feature_names, directory='.'):
+    """Ghi mô hình và bảng mã tỉnh ra các định dạng gốc để server tải nhanh."""
+    _save_boosters(models, booster_filename, directory)
+    TreeEnsemble(models, feature_names).save(os.path.join(directory, TREES_FILENAME))
+    with open(os.path.join(directory, ENCODER_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump({name: int(code) for name, code in province_encoder.items()}, f, ensure_ascii=False, indent=2)
+
+
+def load_province_encoder(directory='.', native=True):
+    path = os.path.join(directory, ENCODER_FILENAME)
+    if native and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    import joblib
+    return joblib.load(os.path.join(directory, LEGACY_ENCODER_FILENAME))
+
+
+def load_boosters(elements, directory='.', native=True):
+    """Các mô hình LightGBM theo yếu tố (Booster từ file .txt, hoặc LGBMRegressor từ .joblib)."""
+    models = {}
+    for element in elements:
+        path = os.path.join(directory, booster_filename(element))
+        if native and os.path.exists(path):
+            import lightgbm as lgb
+            models[element] = lgb.Booster(model_file=path)
+        else:
+            import joblib
+            models[element] = joblib.load(os.path.join(directory, legacy_model_filename(element)))
+    return models
+
+
+def load_tree_ensemble(elements, feature_names, directory='.', native=True):
+    path = os.path.join(directory, TREES_FILENAME)
+    if native and os.path.exists(path):
+        ensemble = TreeEnsemble.load(path)
+        if ensemble.names == list(elements) and ensemble.feature_names == list(feature_names):
+            return ensemble
+        print(f"Cảnh báo: '{path}' không khớp danh sách yếu tố/feature hiện tại, chuyển lại từ mô hình LightGBM.")
+    return TreeEnsemble(load_boosters(elements, directory, native), feature_names)
+
+
+def export_direct_models(models, feature_names, directory='.'):
+    """Ghi các mô hình trực tiếp (một mô hình cho mọi tầm dự báo của mỗi yếu tố)."""
+    _save_boosters(models, direct_booster_filename, directory)
+    TreeEnsemble(models, feature_names).save(os.path.join(directory, DIRECT_TREES_FILENAME))
+
+
+def load_direct_boosters(elements, directory='.'):
+    import lightgbm as lgb
+    return {element: lgb.Booster(model_file=os.path.join(directory, direct_booster_filename(element)))
+            for element in elements}
+
+
+def load_direct_tree_ensemble(elements, feature_names, directory='.'):
+    path = os.path.join(directory, DIRECT_TREES_FILENAME)
+    if os.path.exists(path):
+        ensemble = TreeEnsemble.load(path)
+        if ensemble.names == list(elements) and ensemble.feature_names == list(feature_names):
+            return ensemble
+        print(f"Cảnh báo: '{path}' không khớp danh sách yếu tố/feature hiện tại, chuyển lại từ mô hình LightGBM.")
+    return TreeEnsemble(load_direct_boosters(elements, directory), feature_names)
+
+
+def load_version_index(versions_dir=VERSIONS_DIR):
+    """{'current': phiên bản đang dùng, 'last_full': lần huấn luyện toàn bộ gần nhất, 'versions': [...]}."""
+    try:
+        with open(os.path.join(versions_dir, VERSION_INDEX_FILENAME), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'current': None, 'last_full': None, 'versions': []}
+
+
+def _write_version_index(index, versions_dir):
+    path = os.path.join(versions_dir, VERSION_INDEX_FILENAME)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_version_metadata(version, versions_dir=VERSIONS_DIR):
+    with open(os.path.join(versions_dir, version, METADATA_FILENAME), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_version(models, province_encoder, feature_names, metadata, versions_dir=VERSIONS_DIR,
+                 direct_models=None, direct_feature_names=None, carry_from=None):
+    """Ghi mô hình (định dạng gốc và .joblib) vào một thư mục phiên bản mới; trả về tên phiên bản.
+
+    Mô hình trực tiếp: ghi `direct_models` nếu có, nếu không thì chép các file mô hình
+    trực tiếp của phiên bản `carry_from` (nếu phiên bản đó có).
+    """
+    import joblib
+    version = datetime.now().strftime('%Y%m%d-%H%M%S')
+    while os.path.exists(os.path.join(versions_dir, version)):
+        version += '_'
+    directory = os.path.join(versions_dir, version)
+    os.makedirs(directory)
+    export_models(models, province_encoder, feature_names, directory)
+    for element, model in models.items():
+        joblib.dump(model, os.path.join(directory, legacy_model_filename(element)))
+    joblib.dump(dict(province_encoder), os.path.join(directory, LEGACY_ENCODER_FILENAME))
+    if direct_models:
+        export_direct_models(direct_models, direct_feature_names, directory)
+    elif carry_from:
+        source = os.path.join(versions_dir, carry_from)
+        names = [DIRECT_TREES_FILENAME] + [direct_booster_filename(element) for element in models]
+        if all(os.path.exists(os.path.join(source, name)) for name in names):
+            for name in names:
+                shutil.copyfile(os.path.join(source, name), os.path.join(directory, name))
+    metadata = dict(metadata, version=version, created_at=datetime.now().isoformat(timespec='seconds'))
+    with open(os.path.join(directory, METADATA_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+    index = load_version_index(versions_dir)
+    index['versions'].append({'version': version, 'mode': metadata.get('mode'),
+                              'created_at': metadata['created_at'], 'data_end': metadata.get('data_end')})
+    _write_version_index(index, versions_dir)
+    return version
+
+
+def publish_version(version, directory='.', versions_dir=VERSIONS_DIR):
+    """Chép các file của phiên bản sang thư mục server đọc (từng file thay thế nguyên tử)."""
+    source = os.path.join(versions_dir, version)
+    for name in sorted(os.listdir(source)):
+        if name == METADATA_FILENAME:
+            continue
+        tmp_path = os.path.join(directory, f"{name}.{os.getpid()}.tmp")
+        shutil.copyfile(os.path.join(source, name), tmp_path)
+        os.replace(tmp_path, os.path.join(directory, name))
+    index = load_version_index(versions_dir)
+    index['current'] = version
+    if load_version_metadata(version, versions_dir).get('mode') == 'full':
+        index['last_full'] = version
+    _write_version_index(index, versions_dir)
+
+
+if __name__ == '__main__':
+    # Import server chỉ để lấy danh sách yếu tố và feature (ở chế độ khởi động lười, không nạp mô hình)
+    from server import ELEMENTS, FEATURE_COLUMNS
+
+    models = load_boosters(ELEMENTS, native=False)
+    export_models(models, load_province_encoder(native=False), FEATURE_COLUMNS)
+    print(f"Đã ghi {TREES_FILENAME}, {ENCODER_FILENAME} và "
+          f"{', '.join(booster_filename(element) for element in ELEMENTS)}.")
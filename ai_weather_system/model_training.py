@@ -0,0 +1,222 @@
+# Mục đích: Huấn luyện mô hình LightGBM cho mọi yếu tố trên cùng một ma trận feature
+# (dùng trong train_weather_model.py).
+# - Chia bin (lgb.Dataset) một lần cho tập train và tập kiểm tra rồi dùng chung cho mọi
+#   yếu tố: mỗi mô hình lấy một bản subset (chép dữ liệu đã chia bin, không chia lại)
+#   và chỉ đổi nhãn. Trước đây mỗi lần LGBMRegressor.fit đều chia bin lại cả X.
+# - Có thể ghi Dataset đã chia bin ra file nhị phân của LightGBM (TRAIN_DATASET_DIR),
+#   đặt tên theo mã băm nội dung để lần chạy sau với cùng dữ liệu chỉ cần tải lại.
+# - Chạy song song các mô hình (TRAIN_PARALLEL_TARGETS), chia số lõi CPU cho từng mô hình
+#   thay vì để mỗi mô hình chạy lần lượt với toàn bộ số lõi.
+# - Cập nhật tăng dần (update_models): từ các Booster đang dùng, huấn luyện thêm cây trên
+#   dữ liệu gần đây ('continue') hoặc chỉ tính lại giá trị lá ('refit'), trong giới hạn
+#   thời gian chia đều cho các mô hình.
+# - Mẫu cho mô hình trực tiếp (direct_samples): mỗi mẫu là một (giờ gốc, tầm dự báo h),
+#   lấy giờ gốc cách đều và vài tầm ngẫu nhiên cho mỗi giờ gốc để số mẫu không nhân 72 lần.
+# Cùng tham số và cùng cách chia train/test (random_state=42) nên cho đúng mô hình như
+# vòng lặp LGBMRegressor cũ.
+# ==============================================================================
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+from sklearn.model_selection import train_test_split
+
+from feature_engineering import DIRECT_HORIZON, build_direct_feature_columns, direct_feature_matrix
+
+# Tương đương LGBMRegressor(objective='regression_l1', learning_rate=0.05, num_leaves=31,
+# random_state=42) với eval_metric='rmse' (metric của objective đứng sau)
+LGBM_PARAMS = {
+    'objective': 'regression_l1',
+    'learning_rate': 0.05,
+    'num_leaves': 31,
+    'random_state': 42,
+    'metric': ['rmse', 'l1'],
+    'verbosity': -1,
+}
+NUM_BOOST_ROUND = 1000
+EARLY_STOPPING_ROUNDS = 100
+TEST_SIZE = 0.2
+SPLIT_RANDOM_STATE = 42
+
+INCREMENTAL_ROUNDS = 100
+REFIT_DECAY_RATE = 0.9  # phần giá trị lá cũ được giữ lại khi refit
+
+DIRECT_ORIGIN_STRIDE = int(os.environ.get('DIRECT_ORIGIN_STRIDE', 6))  # giờ giữa hai giờ gốc
+DIRECT_HORIZONS_PER_ORIGIN = int(os.environ.get('DIRECT_HORIZONS_PER_ORIGIN', 6))
+
+PARALLEL_TARGETS = int(os.environ.get('TRAIN_PARALLEL_TARGETS', '0'))  # 0: tự chọn theo số lõi
+DATASET_DIR = os.environ.get('TRAIN_DATASET_DIR', '')  # rỗng: không ghi Dataset ra file
+
+
+def split_indices(n_rows, test_size=TEST_SIZE, random_state=SPLIT_RANDOM_STATE):
+    """Chỉ số (train, test) giống train_test_split(X, y, ...) cho mọi yếu tố."""
+    return train_test_split(np.arange(n_rows), test_size=test_size, random_state=random_state)
+
+
+def thread_plan(n_targets, parallel=None, cores=None):
+    """(số mô hình chạy cùng lúc, số luồng LightGBM của mỗi mô hình)."""
+    cores = cores or os.cpu_count() or 1
+    parallel = parallel or PARALLEL_TARGETS or cores
+    workers = max(1, min(parallel, n_targets, cores))
+    return workers, max(1, cores // workers)
+
+
+def _dataset_key(X, train_index, params):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps({'columns': list(X.columns), 'params': params}, sort_keys=True).encode('utf-8'))
+    digest.update(np.ascontiguousarray(X.to_numpy(dtype=np.float64)))
+    digest.update(np.ascontiguousarray(train_index, dtype=np.int64))
+    return digest.hexdigest()
+
+
+def build_datasets(X, train_index, test_index, params=LGBM_PARAMS, dataset_dir=DATASET_DIR):
+    """Dataset đã chia bin (chưa có nhãn) của tập train và tập kiểm tra.
+
+    Tập kiểm tra dùng bin của tập train như LGBMRegressor.fit. Nếu có `dataset_dir`
+    thì ghi/tải file nhị phân theo mã băm của X, cách chia và tham số.
+    """
+    paths = None
+    if dataset_dir:
+        key = _dataset_key(X, train_index, params)
+        paths = [os.path.join(dataset_dir, f'dataset-{key}.{name}.bin') for name in ('train', 'test')]
+        if all(os.path.exists(path) for path in paths):
+            train = lgb.Dataset(paths[0], params=params).construct()
+            test = lgb.Dataset(paths[1], reference=train, params=params).construct()
+            return train, test
+    train = lgb.Dataset(X.iloc[train_index], params=params).construct()
+    test = lgb.Dataset(X.iloc[test_index], reference=train, params=params).construct()
+    if paths:
+        os.makedirs(dataset_dir, exist_ok=True)
+        for dataset, path in zip((train, test), paths):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            dataset.save_binary(tmp_path)
+            os.replace(tmp_path, path)
+    return train, test
+
+
+def _labelled(dataset, label):
+    subset = dataset.subset(np.arange(dataset.num_data())).construct()
+    subset.set_label(label)
+    return subset
+
+
+def train_models(X, targets, params=LGBM_PARAMS, num_boost_round=NUM_BOOST_ROUND,
+                 early_stopping_rounds=EARLY_STOPPING_ROUNDS, parallel=None, dataset_dir=DATASET_DIR,
+                 on_done=None):
+    """Huấn luyện một Booster cho mỗi cột nhãn trong `targets` ({tên: Series/mảng}).
+
+    Trả về ({tên: Booster}, {tên: RMSE trên tập kiểm tra}). `on_done(tên, booster, rmse,
+    giây)` được gọi khi từng mô hình xong (theo thứ tự hoàn thành).
+    """
+    train_index, test_index = split_indices(len(X))
+    train, test = build_datasets(X, train_index, test_index, params, dataset_dir)
+    workers, threads = thread_plan(len(targets), parallel)
+    X_test = X.iloc[test_index]
+
+    def fit(name, train_set, test_set, y_test):
+        start = time.perf_counter()
+        booster = lgb.train(
+            dict(params, num_threads=threads), train_set, num_boost_round=num_boost_round,
+            valid_sets=[test_set], callbacks=[lgb.early_stopping(early_stopping_rounds, verbose=False)]
+        )
+        preds = booster.predict(X_test, num_threads=threads)
+        rmse = float(np.sqrt(np.mean((y_test - preds) ** 2)))
+        return name, booster, rmse, time.perf_counter() - start
+
+    models, scores = {}, {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        # Tạo các bản có nhãn ở luồng chính (nhanh), chỉ phần huấn luyện chạy song song
+        for name, y in targets.items():
+            y = np.asarray(y, dtype=np.float64)
+            futures.append(executor.submit(fit, name, _labelled(train, y[train_index]),
+                                           _labelled(test, y[test_index]), y[test_index]))
+        for future in as_completed(futures):
+            name, booster, rmse, elapsed = future.result()
+            models[name], scores[name] = booster, rmse
+            if on_done is not None:
+                on_done(name, booster, rmse, elapsed)
+    # Giữ thứ tự yếu tố như đầu vào
+    return {name: models[name] for name in targets}, {name: scores[name] for name in targets}
+
+
+def _time_budget(seconds):
+    # Dừng huấn luyện (giữ các cây đã thêm) khi hết thời gian
+    deadline = time.monotonic() + seconds
+
+    def callback(env):
+        if time.monotonic() >= deadline:
+            raise lgb.callback.EarlyStopException(env.iteration, env.evaluation_result_list or [])
+    callback.order = 40
+    return callback
+
+
+def update_models(models, X, targets, method='continue', num_boost_round=INCREMENTAL_ROUNDS,
+                  time_budget=None, params=LGBM_PARAMS, on_done=None):
+    """Cập nhật các Booster có sẵn ({tên: Booster}) trên dữ liệu gần đây `X`, `targets`.
+
+    method='continue': thêm tối đa `num_boost_round` cây, tiếp tục từ các cây cũ;
+    method='refit': giữ cấu trúc cây, tính lại giá trị lá (REFIT_DECAY_RATE).
+    time_budget (giây) chia đều cho các mô hình còn lại; hết thời gian thì dừng thêm
+    cây, mô hình chưa kịp cập nhật giữ nguyên. Trả về {tên: Booster}.
+    """
+    if method not in ('continue', 'refit'):
+        raise ValueError(f"Cách cập nhật không hợp lệ: {method}")
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    updated = {}
+    for i, (name, y) in enumerate(targets.items()):
+        start = time.perf_counter()
+        base = models[name].booster_ if hasattr(models[name], 'booster_') else models[name]
+        remaining = None if deadline is None else (deadline - time.monotonic()) / (len(targets) - i)
+        y = np.asarray(y, dtype=np.float64)
+        if remaining is not None and remaining <= 0:
+            booster = base
+        elif method == 'refit':
+            booster = base.refit(X, y, decay_rate=REFIT_DECAY_RATE)
+        else:
+            callbacks = [] if remaining is None else [_time_budget(remaining)]
+            booster = lgb.train(dict(params, num_threads=os.cpu_count() or 1), lgb.Dataset(X, label=y, params=params),
+                                num_boost_round=num_boost_round, init_model=base, callbacks=callbacks)
+        updated[name] = booster
+        if on_done is not None:
+            on_done(name, booster, booster is not base, time.perf_counter() - start)
+    return updated
+
+
+def holdout_rmse(models, X, targets):
+    """RMSE của từng mô hình trên cửa sổ kiểm tra."""
+    return {name: float(np.sqrt(np.mean((np.asarray(y, dtype=np.float64) - models[name].predict(X)) ** 2)))
+            for name, y in targets.items()}
+
+
+def direct_samples(df, features, elements, horizon=DIRECT_HORIZON, origin_stride=DIRECT_ORIGIN_STRIDE,
+                   horizons_per_origin=DIRECT_HORIZONS_PER_ORIGIN, seed=SPLIT_RANDOM_STATE):
+    """Mẫu huấn luyện cho mô hình trực tiếp từ bảng feature của train_weather_model.py.
+
+    df sắp theo (tỉnh, giờ), có cột time, province, `features` và các yếu tố. Dòng gốc r
+    (feature cho giờ t) với tầm h có nhãn là giá trị lúc t + (h - 1) giờ của cùng tỉnh;
+    bỏ mẫu khi giờ đó không có trong dữ liệu. Trả về (X, {yếu tố: mảng nhãn}).
+    """
+    rng = np.random.default_rng(seed)
+    times = df['time'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    provinces = pd.factorize(df['province'])[0]
+    origins = np.arange(0, len(df), origin_stride)
+    horizons = rng.integers(1, horizon + 1, size=(len(origins), horizons_per_origin)).ravel()
+    origins = np.repeat(origins, horizons_per_origin)
+    targets = origins + horizons - 1
+    valid = targets < len(df)
+    origins, horizons, targets = origins[valid], horizons[valid], targets[valid]
+    # Có khoảng trống trong dữ liệu thì dòng thứ r + h - 1 không còn là giờ t + h - 1
+    valid = ((provinces[targets] == provinces[origins])
+             & (times[targets] - times[origins] == (horizons - 1) * 3_600_000_000_000))
+    origins, horizons, targets = origins[valid], horizons[valid], targets[valid]
+
+    matrix = direct_feature_matrix(df[features].to_numpy(dtype=np.float64)[origins],
+                                   df['time'].to_numpy()[origins], horizons)
+    X = pd.DataFrame(matrix, columns=build_direct_feature_columns(elements))
+    return X, {element: df[element].to_numpy(dtype=np.float64)[targets] for element in elements}
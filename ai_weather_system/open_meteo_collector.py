@@ -1,13 +1,33 @@
 # Mục đích: Tải dữ liệu thời tiết lịch sử từ API của Open-Meteo.
 # - Nếu file dữ liệu chưa có, tải toàn bộ lịch sử 3 năm.
 # - Nếu file đã có, tìm ngày gần nhất và chỉ tải dữ liệu mới kể từ đó.
+# - Mặc định lưu vào kho phân vùng theo tỉnh/tháng (history_store.py), chỉ ghi các
+#   tháng có dữ liệu mới; lần đầu tự chuyển file CSV cũ sang kho. --csv giữ file CSV cũ.
+# - Với kho, mỗi tỉnh tải từ mốc (watermark) riêng của nó trong manifest, không đọc
+#   dữ liệu cũ; tỉnh lỗi ở lần trước sẽ được tải bù ở lần sau. Các khoảng giờ bị thiếu
+#   giữa chừng (find_gaps) cũng được lên lịch tải bù. Mỗi lô tải xong được ghi ngay.
+# - Khoảng dài (lần đầu tải 3 năm) được chia thành các cửa sổ thời gian, tải và ghi
+#   lần lượt từng cửa sổ nên bộ nhớ không tăng theo độ dài lịch sử; mốc trong manifest
+#   là điểm dừng (checkpoint), chạy lại sẽ tiếp tục từ cửa sổ còn dở.
+# - Mặc định tải song song nhiều tỉnh, giới hạn tốc độ bằng token bucket và thử lại
+#   từng tỉnh; --sequential giữ cách cũ (lần lượt từng tỉnh, nghỉ 1 giây).
+#   Hai cách cho ra cùng một file CSV.
+# - Khi tải song song, gộp nhiều tỉnh vào một request (API nhận danh sách tọa độ
+#   cách nhau bởi dấu phẩy), giới hạn theo số tỉnh và độ dài URL; lô nào lỗi thì
+#   tải lại từng tỉnh của lô đó như bình thường.
 # ==============================================================================
 
+import argparse
 import requests
 import pandas as pd
 from datetime import datetime, timedelta
 import time
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from history_store import HISTORY_DIR, HistoryStore, migrate_csv
+from upstream_client import TokenBucket, UpstreamClient
 
 try:
     # Đảm bảo rằng file province_data.py nằm cùng thư mục
@@ -25,101 +45,311 @@ HOURLY_PARAMS = [
     "cloud_cover",
     "wind_speed_10m"
 ]
+# Đổi tên cột cho nhất quán
+COLUMN_NAMES = {
+    "time": "time",
+    "temperature_2m": "air_temperature",
+    "relative_humidity_2m": "relative_humidity",
+    "precipitation": "precipitation_amount",
+    "cloud_cover": "cloud_area_fraction",
+    "wind_speed_10m": "wind_speed"
+}
 
 # Tên file output
-OUTPUT_FILENAME = 'vietnam_weather_history.csv' 
-BASE_URL = "https://archive-api.open-meteo.com/v1/archive"
-all_provinces_df_list = []
-existing_df = None
+OUTPUT_FILENAME = 'vietnam_weather_history.csv'
+BASE_URL = os.environ.get('OPEN_METEO_ARCHIVE_URL', "https://archive-api.open-meteo.com/v1/archive")
+
+# --- CẤU HÌNH TẢI SONG SONG ---
+# Số tỉnh tải cùng lúc, số request tối đa mỗi giây (chung cho mọi luồng, kể cả
+# các lần thử lại) và số lần thử lại cả tỉnh khi client đã bỏ cuộc
+MAX_WORKERS = int(os.environ.get('COLLECTOR_MAX_WORKERS', 8))
+RATE_LIMIT_PER_SECOND = float(os.environ.get('COLLECTOR_RATE_LIMIT', 5))
+PROVINCE_RETRIES = int(os.environ.get('COLLECTOR_PROVINCE_RETRIES', 2))
+PROVINCE_RETRY_DELAY_SECONDS = 5.0
+# Độ dài mỗi cửa sổ thời gian khi tải khoảng dài (0 = một request cho cả khoảng)
+BACKFILL_WINDOW_DAYS = int(os.environ.get('COLLECTOR_BACKFILL_WINDOW_DAYS', 90))
+# Số tỉnh tối đa trong một request (1 = không gộp) và độ dài URL tối đa của request gộp
+BATCH_SIZE = int(os.environ.get('COLLECTOR_BATCH_SIZE', 10))
+MAX_URL_LENGTH = int(os.environ.get('COLLECTOR_MAX_URL_LENGTH', 2000))
+
+
+def make_client(max_workers=1, rate_limit=None):
+    # Dữ liệu 3 năm mỗi tỉnh khá lớn nên cho phép đọc lâu hơn; lỗi tạm thời được thử lại
+    return UpstreamClient(
+        pool_size=max(2, max_workers), timeout=(3.05, 60.0), deadline=180.0, retries=4, backoff=2.0,
+        rate_limiter=TokenBucket(rate_limit) if rate_limit else None
+    )
+
+
+def _full_date_range():
+    end_date = datetime.now().strftime('%Y-%m-%d')
+    full_start_date = (datetime.now() - timedelta(days=3*365)).strftime('%Y-%m-%d')
+    return full_start_date, end_date
+
+
+def _next_date_range(last_date, end_date):
+    # Ngày bắt đầu sẽ là ngày tiếp theo của ngày cuối cùng trong dữ liệu cũ
+    start_date = (last_date + timedelta(days=1)).strftime('%Y-%m-%d')
+    print(f"Sẽ cập nhật dữ liệu từ ngày {start_date} đến {end_date}.")
+
+    if pd.to_datetime(start_date) > pd.to_datetime(end_date):
+        print("Dữ liệu đã được cập nhật đến ngày hôm nay. Không cần tải thêm.")
+        return None
+    return start_date
+
+
+def determine_date_range(output_filename):
+    """Trả về (dữ liệu cũ, ngày bắt đầu, ngày kết thúc); ngày bắt đầu là None nếu không cần tải thêm."""
+    full_start_date, end_date = _full_date_range()
+
+    # Kiểm tra xem file dữ liệu đã tồn tại chưa
+    if not os.path.exists(output_filename):
+        # Nếu file không tồn tại, lấy dữ liệu của 3 năm gần nhất
+        print(f"Không tìm thấy file '{output_filename}'. Bắt đầu tải dữ liệu lịch sử 3 năm.")
+        return None, full_start_date, end_date
 
-# Kiểm tra xem file dữ liệu đã tồn tại chưa
-if os.path.exists(OUTPUT_FILENAME):
     # Nếu file tồn tại, đọc nó và tìm ngày cuối cùng
-    print(f"Phát hiện file dữ liệu đã có: '{OUTPUT_FILENAME}'.")
+    print(f"Phát hiện file dữ liệu đã có: '{output_filename}'.")
     try:
-        existing_df = pd.read_csv(OUTPUT_FILENAME)
-        if not existing_df.empty:
-            # Chuyển cột 'time' sang định dạng datetime để xử lý
-            existing_df['time'] = pd.to_datetime(existing_df['time'])
-            
-            # Tìm ngày cuối cùng trong dữ liệu cũ
-            last_date = existing_df['time'].max()
-            
-            # Ngày bắt đầu sẽ là ngày tiếp theo của ngày cuối cùng
-            start_date = (last_date + timedelta(days=1)).strftime('%Y-%m-%d')
-            end_date = datetime.now().strftime('%Y-%m-%d')
-            
-            print(f"Sẽ cập nhật dữ liệu từ ngày {start_date} đến {end_date}.")
-
-            if pd.to_datetime(start_date) > pd.to_datetime(end_date):
-                print("Dữ liệu đã được cập nhật đến ngày hôm nay. Không cần tải thêm.")
-                exit()
-        else: # File tồn tại nhưng rỗng
-            print("File dữ liệu hiện tại rỗng. Bắt đầu tải lại từ đầu.")
-            end_date = datetime.now().strftime('%Y-%m-%d')
-            start_date = (datetime.now() - timedelta(days=3*365)).strftime('%Y-%m-%d')
+        existing_df = pd.read_csv(output_filename)
     except pd.errors.EmptyDataError:
-        print(f"File '{OUTPUT_FILENAME}' bị rỗng. Bắt đầu tải lại từ đầu.")
-        existing_df = None # Đảm bảo existing_df là None
-        end_date = datetime.now().strftime('%Y-%m-%d')
-        start_date = (datetime.now() - timedelta(days=3*365)).strftime('%Y-%m-%d')
-else:
-    # Nếu file không tồn tại, lấy dữ liệu của 3 năm gần nhất
-    print(f"Không tìm thấy file '{OUTPUT_FILENAME}'. Bắt đầu tải dữ liệu lịch sử 3 năm.")
-    end_date = datetime.now().strftime('%Y-%m-%d')
-    start_date = (datetime.now() - timedelta(days=3*365)).strftime('%Y-%m-%d')
+        print(f"File '{output_filename}' bị rỗng. Bắt đầu tải lại từ đầu.")
+        return None, full_start_date, end_date
+
+    if existing_df.empty: # File tồn tại nhưng rỗng
+        print("File dữ liệu hiện tại rỗng. Bắt đầu tải lại từ đầu.")
+        return existing_df, full_start_date, end_date
 
-# Vòng lặp để lấy dữ liệu cho từng tỉnh
-print(f"--- Bắt đầu thu thập dữ liệu từ Open-Meteo ({start_date} đến {end_date}) ---")
+    # Chuyển cột 'time' sang định dạng datetime để xử lý
+    existing_df['time'] = pd.to_datetime(existing_df['time'])
+    return existing_df, _next_date_range(existing_df['time'].max(), end_date), end_date
+
+
+def migrate_legacy_csv(store, legacy_csv=OUTPUT_FILENAME):
+    """Nếu kho còn trống mà có file CSV cũ thì chuyển file đó sang kho (một lần)."""
+    if store.exists() or not os.path.exists(legacy_csv):
+        return
+    print(f"Chuyển file '{legacy_csv}' sang kho '{store.directory}' (một lần)...")
+    try:
+        print(f"Đã chuyển {migrate_csv(legacy_csv, store)} dòng.")
+    except pd.errors.EmptyDataError:
+        print(f"File '{legacy_csv}' bị rỗng, bỏ qua.")
 
-for province_name, info in PROVINCE_DATA.items():
-    print(f"Đang lấy dữ liệu cho: {province_name}...")
-    
-    params = {
-        "latitude": info["lat"],
-        "longitude": info["lon"],
+
+def split_date_range(start_date, end_date, origin_date, window_days=BACKFILL_WINDOW_DAYS):
+    """Chia [start_date, end_date] theo lưới cửa sổ `window_days` ngày tính từ origin_date.
+
+    Các tỉnh có mốc khác nhau vẫn dùng chung cửa sổ (để gộp lô) từ cửa sổ thứ hai trở đi.
+    """
+    if not window_days:
+        return [(start_date, end_date)]
+    origin, current, end = (datetime.strptime(d, '%Y-%m-%d') for d in (origin_date, start_date, end_date))
+    windows = []
+    while current <= end:
+        index = (current - origin).days // window_days
+        window_end = min(end, origin + timedelta(days=(index + 1) * window_days - 1))
+        windows.append((current.strftime('%Y-%m-%d'), window_end.strftime('%Y-%m-%d')))
+        current = window_end + timedelta(days=1)
+    return windows
+
+
+def plan_collection(store, provinces, full_start_date, end_date, check_gaps=True,
+                    window_days=BACKFILL_WINDOW_DAYS):
+    """Lên lịch tải tối thiểu từ manifest của kho, không đọc dữ liệu lịch sử.
+
+    Trả về [(ngày bắt đầu, ngày kết thúc, {tỉnh: info})] theo thứ tự thời gian, các
+    tỉnh cùng khoảng ngày được gom chung để gộp lô. Mỗi tỉnh tải tiếp từ mốc của nó
+    (tỉnh chưa có dữ liệu thì tải từ full_start_date), chia thành các cửa sổ
+    `window_days` ngày; check_gaps thêm các khoảng giờ bị thiếu (chia cùng cách).
+    """
+    watermarks = store.watermarks()
+    ranges = {}
+    for province_name, info in provinces.items():
+        watermark = watermarks.get(province_name)
+        if watermark is None:
+            start_date = full_start_date
+        else:
+            # API lưu trữ trả theo ngày: tải lại ngày của mốc nếu ngày đó chưa đủ 24 giờ
+            start_date = (watermark + timedelta(hours=1)).strftime('%Y-%m-%d')
+        # Ngày dạng YYYY-MM-DD so sánh được như chuỗi
+        if start_date <= end_date:
+            for key in split_date_range(start_date, end_date, full_start_date, window_days):
+                ranges.setdefault(key, {})[province_name] = info
+        if check_gaps and watermark is not None:
+            # Khoảng thiếu dài cũng chia theo cùng lưới cửa sổ, không tải cả khoảng một lần
+            for gap_start, gap_end in store.find_gaps(province_name):
+                for key in split_date_range(gap_start.strftime('%Y-%m-%d'), gap_end.strftime('%Y-%m-%d'),
+                                            full_start_date, window_days):
+                    ranges.setdefault(key, {})[province_name] = info
+    return [(start_date, end, group) for (start_date, end), group in sorted(ranges.items())]
+
+
+def _request_params(infos, start_date, end_date):
+    return {
+        "latitude": ",".join(str(info["lat"]) for info in infos),
+        "longitude": ",".join(str(info["lon"]) for info in infos),
         "start_date": start_date,
         "end_date": end_date,
         "hourly": HOURLY_PARAMS
     }
-    
-    try:
-        response = requests.get(BASE_URL, params=params)
-        response.raise_for_status() # Báo lỗi nếu request không thành công
-        
-        data = response.json()
-        
-        # Kiểm tra xem API có trả về dữ liệu không
-        if 'hourly' not in data or not data['hourly']['time']:
-            print(f"Không có dữ liệu mới cho {province_name} trong khoảng thời gian này.")
-            continue
-            
-        df = pd.DataFrame(data['hourly'])
-        # Đổi tên cột cho nhất quán
-        df = df.rename(columns={
-            "time": "time",
-            "temperature_2m": "air_temperature",
-            "relative_humidity_2m": "relative_humidity",
-            "precipitation": "precipitation_amount",
-            "cloud_cover": "cloud_area_fraction",
-            "wind_speed_10m": "wind_speed"
-        })
-        
-        df['province'] = province_name
-        all_provinces_df_list.append(df)
-        
-        print(f"Lấy dữ liệu thành công cho {province_name}.")
-        
-    except requests.exceptions.RequestException as e:
-        print(f"Lỗi khi lấy dữ liệu cho {province_name}: {e}")
-    
-    # Tạm dừng 1 giây để tránh làm quá tải API
-    time.sleep(1)
-
-# Xử lý và lưu file
-if all_provinces_df_list:
+
+
+def _to_frame(province_name, data):
+    # Kiểm tra xem API có trả về dữ liệu không
+    if 'hourly' not in data or not data['hourly']['time']:
+        return None
+
+    df = pd.DataFrame(data['hourly']).rename(columns=COLUMN_NAMES)
+    df['province'] = province_name
+    return df
+
+
+def fetch_province(client, province_name, info, start_date, end_date, base_url=BASE_URL):
+    """Tải dữ liệu giờ của một tỉnh; trả về DataFrame hoặc None nếu API không có dữ liệu mới."""
+    # Báo lỗi nếu request không thành công sau khi đã thử lại
+    data = client.get_json(base_url, params=_request_params([info], start_date, end_date))
+    return _to_frame(province_name, data)
+
+
+def make_batches(provinces, start_date, end_date, base_url=BASE_URL,
+                 batch_size=BATCH_SIZE, max_url_length=MAX_URL_LENGTH):
+    """Chia các tỉnh (giữ thứ tự) thành các lô, mỗi lô là một request có URL không quá `max_url_length`."""
+    batches, current = [], []
+    for province_name, info in provinces.items():
+        candidate = current + [(province_name, info)]
+        url = requests.Request(
+            'GET', base_url, params=_request_params([i for _, i in candidate], start_date, end_date)
+        ).prepare().url
+        if current and (len(candidate) > batch_size or len(url) > max_url_length):
+            batches.append(current)
+            candidate = [(province_name, info)]
+        current = candidate
+    if current:
+        batches.append(current)
+    return batches
+
+
+def fetch_batch(client, batch, start_date, end_date, base_url=BASE_URL):
+    """Tải một lô tỉnh bằng một request; trả về danh sách DataFrame (hoặc None) theo thứ tự của lô.
+
+    Báo ValueError nếu phản hồi không có đúng một kết quả cho mỗi tọa độ.
+    """
+    data = client.get_json(base_url, params=_request_params([info for _, info in batch], start_date, end_date))
+    # Một tọa độ: API trả về một object; nhiều tọa độ: một danh sách cùng thứ tự
+    results = [data] if isinstance(data, dict) else data
+    if not isinstance(results, list) or len(results) != len(batch):
+        raise ValueError(f"Phản hồi có {len(results) if isinstance(results, list) else '?'} kết quả "
+                         f"cho {len(batch)} tọa độ")
+    return [_to_frame(province_name, result) for (province_name, _), result in zip(batch, results)]
+
+
+def collect_sequential(client, provinces, start_date, end_date, base_url=BASE_URL, delay_seconds=1.0,
+                       on_failure=None):
+    """Cách cũ: lần lượt từng tỉnh, nghỉ giữa các lần gọi."""
+    frames = []
+    for province_name, info in provinces.items():
+        print(f"Đang lấy dữ liệu cho: {province_name}...")
+        try:
+            df = fetch_province(client, province_name, info, start_date, end_date, base_url)
+            if df is None:
+                print(f"Không có dữ liệu mới cho {province_name} trong khoảng thời gian này.")
+            else:
+                frames.append(df)
+                print(f"Lấy dữ liệu thành công cho {province_name}.")
+        except requests.exceptions.RequestException as e:
+            print(f"Lỗi khi lấy dữ liệu cho {province_name}: {e}")
+            if on_failure is not None:
+                on_failure(province_name, e)
+
+        # Tạm dừng để tránh làm quá tải API
+        time.sleep(delay_seconds)
+    return frames
+
+
+def collect_concurrent(client, provinces, start_date, end_date, base_url=BASE_URL,
+                       max_workers=MAX_WORKERS, province_retries=PROVINCE_RETRIES,
+                       retry_delay_seconds=PROVINCE_RETRY_DELAY_SECONDS,
+                       batch_size=BATCH_SIZE, max_url_length=MAX_URL_LENGTH, on_frames=None, on_failure=None):
+    """Tải nhiều tỉnh cùng lúc; tốc độ do rate_limiter của client quyết định.
+
+    Các tỉnh được gộp thành lô (xem make_batches); lô lỗi thì tải lại từng tỉnh.
+    Kết quả giữ đúng thứ tự của `provinces` như cách tuần tự.
+    """
+    return collect_plan(client, [(start_date, end_date, provinces)], base_url, max_workers, province_retries,
+                        retry_delay_seconds, batch_size, max_url_length, on_frames, on_failure)
+
+
+def collect_plan(client, plan, base_url=BASE_URL, max_workers=MAX_WORKERS, province_retries=PROVINCE_RETRIES,
+                 retry_delay_seconds=PROVINCE_RETRY_DELAY_SECONDS, batch_size=BATCH_SIZE,
+                 max_url_length=MAX_URL_LENGTH, on_frames=None, on_failure=None):
+    """Như collect_concurrent cho nhiều khoảng ngày (kết quả của plan_collection) trong cùng một pool.
+
+    on_frames(frames) được gọi (ở luồng gọi hàm, theo thứ tự) mỗi khi một lô xong,
+    để ghi ngay thay vì chờ tải hết; khi đó dữ liệu không được giữ lại và kết quả
+    trả về rỗng. on_failure(tên tỉnh, lỗi) được gọi cho tỉnh tải lỗi.
+    """
+    def fetch_one(province_name, info, start_date, end_date):
+        for attempt in range(province_retries + 1):
+            try:
+                return fetch_province(client, province_name, info, start_date, end_date, base_url)
+            except requests.exceptions.RequestException as e:
+                if attempt == province_retries:
+                    raise
+                print(f"Lỗi khi lấy dữ liệu cho {province_name} (thử lại lần {attempt + 1}): {e}")
+                time.sleep(retry_delay_seconds * (attempt + 1))
+
+    def fetch(batch, start_date, end_date):
+        # Trả về [(tên tỉnh, DataFrame/None hoặc lỗi)] theo thứ tự của lô
+        if len(batch) > 1:
+            try:
+                frames = fetch_batch(client, batch, start_date, end_date, base_url)
+                return [(name, df) for (name, _), df in zip(batch, frames)]
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Lỗi khi lấy lô {len(batch)} tỉnh ({batch[0][0]}...), tải lại từng tỉnh: {e}")
+        results = []
+        for province_name, info in batch:
+            try:
+                results.append((province_name, fetch_one(province_name, info, start_date, end_date)))
+            except requests.exceptions.RequestException as e:
+                results.append((province_name, e))
+        return results
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = deque(
+            executor.submit(fetch, batch, start_date, end_date)
+            for start_date, end_date, provinces in plan
+            for batch in make_batches(provinces, start_date, end_date, base_url, max(1, batch_size), max_url_length)
+        )
+        frames = []
+        while futures:
+            # Bỏ tham chiếu tới lô đã xử lý để bộ nhớ được giải phóng ngay
+            future = futures.popleft()
+            batch_frames = []
+            for province_name, df in future.result():
+                if isinstance(df, Exception):
+                    print(f"Lỗi khi lấy dữ liệu cho {province_name}: {df}")
+                    if on_failure is not None:
+                        on_failure(province_name, df)
+                elif df is None:
+                    print(f"Không có dữ liệu mới cho {province_name} trong khoảng thời gian này.")
+                else:
+                    batch_frames.append(df)
+                    print(f"Lấy dữ liệu thành công cho {province_name}.")
+            if on_frames is None:
+                frames.extend(batch_frames)
+            elif batch_frames:
+                on_frames(batch_frames)
+    return frames
+
+
+def merge_and_save(existing_df, frames, output_filename):
+    """Ghép dữ liệu mới với dữ liệu cũ và ghi lại file CSV. Trả về False nếu không có gì mới."""
+    if not frames:
+        print("\nKhông có dữ liệu mới nào được thu thập.")
+        return False
+
     # Ghép tất cả dữ liệu mới thu thập được
-    new_df = pd.concat(all_provinces_df_list, ignore_index=True)
+    new_df = pd.concat(frames, ignore_index=True)
     new_df['time'] = pd.to_datetime(new_df['time'])
 
     # Nếu có dữ liệu cũ và nó không rỗng, hãy ghép chúng lại với nhau
@@ -132,9 +362,113 @@ if all_provinces_df_list:
     # Sắp xếp lại và loại bỏ các dòng trùng lặp (nếu có)
     # đảm bảo tính duy nhất cho mỗi điểm dữ liệu theo tỉnh và thời gian
     final_df = final_df.sort_values(by=['province', 'time']).drop_duplicates(subset=['province', 'time'], keep='last')
-    
+
     # Ghi lại toàn bộ dữ liệu đã được cập nhật ra file CSV
-    final_df.to_csv(OUTPUT_FILENAME, index=False, date_format='%Y-%m-%dT%H:%M')
-    print(f"\n--- HOÀN TẤT ---. Dữ liệu đã được cập nhật và lưu tại file: {OUTPUT_FILENAME}")
-else:
-    print("\nKhông có dữ liệu mới nào được thu thập.")
\ No newline at end of file
+    final_df.to_csv(output_filename, index=False, date_format='%Y-%m-%dT%H:%M')
+    print(f"\n--- HOÀN TẤT ---. Dữ liệu đã được cập nhật và lưu tại file: {output_filename}")
+    return True
+
+
+def save_to_store(store, frames):
+    """Ghi dữ liệu mới vào kho phân vùng (và nâng mốc của các tỉnh). Trả về số phân vùng đã ghi."""
+    if not frames:
+        return 0
+    return store.append(pd.concat(frames, ignore_index=True))
+
+
+def run_plan(client, store, plan, base_url=BASE_URL, max_workers=MAX_WORKERS, batch_size=BATCH_SIZE,
+             sequential=False, **collect_options):
+    """Tải và ghi vào kho lần lượt từng khoảng của plan_collection; trả về (số phân vùng đã ghi, tỉnh lỗi).
+
+    Mỗi khoảng được ghi ngay khi tải xong nên dừng giữa chừng chỉ mất khoảng đang tải.
+    Tỉnh lỗi ở một khoảng bị bỏ qua ở các khoảng sau, để mốc của tỉnh đó không nhảy
+    qua chỗ thiếu; lần chạy sau sẽ tiếp tục từ mốc ấy.
+    """
+    written, failed = [0], set()
+
+    def save(frames):
+        written[0] += save_to_store(store, frames)
+
+    for number, (start_date, end_date, provinces) in enumerate(plan, 1):
+        provinces = {name: info for name, info in provinces.items() if name not in failed}
+        if not provinces:
+            continue
+        print(f"[{number}/{len(plan)}] {start_date} đến {end_date}: {len(provinces)} tỉnh")
+        if sequential:
+            save(collect_sequential(client, provinces, start_date, end_date, base_url,
+                                    on_failure=lambda name, error: failed.add(name)))
+        else:
+            collect_plan(client, [(start_date, end_date, provinces)], base_url, max_workers,
+                         batch_size=batch_size, on_frames=save,
+                         on_failure=lambda name, error: failed.add(name), **collect_options)
+    return written[0], failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sequential', action='store_true', help='Tải lần lượt từng tỉnh như trước')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--rate', type=float, default=RATE_LIMIT_PER_SECOND, help='Số request tối đa mỗi giây')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Số tỉnh mỗi request (1 = không gộp)')
+    parser.add_argument('--csv', action='store_true', help='Ghi file CSV cũ thay vì kho phân vùng')
+    parser.add_argument('--output', help=f'Mặc định: {HISTORY_DIR} (kho) hoặc {OUTPUT_FILENAME} (--csv)')
+    parser.add_argument('--base-url', default=BASE_URL)
+    parser.add_argument('--skip-gaps', action='store_true', help='Không tìm và tải bù các khoảng giờ bị thiếu')
+    parser.add_argument('--window-days', type=int, default=BACKFILL_WINDOW_DAYS,
+                        help='Số ngày mỗi cửa sổ khi tải khoảng dài (0 = không chia)')
+    args = parser.parse_args(argv)
+
+    if args.csv:
+        run_csv(args)
+        return
+
+    store = HistoryStore(args.output or HISTORY_DIR)
+    migrate_legacy_csv(store)
+    full_start_date, end_date = _full_date_range()
+    plan = plan_collection(store, PROVINCE_DATA, full_start_date, end_date, check_gaps=not args.skip_gaps,
+                           window_days=args.window_days)
+    if not plan:
+        print("Dữ liệu đã được cập nhật đến ngày hôm nay. Không cần tải thêm.")
+        return
+    print(f"--- Bắt đầu thu thập dữ liệu từ Open-Meteo vào kho '{store.directory}' "
+          f"({len(plan)} khoảng, {plan[0][0]} đến {plan[-1][1]}) ---")
+
+    started = time.perf_counter()
+    client = make_client() if args.sequential else make_client(args.workers, args.rate)
+    written, failed = run_plan(client, store, plan, args.base_url, args.workers, args.batch_size, args.sequential)
+    print(f"Thu thập xong sau {time.perf_counter() - started:.1f} giây.")
+    print(f"Thống kê gọi API: {client.stats()}")
+    if failed:
+        print(f"Các tỉnh chưa tải xong (sẽ tiếp tục ở lần chạy sau): {', '.join(sorted(failed))}")
+    if not written:
+        print("\nKhông có dữ liệu mới nào được thu thập.")
+    else:
+        print(f"\n--- HOÀN TẤT ---. Đã ghi {written} phân vùng (tỉnh, tháng) vào kho: {store.directory}")
+
+
+def run_csv(args):
+    """Cách cũ: một khoảng ngày chung cho mọi tỉnh, ghi lại toàn bộ file CSV."""
+    output = args.output or OUTPUT_FILENAME
+    existing_df, start_date, end_date = determine_date_range(output)
+    if start_date is None:
+        return
+
+    # Vòng lặp để lấy dữ liệu cho từng tỉnh
+    print(f"--- Bắt đầu thu thập dữ liệu từ Open-Meteo ({start_date} đến {end_date}) ---")
+    started = time.perf_counter()
+    if args.sequential:
+        client = make_client()
+        frames = collect_sequential(client, PROVINCE_DATA, start_date, end_date, args.base_url)
+    else:
+        client = make_client(args.workers, args.rate)
+        frames = collect_concurrent(client, PROVINCE_DATA, start_date, end_date, args.base_url, args.workers,
+                                    batch_size=args.batch_size)
+    print(f"Thu thập xong sau {time.perf_counter() - started:.1f} giây.")
+    print(f"Thống kê gọi API: {client.stats()}")
+
+    # Xử lý và lưu file
+    merge_and_save(existing_df, frames, output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# Mục đích: Máy chủ HTTP giả lập Open-Meteo chạy trên localhost để kiểm tra
+# client upstream và bộ thu thập dữ liệu mà không cần mạng.
+# - Phát lại các phản hồi đã ghi (file JSON trong một thư mục) nếu có,
+#   nếu không thì sinh phản hồi đúng cấu trúc của Open-Meteo từ tham số request.
+# - Có thể giả lập độ trễ, lỗi 5xx/429 theo kịch bản và giới hạn tốc độ.
+# ==============================================================================
+import json
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+HOURLY_UNITS = {
+    "time": "iso8601", "temperature_2m": "°C", "relative_humidity_2m": "%",
+    "precipitation": "mm", "cloud_cover": "%", "wind_speed_10m": "km/h"
+}
+
+
+def synthesize_hourly(lat, lon, times, variables):
+    # Chuỗi thời tiết xác định theo tọa độ và giờ tuyệt đối (đủ để kiểm tra định dạng):
+    # cùng một giờ luôn cho cùng giá trị, dù request hỏi khoảng ngày nào
+    seed = (lat * 7.0 + lon * 3.0) % 10
+    stamps = np.array(times, dtype='datetime64[h]')
+    i = (stamps - np.datetime64('2000-01-01T00', 'h')).astype(np.int64)
+    hour = (i % 24).astype(float)
+    phase = np.sin(2 * np.pi * (hour - 9) / 24)
+    hourly = {"time": times}
+    for variable in variables:
+        if variable == 'temperature_2m':
+            values = np.round(24 + seed / 2 + 5 * phase, 1)
+        elif variable == 'relative_humidity_2m':
+            values = (80 - 15 * phase).astype(int)
+        elif variable == 'precipitation':
+            values = np.where(i % 4 == 0, np.round(np.maximum(0.0, np.sin(i / 5 + seed)) * 1.2, 1), 0.0)
+        elif variable == 'cloud_cover':
+            values = (50 + 45 * np.sin(i / 7 + seed)).astype(int)
+        elif variable == 'wind_speed_10m':
+            values = np.round(8 + 4 * np.cos(i / 9 + seed), 1)
+        else:
+            values = np.full(len(times), None)
+        hourly[variable] = values.tolist()
+    return hourly
+
+
+def _hour_range(start, end):
+    times, current = [], start
+    while current < end:
+        times.append(current.strftime('%Y-%m-%dT%H:%M'))
+        current += timedelta(hours=1)
+    return times
+
+
+def synthesize_response(path, params):
+    """Phản hồi giống Open-Meteo cho /v1/forecast hoặc /v1/archive (một hay nhiều tọa độ)."""
+    lats = [float(v) for v in params['latitude'][0].split(',')]
+    lons = [float(v) for v in params['longitude'][0].split(',')]
+    variables = []
+    for value in params.get('hourly', []):
+        variables.extend(v for v in value.split(',') if v)
+    if path.endswith('/archive'):
+        start = datetime.strptime(params['start_date'][0], '%Y-%m-%d')
+        end = datetime.strptime(params['end_date'][0], '%Y-%m-%d') + timedelta(days=1)
+    else:
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        start = today - timedelta(days=int(params.get('past_days', ['0'])[0]))
+        end = today + timedelta(days=int(params.get('forecast_days', ['7'])[0]))
+    times = _hour_range(start, end)
+    results = []
+    for lat, lon in zip(lats, lons):
+        results.append({
+            "latitude": lat, "longitude": lon, "generationtime_ms": 0.1,
+            "utc_offset_seconds": 0, "timezone": "GMT", "timezone_abbreviation": "GMT",
+            "elevation": 10.0,
+            "hourly_units": {v: HOURLY_UNITS.get(v, '') for v in ['time'] + variables},
+            "hourly": synthesize_hourly(lat, lon, times, variables)
+        })
+    return results[0] if len(results) == 1 else results
+
+
+class OpenMeteoStandIn:
+    """Máy chủ giả lập. Dùng như context manager; self.url là địa chỉ gốc.
+
+    script: danh sách hành động cho các request đầu tiên theo thứ tự, mỗi hành
+        động là 'ok', một mã lỗi HTTP (ví dụ 503, 429) hoặc ('delay', giây).
+    latency: độ trễ (giây) thêm vào mọi request.
+    rate_limit: số request tối đa mỗi giây, vượt quá trả 429 kèm Retry-After.
+    recordings_dir: thư mục chứa file <tên endpoint>*.json để phát lại lần lượt.
+    max_locations: số tọa độ tối đa trong một request, vượt quá trả 400.
+    """
+
+    def __init__(self, script=None, latency=0.0, rate_limit=None, recordings_dir=None, max_locations=None):
+        self.script = list(script or [])
+        self.max_locations = max_locations
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.requests = []
+        self.connections = set()  # các kết nối TCP (địa chỉ client) đã dùng
+        self.recordings = {}
+        if recordings_dir:
+            for name in sorted(os.listdir(recordings_dir)):
+                if name.endswith('.json'):
+                    endpoint = name.split('_')[0].split('.')[0]
+                    with open(os.path.join(recordings_dir, name), encoding='utf-8') as f:
+                        self.recordings.setdefault(endpoint, []).append(json.load(f))
+        self._lock = threading.Lock()
+        self._window = []
+        self._replayed = Counter()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_action(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.rate_limit is not None:
+                self._window = [t for t in self._window if now - t < 1.0]
+                if len(self._window) >= self.rate_limit:
+                    return 429
+                self._window.append(now)
+            return self.script.pop(0) if self.script else 'ok'
+
+    def _respond(self, path, params):
+        endpoint = path.rstrip('/').rsplit('/', 1)[-1]
+        recorded = self.recordings.get(endpoint)
+        if recorded:
+            with self._lock:
+                index = self._replayed[endpoint] % len(recorded)
+                self._replayed[endpoint] += 1
+            return recorded[index]
+        return synthesize_response(path, params)
+
+    def _make_handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 để client giữ kết nối (keep-alive) giữa các request
+            protocol_version = 'HTTP/1.1'
+            # Gửi header và body ngay, tránh trễ ~40 ms do Nagle + delayed ACK khi keep-alive
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                params = parse_qs(parsed.query)
+                action = standin._next_action()
+                locations = len(params.get('latitude', [''])[0].split(','))
+                if action == 'ok' and standin.max_locations is not None and locations > standin.max_locations:
+                    action = 400
+                with standin._lock:
+                    standin.requests.append((parsed.path, params, action))
+                    standin.connections.add(self.client_address)
+                time.sleep(standin.latency)
+                if isinstance(action, tuple) and action[0] == 'delay':
+                    time.sleep(action[1])
+                    action = 'ok'
+                status = 200
+                if action == 'ok':
+                    body = json.dumps(standin._respond(parsed.path, params)).encode()
+                else:
+                    status = action
+                    body = json.dumps({"error": True, "reason": f"stand-in {action}"}).encode()
+                self.send_response(status)
+                if status == 429:
+                    self.send_header('Retry-After', '1')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # client đã bỏ đi (ví dụ hết hạn chót)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,197 @@
+# Mục đích: Bộ máy dự báo đệ quy (rollout) dùng bộ đệm vòng NumPy cố định.
+# - Thay cho việc tính lại rolling của pandas trên toàn bộ lịch sử ở mỗi bước
+#   và nối thêm dòng bằng pd.concat (chi phí tăng theo bình phương).
+# - Các feature lag, rolling mean 6/24 và rolling std 6 được cập nhật tăng dần.
+#   Thuật toán cộng/trừ (Kahan, Welford) chép đúng theo
+#   pandas/_libs/window/aggregations.pyx nên kết quả trùng khớp từng bit với
+#   Series.rolling(window, min_periods=1).mean()/std() của pandas hiện tại.
+# - Trạng thái có thêm chiều "tỉnh" ở đầu để có thể chạy nhiều tỉnh cùng lúc.
+# - Định nghĩa feature (số lag, cửa sổ, feature thời gian) lấy từ feature_engineering.py.
+# ==============================================================================
+import numpy as np
+
+from feature_engineering import LAGS, MEAN_WINDOWS, STD_WINDOW, time_features
+
+BUFFER_SIZE = max(MEAN_WINDOWS + (STD_WINDOW, LAGS))
+
+# Ngưỡng phát hiện mất chính xác khi trừ (giống InvCondTol của pandas)
+_INV_COND_TOL = np.finfo(np.float64).eps * 1e3
+
+
+class _RollingMean:
+    # Trạng thái roll_mean của pandas cho cửa sổ cố định (Kahan summation).
+    def __init__(self, window, shape):
+        self.window = window
+        self.nobs = np.zeros(shape, dtype=np.int64)
+        self.neg_ct = np.zeros(shape, dtype=np.int64)
+        self.sum_x = np.zeros(shape)
+        self.comp_add = np.zeros(shape)
+        self.comp_remove = np.zeros(shape)
+        self.num_same = np.zeros(shape, dtype=np.int64)
+        self.prev_value = np.full(shape, np.nan)
+
+    def add(self, val):
+        valid = val == val
+        self.nobs += valid
+        y = val - self.comp_add
+        t = self.sum_x + y
+        self.comp_add = np.where(valid, t - self.sum_x - y, self.comp_add)
+        self.sum_x = np.where(valid, t, self.sum_x)
+        self.neg_ct += valid & np.signbit(val)
+        same = valid & (val == self.prev_value)
+        self.num_same = np.where(same, self.num_same + 1, np.where(valid, 1, self.num_same))
+        self.prev_value = np.where(valid, val, self.prev_value)
+
+    def remove(self, val):
+        valid = val == val
+        self.nobs -= valid
+        y = -val - self.comp_remove
+        t = self.sum_x + y
+        self.comp_remove = np.where(valid, t - self.sum_x - y, self.comp_remove)
+        self.sum_x = np.where(valid, t, self.sum_x)
+        self.neg_ct -= valid & np.signbit(val)
+
+    def value(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = self.sum_x / self.nobs
+        result = np.where((self.neg_ct == 0) & (result < 0), 0.0, result)
+        result = np.where((self.neg_ct == self.nobs) & (result > 0), 0.0, result)
+        result = np.where(self.num_same >= self.nobs, self.prev_value, result)
+        return np.where(self.nobs > 0, result, np.nan)
+
+
+class _RollingStd:
+    # Trạng thái roll_var của pandas (Welford + Kahan), ddof=1, min_periods=1.
+    def __init__(self, window, shape):
+        self.window = window
+        self.nobs = np.zeros(shape)
+        self.mean_x = np.zeros(shape)
+        self.ssqdm_x = np.zeros(shape)
+        self.comp_add = np.zeros(shape)
+        self.comp_remove = np.zeros(shape)
+        self.unstable = np.zeros(shape, dtype=bool)
+
+    def _add(self, val, mask):
+        valid = mask & (val == val)
+        prev_m2 = self.ssqdm_x
+        nobs = np.where(valid, self.nobs + 1, self.nobs)
+        prev_mean = self.mean_x - self.comp_add
+        y = val - self.comp_add
+        t = y - self.mean_x
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_x = self.mean_x + t / nobs
+        ssqdm_x = prev_m2 + (val - prev_mean) * (val - mean_x)
+        self.comp_add = np.where(valid, t + self.mean_x - y, self.comp_add)
+        self.nobs = nobs
+        self.mean_x = np.where(valid, mean_x, self.mean_x)
+        self.ssqdm_x = np.where(valid, ssqdm_x, self.ssqdm_x)
+        self.unstable |= valid & (prev_m2 * _INV_COND_TOL > self.ssqdm_x)
+
+    def add(self, val):
+        self._add(val, np.ones(val.shape, dtype=bool))
+
+    def remove(self, val):
+        valid = val == val
+        prev_m2 = self.ssqdm_x
+        nobs = np.where(valid, self.nobs - 1, self.nobs)
+        keep = valid & (nobs != 0)
+        emptied = valid & (nobs == 0)
+        prev_mean = self.mean_x - self.comp_remove
+        y = val - self.comp_remove
+        t = y - self.mean_x
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_x = self.mean_x - t / nobs
+        ssqdm_x = prev_m2 - (val - prev_mean) * (val - mean_x)
+        self.comp_remove = np.where(keep, t + self.mean_x - y, self.comp_remove)
+        self.nobs = nobs
+        self.mean_x = np.where(keep, mean_x, np.where(emptied, 0.0, self.mean_x))
+        self.ssqdm_x = np.where(keep, ssqdm_x, np.where(emptied, 0.0, self.ssqdm_x))
+        self.unstable = np.where(emptied, False, self.unstable | (keep & (prev_m2 * _INV_COND_TOL > self.ssqdm_x)))
+
+    def recompute(self, window_values):
+        # Khi phát hiện mất chính xác, pandas tính lại từ đầu trên cửa sổ hiện tại.
+        lanes = self.unstable.copy()
+        for name in ('nobs', 'mean_x', 'ssqdm_x', 'comp_add', 'comp_remove'):
+            setattr(self, name, np.where(lanes, 0.0, getattr(self, name)))
+        for val in window_values:
+            self._add(val, lanes)
+        self.unstable[:] = False
+
+    def value(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = np.where(self.nobs > 1, self.ssqdm_x / (self.nobs - 1), np.nan)
+            std = np.sqrt(var)
+        return np.where(var < 0, 0.0, std)
+
+
+class RolloutEngine:
+    """Giữ trạng thái lịch sử của một hoặc nhiều tỉnh để dự báo đệ quy."""
+
+    def __init__(self, histories, province_codes):
+        # histories: mảng (số tỉnh, số giờ, số yếu tố), căn lề phải;
+        # tỉnh có lịch sử ngắn hơn được đệm NaN ở đầu (NaN không làm đổi
+        # trạng thái rolling nên kết quả vẫn như khi tính trên chuỗi gốc).
+        histories = np.asarray(histories, dtype=np.float64)
+        n_provinces, n_rows, n_elements = histories.shape
+        if n_rows < LAGS:
+            raise ValueError(f"Cần ít nhất {LAGS} giờ lịch sử để tạo feature.")
+        shape = (n_provinces, n_elements)
+        self.province_codes = np.asarray(province_codes, dtype=np.float64)
+        self.buffer = np.full((n_provinces, n_elements, BUFFER_SIZE), np.nan)
+        self.count = 0
+        self.means = [_RollingMean(w, shape) for w in MEAN_WINDOWS]
+        self.std = _RollingStd(STD_WINDOW, shape)
+        for row in range(n_rows):
+            self.push(histories[:, row, :])
+
+    @classmethod
+    def from_frames(cls, history_dfs, province_codes, elements):
+        n_rows = max(len(df) for df in history_dfs)
+        histories = np.full((len(history_dfs), n_rows, len(elements)), np.nan)
+        for i, df in enumerate(history_dfs):
+            if len(df):
+                histories[i, n_rows - len(df):, :] = df[elements].to_numpy(dtype=np.float64)
+        return cls(histories, province_codes)
+
+    def _recent(self, back):
+        # Giá trị thô cách hiện tại `back` bước (1 = giá trị mới nhất)
+        return self.buffer[:, :, (self.count - back) % BUFFER_SIZE]
+
+    def push(self, values):
+        """Thêm một giờ mới (mảng (số tỉnh, số yếu tố)) vào trạng thái."""
+        raw = np.asarray(values, dtype=np.float64)
+        val = np.where(np.isinf(raw), np.nan, raw)
+        for rolling in self.means + [self.std]:
+            if self.count >= rolling.window:
+                old = self._recent(rolling.window)
+                rolling.remove(np.where(np.isinf(old), np.nan, old))
+        self.buffer[:, :, self.count % BUFFER_SIZE] = raw
+        self.count += 1
+        for rolling in self.means + [self.std]:
+            rolling.add(val)
+        if self.std.unstable.any():
+            start = max(self.count - STD_WINDOW, 0)
+            window = [self.buffer[:, :, j % BUFFER_SIZE] for j in range(start, self.count)]
+            self.std.recompute([np.where(np.isinf(w), np.nan, w) for w in window])
+
+    def element_features(self):
+        # Mảng (số tỉnh, số yếu tố, 6): lag 1..3, mean 6, mean 24, std 6
+        parts = [self._recent(i) for i in range(1, LAGS + 1)]
+        parts += [rolling.value() for rolling in self.means]
+        parts.append(self.std.value())
+        return np.stack(parts, axis=-1)
+
+    def features(self, prediction_times):
+        """Ma trận feature (số tỉnh, số cột) cho bước dự báo kế tiếp."""
+        n_provinces = len(self.province_codes)
+        if not isinstance(prediction_times, (list, tuple)):
+            prediction_times = [prediction_times] * n_provinces
+        cache = {}
+        time_block = np.array([
+            cache.setdefault(t, time_features(t)) for t in prediction_times
+        ])
+        element_block = self.element_features().reshape(n_provinces, -1)
+        matrix = np.concatenate(
+            [time_block, element_block, self.province_codes[:, None]], axis=1
+        )
+        return np.where(np.isnan(matrix), 0.0, matrix)
@@ -2,16 +2,18 @@
 # và cung cấp API dự báo thời tiết.
 # ==============================================================================
 # Sử dụng các feature tuần hoàn và trung bình trượt khi dự báo.
+# FORECAST_MODE=direct: dùng mô hình trực tiếp, 72 giờ trong một lần suy luận thay cho
+# 72 bước đệ quy (cùng định dạng /api/predict).
 # ==============================================================================
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-import joblib
-import requests
-import pandas as pd
 from datetime import datetime, timedelta, timezone
 import numpy as np
-import pytz 
 import time 
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from province_data import PROVINCE_DATA
@@ -19,13 +21,73 @@ except ImportError:
     print("Lỗi: Không tìm thấy file province_data.py.")
     exit()
 
+# Thư mục gốc của dự án chứa gói dùng chung weather_common
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weather_common import LocationRegistry, force_import, lazy_import
+
+# pandas và pytz chỉ được import khi có request dự báo đầu tiên (xem STARTUP_MODE)
+pd = lazy_import('pandas')
+pytz = lazy_import('pytz')
+
+from feature_engineering import (
+    DIRECT_HORIZON, build_direct_feature_columns, build_feature_columns, direct_feature_matrix, next_hour_features
+)
+from rollout_engine import RolloutEngine
+from model_store import (
+    load_boosters, load_direct_boosters, load_direct_tree_ensemble, load_province_encoder, load_tree_ensemble
+)
+from forecast_cache import ForecastCache, CacheWarmer, STALE
+from cache_backends import MemoryBackend, SQLiteBackend
+from upstream_client import UpstreamClient
+
 # --- Khởi tạo và tải các tài nguyên cần thiết ---
 app = Flask(__name__)
 CORS(app)
 
 # --- CẤU HÌNH CACHE ---
-FORECAST_CACHE = {} # Dictionary để lưu cache
 CACHE_DURATION_SECONDS = 15 * 60 # Thời gian cache tồn tại: 15 phút
+CACHE_WARMER_ENABLED = os.environ.get('CACHE_WARMER_ENABLED', '1') == '1'
+# Sau khi hết hạn vẫn phục vụ bản cũ thêm tối đa chừng này giây, trong lúc làm mới ở nền;
+# không có bộ làm mới nền thì không ai làm mới bản cũ, nên hết hạn là tính lại ngay
+CACHE_STALE_SECONDS = int(os.environ.get('CACHE_STALE_SECONDS', 10 * 60)) if CACHE_WARMER_ENABLED else 0
+# Bộ làm mới nền: làm mới trước khi hết hạn bao nhiêu giây, chu kỳ kiểm tra,
+# số request Open-Meteo song song, số tỉnh mỗi nhóm làm mới (mỗi nhóm vào cache ngay khi xong)
+# và tập tỉnh cần giữ ấm ('all', số N = N tỉnh được hỏi nhiều nhất, hoặc danh sách tên tỉnh
+# cách nhau bởi dấu phẩy); mặc định chỉ giữ ấm các tỉnh có người hỏi để không tải lại
+# cả 63 tỉnh khi không có truy cập
+CACHE_REFRESH_AHEAD_SECONDS = int(os.environ.get('CACHE_REFRESH_AHEAD_SECONDS', 2 * 60))
+CACHE_WARMER_INTERVAL_SECONDS = int(os.environ.get('CACHE_WARMER_INTERVAL_SECONDS', 30))
+CACHE_REFRESH_CONCURRENCY = int(os.environ.get('CACHE_REFRESH_CONCURRENCY', 4))
+CACHE_WARMER_MAX_BATCH = int(os.environ.get('CACHE_WARMER_MAX_BATCH', CACHE_REFRESH_CONCURRENCY))
+CACHE_WARM_SET = os.environ.get('CACHE_WARM_SET', '10')
+
+# Nơi lưu cache: 'sqlite' (mặc định) để các tiến trình worker trên cùng máy dùng chung
+# kết quả và chỉ một worker tính mỗi tỉnh; 'memory' để mỗi tiến trình có cache riêng.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'sqlite')
+# Mặc định nằm cạnh module (không phụ thuộc thư mục làm việc của gunicorn/WSGI)
+CACHE_DB_PATH = os.environ.get(
+    'CACHE_DB_PATH', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'forecast_cache.sqlite3')
+)
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1000))
+
+if CACHE_BACKEND == 'memory':
+    _cache_backend = MemoryBackend(max_entries=CACHE_MAX_ENTRIES)
+else:
+    _cache_backend = SQLiteBackend(CACHE_DB_PATH, max_bytes=CACHE_MAX_BYTES, max_entries=CACHE_MAX_ENTRIES)
+FORECAST_CACHE = ForecastCache(CACHE_DURATION_SECONDS, CACHE_STALE_SECONDS, backend=_cache_backend)
+
+# --- CẤU HÌNH GỌI OPEN-METEO ---
+# Một client dùng chung cho mọi request (giữ kết nối), hạn chót tổng cho mỗi lần tải
+# lịch sử (kể cả thử lại) để request /api/predict không bị treo khi upstream chậm.
+OPEN_METEO_FORECAST_URL = os.environ.get('OPEN_METEO_FORECAST_URL', "https://api.open-meteo.com/v1/forecast")
+UPSTREAM_DEADLINE_SECONDS = float(os.environ.get('UPSTREAM_DEADLINE_SECONDS', 10))
+OPEN_METEO = UpstreamClient(
+    pool_size=max(10, CACHE_REFRESH_CONCURRENCY * 2),
+    timeout=(3.05, UPSTREAM_DEADLINE_SECONDS),
+    deadline=UPSTREAM_DEADLINE_SECONDS,
+    retries=int(os.environ.get('UPSTREAM_RETRIES', 2))
+)
 
 ELEMENTS = [
     'air_temperature',
@@ -34,29 +96,102 @@ ELEMENTS = [
     'cloud_area_fraction',
     'wind_speed'
 ]
+FEATURE_COLUMNS = build_feature_columns(ELEMENTS)
+DIRECT_FEATURE_COLUMNS = build_direct_feature_columns(ELEMENTS)
 
-# Tải các mô hình và bộ mã hóa
-try:
-    MODELS = {element: joblib.load(f'model_{element}.joblib') for element in ELEMENTS}
-    PROVINCE_ENCODER = joblib.load('province_encoder.joblib')
-    print("--- Tất cả mô hình đã được tải thành công! ---")
-except FileNotFoundError as e:
-    print(f"Lỗi: Không tìm thấy file mô hình. Vui lòng chạy 'train_weather_model.py' trước. Chi tiết: {e}")
-    exit()
+# --- CẤU HÌNH KHỞI ĐỘNG ---
+# 'lazy': import pandas và nạp mô hình ở request dự báo đầu tiên, worker sẵn sàng ngay;
+# 'background': như 'lazy' nhưng bắt đầu nạp ở một luồng nền ngay khi khởi động;
+# 'eager': nạp hết khi import, dùng với gunicorn --preload để tiến trình cha nạp một
+# lần rồi fork, các worker dùng chung bộ nhớ mô hình.
+STARTUP_MODE = os.environ.get('STARTUP_MODE', 'lazy')
+# 'native': forecast_trees.npz, model_*.txt, province_encoder.json (xem model_store.py),
+# tự quay về .joblib nếu chưa có; 'joblib': luôn dùng các file pickle cũ.
+MODEL_FORMAT = os.environ.get('MODEL_FORMAT', 'native')
+
+# --- CẤU HÌNH SUY LUẬN ---
+# 'lightgbm': gọi mô hình LightGBM; 'native': bộ suy luận NumPy (tree_inference.py);
+# 'auto': dùng bản NumPy khi số dòng nhỏ (ít chi phí cố định mỗi lần gọi),
+# và LightGBM (C++ đa luồng) cho các ma trận lớn.
+INFERENCE_ENGINE = os.environ.get('INFERENCE_ENGINE', 'auto')
+NATIVE_MAX_ROWS = int(os.environ.get('NATIVE_MAX_ROWS', 8))
+# 'recursive': dự báo từng giờ rồi đưa kết quả làm đầu vào cho giờ sau (72 bước nối tiếp);
+# 'direct': mô hình trực tiếp (train_weather_model.py --direct) dự báo cả 72 giờ
+# trong một lần suy luận từ cửa sổ quan sát hiện tại.
+FORECAST_MODE = os.environ.get('FORECAST_MODE', 'recursive')
+
+_RESOURCES = {}
+_RESOURCES_LOCK = threading.RLock()
+
+def _resource(name, load):
+    # Nạp tài nguyên một lần duy nhất, các luồng khác chờ lần nạp đang chạy
+    value = _RESOURCES.get(name)
+    if value is None:
+        with _RESOURCES_LOCK:
+            value = _RESOURCES.get(name)
+            if value is None:
+                start = time.perf_counter()
+                value = _RESOURCES[name] = load()
+                print(f"--- Đã nạp {name} trong {time.perf_counter() - start:.2f} giây ---")
+    return value
+
+def get_province_encoder():
+    return _resource('province_encoder', lambda: load_province_encoder(native=MODEL_FORMAT == 'native'))
+
+def get_models():
+    # Mô hình LightGBM cho các lô lớn (import LightGBM khá chậm nên chỉ nạp khi cần)
+    return _resource('lightgbm_models', lambda: load_boosters(ELEMENTS, native=MODEL_FORMAT == 'native'))
+
+def get_tree_ensemble():
+    return _resource('tree_ensemble', lambda: load_tree_ensemble(
+        ELEMENTS, FEATURE_COLUMNS, native=MODEL_FORMAT == 'native'
+    ))
+
+def get_direct_models():
+    return _resource('direct_lightgbm_models', lambda: load_direct_boosters(ELEMENTS))
+
+def get_direct_tree_ensemble():
+    return _resource('direct_tree_ensemble', lambda: load_direct_tree_ensemble(ELEMENTS, DIRECT_FEATURE_COLUMNS))
+
+def load_libraries():
+    # Import thật pandas/pytz dưới khóa trước khi nhiều luồng cùng dùng
+    return _resource('pandas', lambda: (force_import(pd), force_import(pytz)))
+
+def preload():
+    """Nạp trước mọi thứ cần cho dự báo: pandas, pytz, bảng mã tỉnh và mô hình."""
+    load_libraries()
+    get_province_encoder()
+    direct = FORECAST_MODE == 'direct'
+    if INFERENCE_ENGINE != 'lightgbm':
+        get_direct_tree_ensemble() if direct else get_tree_ensemble()
+    if INFERENCE_ENGINE != 'native':
+        get_direct_models() if direct else get_models()
+
+def _preload_in_background():
+    try:
+        preload()
+    except Exception as e:
+        print(f"Lỗi khi nạp trước mô hình: {e}")
+
+if STARTUP_MODE == 'eager':
+    try:
+        preload()
+        print("--- Tất cả mô hình đã được tải thành công! ---")
+    except FileNotFoundError as e:
+        print(f"Lỗi: Không tìm thấy file mô hình. Vui lòng chạy 'train_weather_model.py' trước. Chi tiết: {e}")
+        exit()
+elif STARTUP_MODE == 'background':
+    threading.Thread(target=_preload_in_background, name='model-preload', daemon=True).start()
 
 # --- HÀM HỖ TRỢ: Tìm tỉnh gần nhất theo tọa độ ---
+PROVINCE_REGISTRY = LocationRegistry(PROVINCE_DATA)
+MAX_NEAREST_POINTS = 20000 # Số điểm tối đa cho một lần gọi /api/nearest
+
 def find_closest_province(lat, lon):
-    min_dist_sq = float('inf')
-    closest_province = None
-    for province_name, info in PROVINCE_DATA.items():
-        dist_sq = (lat - info['lat'])**2 + (lon - info['lon'])**2
-        if dist_sq < min_dist_sq:
-            min_dist_sq = dist_sq
-            closest_province = province_name
-    return closest_province
+    province_name, _ = PROVINCE_REGISTRY.nearest_one(lat, lon)
+    return province_name
 
 def get_initial_features(lat, lon):
-    url = "https://api.open-meteo.com/v1/forecast"
     params = {
         "latitude": lat,
         "longitude": lon,
@@ -66,9 +201,7 @@ def get_initial_features(lat, lon):
         ]),
         "past_days": 2, "forecast_days": 1 
     }
-    response = requests.get(url, params=params)
-    response.raise_for_status()
-    data = response.json()['hourly']
+    data = OPEN_METEO.get_json(OPEN_METEO_FORECAST_URL, params=params)['hourly']
     
     df = pd.DataFrame(data)
     df = df.rename(columns={
@@ -84,25 +217,9 @@ def get_initial_features(lat, lon):
 
 
 def create_features_for_prediction(df_history, province_name, prediction_time):
-    features = {}
-    
-    features['hour_sin'] = np.sin(2 * np.pi * prediction_time.hour / 24)
-    features['hour_cos'] = np.cos(2 * np.pi * prediction_time.hour / 24)
-    features['day_of_year_sin'] = np.sin(2 * np.pi * prediction_time.dayofyear / 366)
-    features['day_of_year_cos'] = np.cos(2 * np.pi * prediction_time.dayofyear / 366)
-    features['month_sin'] = np.sin(2 * np.pi * prediction_time.month / 12)
-    features['month_cos'] = np.cos(2 * np.pi * prediction_time.month / 12)
-
-    for element in ELEMENTS:
-        history_series = df_history[element]
-        for i in range(1, 4):
-            features[f'{element}_lag_{i}'] = history_series.iloc[-i]
-        
-        features[f'{element}_rolling_mean_6'] = history_series.rolling(window=6, min_periods=1).mean().iloc[-1]
-        features[f'{element}_rolling_mean_24'] = history_series.rolling(window=24, min_periods=1).mean().iloc[-1]
-        features[f'{element}_rolling_std_6'] = history_series.rolling(window=6, min_periods=1).std().iloc[-1]
-        
-    features['province_encoded'] = PROVINCE_ENCODER[province_name]
+    # Cùng cách tính với dữ liệu huấn luyện (feature_engineering.add_features)
+    features = next_hour_features(df_history, ELEMENTS, prediction_time)
+    features['province_encoded'] = get_province_encoder()[province_name]
     
     return pd.DataFrame([features]).fillna(0)
 
@@ -116,6 +233,291 @@ def determine_weather_symbol(precipitation, cloud_cover, hour):
     return 'clearsky_day' if is_day else 'clearsky_night'
 
 
+def clip_predictions(element, predictions):
+    # Ràng buộc vật lý: không âm (trừ nhiệt độ), độ ẩm trong [0, 100]
+    if element != 'air_temperature':
+        predictions = np.where(predictions < 0, 0, predictions)
+    if element == 'relative_humidity':
+        predictions = np.clip(predictions, 0, 100)
+    return predictions
+
+
+def predict_elements(feature_matrix, direct=False):
+    """Dự báo cả 5 yếu tố cho một ma trận feature, trả về mảng (số dòng, số yếu tố).
+
+    direct=True: ma trận theo DIRECT_FEATURE_COLUMNS, dùng mô hình trực tiếp.
+    """
+    use_native = INFERENCE_ENGINE == 'native' or (
+        INFERENCE_ENGINE == 'auto' and len(feature_matrix) <= NATIVE_MAX_ROWS
+    )
+    if use_native:
+        raw = (get_direct_tree_ensemble() if direct else get_tree_ensemble()).predict(feature_matrix)
+        return np.column_stack([clip_predictions(element, raw[:, i]) for i, element in enumerate(ELEMENTS)])
+    models = get_direct_models() if direct else get_models()
+    feature_df = pd.DataFrame(feature_matrix, columns=DIRECT_FEATURE_COLUMNS if direct else FEATURE_COLUMNS)
+    return np.column_stack([
+        clip_predictions(element, models[element].predict(feature_df)) for element in ELEMENTS
+    ])
+
+
+def rollout_forecast(province_names, histories, steps=72):
+    """Dự báo đệ quy cho nhiều tỉnh cùng lúc, mỗi bước chỉ một lần suy luận cho cả lô."""
+    engine = RolloutEngine.from_frames(
+        histories, [get_province_encoder()[name] for name in province_names], ELEMENTS
+    )
+    current_times = [pd.to_datetime(history['time'].iloc[-1]) for history in histories]
+    predictions = [[] for _ in province_names]
+
+    for _ in range(steps):
+        current_times = [t + timedelta(hours=1) for t in current_times]
+        # Ghép feature của tất cả các tỉnh thành một ma trận cho bước này
+        step_values = predict_elements(engine.features(current_times))
+        engine.push(step_values)
+        for i, current_time_utc in enumerate(current_times):
+            predicted_values = {"time": current_time_utc}
+            predicted_values.update(zip(ELEMENTS, step_values[i]))
+            predictions[i].append(predicted_values)
+
+    return [pd.DataFrame(rows) for rows in predictions]
+
+
+def direct_forecast(province_names, histories, steps=DIRECT_HORIZON):
+    """Dự báo `steps` giờ cho nhiều tỉnh bằng mô hình trực tiếp: một lần suy luận cho mọi (tỉnh, giờ).
+
+    Trả về cùng dạng với rollout_forecast (mỗi tỉnh một DataFrame time + các yếu tố).
+    """
+    if steps > DIRECT_HORIZON:
+        raise ValueError(f"Mô hình trực tiếp chỉ dự báo tối đa {DIRECT_HORIZON} giờ.")
+    engine = RolloutEngine.from_frames(
+        histories, [get_province_encoder()[name] for name in province_names], ELEMENTS
+    )
+    first_times = [pd.to_datetime(history['time'].iloc[-1]) + timedelta(hours=1) for history in histories]
+    # Feature của giờ kế tiếp (như bước đầu của rollout), lặp lại cho từng tầm dự báo
+    base = engine.features(first_times)
+    horizons = np.tile(np.arange(1, steps + 1), len(province_names))
+    rows = np.repeat(np.arange(len(province_names)), steps)
+    base_times = pd.DatetimeIndex(first_times)[rows]
+    values = predict_elements(direct_feature_matrix(base[rows], base_times, horizons), direct=True)
+
+    forecast_dfs = []
+    for i in range(len(province_names)):
+        block = slice(i * steps, (i + 1) * steps)
+        frame = pd.DataFrame(values[block], columns=ELEMENTS)
+        frame.insert(0, 'time', base_times[block] + pd.to_timedelta(horizons[block] - 1, unit='h'))
+        forecast_dfs.append(frame)
+    return forecast_dfs
+
+
+def forecast_frames(province_names, histories):
+    """72 giờ dự báo cho các tỉnh theo FORECAST_MODE."""
+    if FORECAST_MODE == 'direct':
+        return direct_forecast(province_names, histories)
+    return rollout_forecast(province_names, histories)
+
+
+# Các ký hiệu theo thứ tự chữ cái: khi hòa, mode() của pandas lấy ký hiệu đứng trước
+WEATHER_SYMBOLS = np.array(sorted([
+    'heavyrain', 'rain', 'cloudy', 'partlycloudy_day', 'partlycloudy_night', 'clearsky_day', 'clearsky_night'
+]))
+
+
+def weather_symbol_codes(precipitation, cloud_cover, hours):
+    """determine_weather_symbol cho cả mảng; trả về chỉ số trong WEATHER_SYMBOLS."""
+    is_day = (hours >= 6) & (hours < 18)
+    symbols = np.select(
+        [precipitation > 2.0, precipitation > 0.2, cloud_cover > 80,
+         (cloud_cover > 40) & is_day, cloud_cover > 40, is_day],
+        ['heavyrain', 'rain', 'cloudy', 'partlycloudy_day', 'partlycloudy_night', 'clearsky_day'],
+        default='clearsky_night'
+    )
+    return np.searchsorted(WEATHER_SYMBOLS, symbols)
+
+
+def _segment_sum_mean(values, starts, lengths):
+    # Tổng và trung bình từng đoạn liên tiếp, bỏ qua NaN như Series.sum()/mean().
+    # Cộng theo đúng thứ tự của pandas (tổng cặp của NumPy) bằng cách gom các
+    # đoạn cùng độ dài thành một ma trận.
+    is_nan = np.isnan(values)
+    values = np.where(is_nan, 0.0, values)
+    sums = np.empty(len(starts))
+    for length in np.unique(lengths):
+        selected = lengths == length
+        sums[selected] = values[starts[selected, None] + np.arange(length)].sum(axis=1)
+    counts = lengths - np.add.reduceat(is_nan, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return sums, means
+
+
+def build_forecast_responses(province_names, forecast_dfs, now_vn=None):
+    """Chuyển kết quả rollout của nhiều tỉnh thành JSON dự báo theo giờ và theo ngày.
+
+    Mọi tỉnh được nối thành các mảng chung (theo tỉnh rồi theo giờ), ký hiệu
+    thời tiết tính trên cả mảng, và thống kê theo ngày lấy từ một lần chia
+    nhóm (tỉnh, ngày) thay vì lọc lại bảng cho từng ngày.
+    """
+    vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
+    if now_vn is None:
+        now_vn = datetime.now(vn_tz)
+    province = np.repeat(np.arange(len(forecast_dfs)), [len(df) for df in forecast_dfs])
+    columns = {
+        element: np.concatenate([df[element].to_numpy(dtype=np.float64) for df in forecast_dfs])
+        for element in ELEMENTS
+    }
+    times = pd.DatetimeIndex(pd.concat([df['time'] for df in forecast_dfs], ignore_index=True))
+    local = times.tz_convert(vn_tz).tz_localize(None).to_numpy()
+    hours = (local.astype('datetime64[h]').astype(np.int64) % 24)
+    minutes = (local.astype('datetime64[m]').astype(np.int64) % 60)
+    days = local.astype('datetime64[D]')
+    symbols = weather_symbol_codes(columns['precipitation_amount'], columns['cloud_area_fraction'], hours)
+    responses = [{"province": name, "hourly": [], "daily": []} for name in province_names]
+
+    # 24 giờ tới của mỗi tỉnh
+    upcoming = np.flatnonzero(times > now_vn)
+    first = np.searchsorted(province[upcoming], province[upcoming], side='left')
+    upcoming = upcoming[np.arange(len(upcoming)) - first < 24]
+    for p, hour, minute, temperature, precipitation, wind_speed, humidity, symbol in zip(
+        province[upcoming].tolist(), hours[upcoming].tolist(), minutes[upcoming].tolist(),
+        np.round(columns['air_temperature'][upcoming], 1).tolist(),
+        np.round(columns['precipitation_amount'][upcoming], 2).tolist(),
+        np.round(columns['wind_speed'][upcoming], 1).tolist(),
+        np.round(columns['relative_humidity'][upcoming], 1).tolist(),
+        WEATHER_SYMBOLS[symbols[upcoming]].tolist()
+    ):
+        responses[p]["hourly"].append({
+            "time": f"{hour:02d}:{minute:02d}",
+            "temperature": temperature,
+            "precipitation": precipitation,
+            "wind_speed": wind_speed,
+            "relative_humidity": humidity,
+            "symbol_url": symbol
+        })
+
+    # Chia nhóm (tỉnh, ngày) từ hôm nay: dữ liệu đã xếp theo tỉnh rồi theo giờ nên mỗi nhóm liên tiếp
+    rows = np.flatnonzero(days >= np.datetime64(now_vn.date()))
+    if not len(rows):
+        return responses
+    row_province, row_day = province[rows], days[rows]
+    new_group = np.r_[True, (row_province[1:] != row_province[:-1]) | (row_day[1:] != row_day[:-1])]
+    group_of_row = np.cumsum(new_group) - 1
+    starts = np.flatnonzero(new_group)
+    lengths = np.diff(np.r_[starts, len(rows)])
+    group_province = row_province[starts]
+    # Chỉ giữ 3 ngày đầu tiên của mỗi tỉnh
+    group_rank = np.arange(len(starts)) - np.searchsorted(group_province, group_province, side='left')
+
+    temperature = columns['air_temperature'][rows]
+    temp_max = np.fmax.reduceat(temperature, starts)
+    temp_min = np.fmin.reduceat(temperature, starts)
+    total_precipitation, _ = _segment_sum_mean(columns['precipitation_amount'][rows], starts, lengths)
+    _, avg_wind_speed = _segment_sum_mean(columns['wind_speed'][rows], starts, lengths)
+    _, avg_humidity = _segment_sum_mean(columns['relative_humidity'][rows], starts, lengths)
+    # Ký hiệu của ngày: ký hiệu xuất hiện nhiều nhất từ 7h đến 17h, mặc định trời quang
+    daytime = (hours[rows] >= 7) & (hours[rows] < 17)
+    symbol_counts = np.bincount(
+        group_of_row[daytime] * len(WEATHER_SYMBOLS) + symbols[rows][daytime],
+        minlength=len(starts) * len(WEATHER_SYMBOLS)
+    ).reshape(len(starts), len(WEATHER_SYMBOLS))
+    daily_symbols = np.where(
+        symbol_counts.any(axis=1), WEATHER_SYMBOLS[symbol_counts.argmax(axis=1)], 'clearsky_day'
+    )
+
+    keep = np.flatnonzero(group_rank < 3)
+    dates = pd.DatetimeIndex(row_day[starts[keep]]).strftime('%A, %d/%m').tolist()
+    for p, date, t_max, t_min, precipitation, wind_speed, humidity, symbol in zip(
+        group_province[keep].tolist(), dates,
+        np.round(temp_max[keep], 1).tolist(), np.round(temp_min[keep], 1).tolist(),
+        np.round(total_precipitation[keep], 1).tolist(), np.round(avg_wind_speed[keep], 1).tolist(),
+        np.round(avg_humidity[keep], 1).tolist(), daily_symbols[keep].tolist()
+    ):
+        responses[p]["daily"].append({
+            "date": date,
+            "temp_max": t_max,
+            "temp_min": t_min,
+            "total_precipitation": precipitation,
+            "avg_wind_speed": wind_speed,
+            "avg_humidity": humidity,
+            "symbol_url": symbol
+        })
+    return responses
+
+
+def build_forecast_response(province_name, forecast_df):
+    """Chuyển kết quả rollout của một tỉnh thành JSON dự báo theo giờ và theo ngày."""
+    return build_forecast_responses([province_name], [forecast_df])[0]
+
+
+def fetch_histories(province_names):
+    """Tải dữ liệu ban đầu cho nhiều tỉnh song song. Trả về (lịch sử, lỗi)."""
+    def fetch(province_name):
+        province_info = PROVINCE_DATA[province_name]
+        return get_initial_features(province_info['lat'], province_info['lon'])
+
+    histories, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, CACHE_REFRESH_CONCURRENCY)) as executor:
+        futures = {name: executor.submit(fetch, name) for name in province_names}
+        for province_name, future in futures.items():
+            try:
+                history = future.result()
+            except Exception as e:
+                print(f"Lỗi khi tải dữ liệu ban đầu cho {province_name}: {e}")
+                errors[province_name] = "Không tải được dữ liệu ban đầu."
+                continue
+            if len(history) < 24:
+                errors[province_name] = "Không đủ dữ liệu lịch sử để bắt đầu dự báo."
+                continue
+            histories[province_name] = history
+    return histories, errors
+
+
+def forecast_provinces(province_names):
+    """Dự báo mới theo lô cho các tỉnh. Trả về (kết quả, lỗi).
+
+    Không gọi trực tiếp từ request: dùng FORECAST_CACHE.compute() để các lần
+    miss đồng thời cho cùng một tỉnh chỉ tải dữ liệu và dự báo một lần.
+    """
+    load_libraries()
+    histories, errors = fetch_histories(province_names)
+    results = {}
+    if histories:
+        names = list(histories)
+        forecast_dfs = forecast_frames(names, [histories[name] for name in names])
+        results = dict(zip(names, build_forecast_responses(names, forecast_dfs)))
+    return results, errors
+
+
+def parse_warm_set(value):
+    value = value.strip()
+    if value.lower() == 'all':
+        return None
+    if value.isdigit():
+        return int(value)
+    return [name.strip() for name in value.split(',') if name.strip() in PROVINCE_DATA]
+
+
+CACHE_WARMER = CacheWarmer(
+    FORECAST_CACHE, forecast_provinces, PROVINCE_DATA,
+    warm_set=parse_warm_set(CACHE_WARM_SET),
+    refresh_ahead_seconds=CACHE_REFRESH_AHEAD_SECONDS,
+    interval_seconds=CACHE_WARMER_INTERVAL_SECONDS,
+    max_batch=CACHE_WARMER_MAX_BATCH or None
+)
+_WARMER_LOCK = threading.Lock()
+_warmer_pid = None
+
+
+def ensure_cache_warmer():
+    # Chạy bộ làm mới nền một lần cho mỗi tiến trình, kể cả các worker gunicorn/WSGI
+    # (không đi qua __main__); worker được fork sau khi nạp module nên so theo pid.
+    global _warmer_pid
+    if not CACHE_WARMER_ENABLED or _warmer_pid == os.getpid():
+        return
+    with _WARMER_LOCK:
+        if _warmer_pid != os.getpid():
+            CACHE_WARMER.start()
+            _warmer_pid = os.getpid()
+
+
 @app.route('/api/provinces', methods=['GET'])
 def get_provinces():
     provinces_list = [
@@ -124,8 +526,49 @@ def get_provinces():
     ]
     return jsonify(provinces_list)
 
+@app.route('/api/nearest', methods=['GET', 'POST'])
+def nearest():
+    # GET ?lat=..&lon=.. cho một điểm (ví dụ khi người dùng bấm lên bản đồ);
+    # POST {"points": [{"lat": .., "lon": .., "id": ..}, ...]} cho nhiều điểm,
+    # ví dụ toàn bộ processed_city_list_with_coords.json. Tùy chọn max_distance_km.
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        points = payload.get('points')
+        max_distance_km = payload.get('max_distance_km')
+    else:
+        lat = request.args.get('lat', type=float)
+        lon = request.args.get('lon', type=float)
+        points = None if lat is None or lon is None else [{"lat": lat, "lon": lon}]
+        max_distance_km = request.args.get('max_distance_km', type=float)
+
+    if not isinstance(points, list) or not points:
+        return jsonify({"error": "Cần cung cấp 'lat' và 'lon' hoặc danh sách 'points'."}), 400
+    if len(points) > MAX_NEAREST_POINTS:
+        return jsonify({"error": f"Tối đa {MAX_NEAREST_POINTS} điểm cho mỗi lần gọi."}), 400
+    try:
+        lats = np.array([point['lat'] for point in points], dtype=np.float64)
+        lons = np.array([point['lon'] for point in points], dtype=np.float64)
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Mỗi điểm cần có 'lat' và 'lon' dạng số."}), 400
+    if not (np.isfinite(lats).all() and np.isfinite(lons).all()
+            and (np.abs(lats) <= 90).all() and (np.abs(lons) <= 180).all()):
+        return jsonify({"error": "Tọa độ không hợp lệ."}), 400
+
+    names, distances = PROVINCE_REGISTRY.nearest(lats, lons, max_distance_km)
+    results = []
+    for point, name, distance in zip(points, names.tolist(), distances.tolist()):
+        item = {
+            "lat": point['lat'], "lon": point['lon'], "province": name,
+            "distance_km": None if name is None else round(distance, 2)
+        }
+        if 'id' in point:
+            item['id'] = point['id']
+        results.append(item)
+    return jsonify({"results": results})
+
 @app.route('/api/predict', methods=['GET'])
 def predict():
+    ensure_cache_warmer()
     province_name = request.args.get('province')
     lat = request.args.get('lat', type=float)
     lon = request.args.get('lon', type=float)
@@ -141,104 +584,83 @@ def predict():
         return jsonify({"error": "Cần cung cấp 'province' hoặc 'lat' và 'lon'."}), 400
     
     # --- LOGIC CACHE: KIỂM TRA TRƯỚC KHI DỰ BÁO ---
-    current_time_epoch = time.time()
-    if province_name in FORECAST_CACHE:
-        cached_result, timestamp = FORECAST_CACHE[province_name]
-        if current_time_epoch - timestamp < CACHE_DURATION_SECONDS:
-            print(f"--> Phục vụ dự báo từ cache cho: {province_name}")
-            return jsonify(cached_result)
+    FORECAST_CACHE.record_request(province_name)
+    cached_result, state = FORECAST_CACHE.lookup(province_name)
+    if cached_result is not None:
+        if state == STALE:
+            # Trả bản cũ ngay, làm mới ở nền
+            CACHE_WARMER.request_refresh(province_name)
+        print(f"--> Phục vụ dự báo từ cache ({state}) cho: {province_name}")
+        return jsonify(cached_result)
 
     print(f"--> Cache không có hoặc đã hết hạn. Thực hiện dự báo mới cho: {province_name}")
 
     try:
-        province_info = PROVINCE_DATA[province_name]
-        history = get_initial_features(province_info['lat'], province_info['lon'])
-        
-        if len(history) < 24:
-            return jsonify({"error": "Không đủ dữ liệu lịch sử để bắt đầu dự báo."}), 500
-            
-        predictions = []
-        current_time_utc = pd.to_datetime(history['time'].iloc[-1])
-
-        for _ in range(72):
-            current_time_utc += timedelta(hours=1)
-            feature_df = create_features_for_prediction(history, province_name, current_time_utc)
-            
-            predicted_values = {"time": current_time_utc}
-            for element in ELEMENTS:
-                prediction = MODELS[element].predict(feature_df)[0]
-                if prediction < 0 and element != 'air_temperature':
-                    prediction = 0
-                if element == 'relative_humidity':
-                    prediction = np.clip(prediction, 0, 100)
-                predicted_values[element] = prediction
-            
-            predictions.append(predicted_values)
-            
-            new_row = pd.DataFrame([predicted_values])
-            history = pd.concat([history, new_row], ignore_index=True)
-
-        forecast_df = pd.DataFrame(predictions)
-        vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-        forecast_df['time_vn'] = forecast_df['time'].dt.tz_convert(vn_tz)
-        
-        now_vn = datetime.now(vn_tz)
-
-        hourly_df = forecast_df[forecast_df['time_vn'] > now_vn].head(24)
-        hourly_forecast = []
-        for _, row in hourly_df.iterrows():
-            symbol_code = determine_weather_symbol(row['precipitation_amount'], row['cloud_area_fraction'], row['time_vn'].hour)
-            hourly_forecast.append({
-                "time": row['time_vn'].strftime('%H:%M'),
-                "temperature": round(row['air_temperature'], 1),
-                "precipitation": round(row['precipitation_amount'], 2),
-                "wind_speed": round(row['wind_speed'], 1),
-                "relative_humidity": round(row['relative_humidity'], 1),
-                "symbol_url": symbol_code 
-            })
-            
-        forecast_df['date'] = forecast_df['time_vn'].dt.date
-        daily_forecast = []
-        unique_days = sorted(forecast_df[forecast_df['date'] >= now_vn.date()]['date'].unique())
-        
-        for date_val in unique_days[:3]:
-            group = forecast_df[forecast_df['date'] == date_val]
-            if group.empty: continue
-            
-            daytime_group = group[(group['time_vn'].dt.hour >= 7) & (group['time_vn'].dt.hour < 17)]
-            if not daytime_group.empty:
-                daily_symbols = daytime_group.apply(
-                    lambda row: determine_weather_symbol(row['precipitation_amount'], row['cloud_area_fraction'], row['time_vn'].hour),
-                    axis=1
-                )
-                daily_symbol_code = daily_symbols.mode()[0] if not daily_symbols.empty else 'clearsky_day'
-            else:
-                daily_symbol_code = 'clearsky_day' 
-            
-            daily_forecast.append({
-                "date": date_val.strftime('%A, %d/%m'),
-                "temp_max": round(group['air_temperature'].max(), 1),
-                "temp_min": round(group['air_temperature'].min(), 1),
-                "total_precipitation": round(group['precipitation_amount'].sum(), 1),
-                "avg_wind_speed": round(group['wind_speed'].mean(), 1),
-                "avg_humidity": round(group['relative_humidity'].mean(), 1),
-                "symbol_url": daily_symbol_code
-            })
-
-        result_json = {
-            "province": province_name,
-            "hourly": hourly_forecast,
-            "daily": daily_forecast
-        }
-
-        # --- LOGIC CACHE: LƯU KẾT QUẢ VÀO CACHE ---
-        FORECAST_CACHE[province_name] = (result_json, time.time())
-        
-        return jsonify(result_json)
+        # --- LOGIC CACHE: TÍNH MỘT LẦN, LƯU VÀO CACHE, CÁC REQUEST TRÙNG CHỜ KẾT QUẢ ---
+        results, errors = FORECAST_CACHE.compute([province_name], forecast_provinces)
+        if province_name in errors:
+            return jsonify({"error": errors[province_name]}), 500
+        return jsonify(results[province_name])
 
     except Exception as e:
         print(f"Lỗi khi thực hiện dự báo cho {province_name}: {e}")
         return jsonify({"error": "Đã xảy ra lỗi phía server."}), 500
 
+@app.route('/api/predict_batch', methods=['GET'])
+def predict_batch():
+    ensure_cache_warmer()
+    # ?provinces=all (mặc định) hoặc ?provinces=Hà Nội,Đà Nẵng,...
+    provinces_arg = request.args.get('provinces', 'all').strip()
+    if provinces_arg.lower() == 'all':
+        province_names = list(PROVINCE_DATA)
+    else:
+        province_names = list(dict.fromkeys(p.strip() for p in provinces_arg.split(',') if p.strip()))
+    invalid = [name for name in province_names if name not in PROVINCE_DATA]
+    if invalid:
+        return jsonify({"error": f"Tên tỉnh không hợp lệ: {', '.join(invalid)}."}), 400
+    if not province_names:
+        return jsonify({"error": "Cần cung cấp 'provinces'."}), 400
+
+    results, missing_names = {}, []
+    for province_name in province_names:
+        FORECAST_CACHE.record_request(province_name)
+        cached_result, state = FORECAST_CACHE.lookup(province_name)
+        if cached_result is None:
+            missing_names.append(province_name)
+            continue
+        if state == STALE:
+            CACHE_WARMER.request_refresh(province_name)
+        results[province_name] = cached_result
+
+    errors = {}
+    if missing_names:
+        print(f"--> Dự báo theo lô cho {len(missing_names)} tỉnh, {len(results)} tỉnh lấy từ cache.")
+        try:
+            fresh_results, errors = FORECAST_CACHE.compute(missing_names, forecast_provinces)
+            results.update(fresh_results)
+        except Exception as e:
+            print(f"Lỗi khi dự báo theo lô: {e}")
+            return jsonify({"error": "Đã xảy ra lỗi phía server."}), 500
+
+    return jsonify({
+        "forecasts": [results[name] for name in province_names if name in results],
+        "errors": errors
+    })
+
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    # Hit/miss của tiến trình này và kích thước, số mục bị xóa của cache dùng chung
+    return jsonify(FORECAST_CACHE.stats())
+
+@app.route('/api/upstream_stats', methods=['GET'])
+def upstream_stats():
+    # Số lần gọi, thử lại, lỗi, độ trễ và trạng thái cầu dao của client Open-Meteo
+    return jsonify(OPEN_METEO.stats())
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    debug = os.environ.get('FLASK_DEBUG', '1') == '1'
+    # Với debug=True, tiến trình giám sát của reloader không phục vụ request nên không chạy
+    # bộ làm mới nền; tiến trình con (WERKZEUG_RUN_MAIN) và chế độ thường khởi động ngay
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        ensure_cache_warmer()
+    app.run(host='0.0.0.0', port=5001, debug=debug)
\ No newline at end of file
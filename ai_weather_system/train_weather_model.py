@@ -1,16 +1,56 @@
-# Mục đích: Đọc dữ liệu từ file CSV của Open-Meteo, xử lý và huấn luyện
-# các mô hình AI dự báo thời tiết.
+# Mục đích: Đọc dữ liệu Open-Meteo (kho phân vùng history_store, hoặc file CSV cũ
+# nếu chưa chuyển), xử lý và huấn luyện các mô hình AI dự báo thời tiết.
+# - Chế độ 'full': huấn luyện lại toàn bộ trên mọi dữ liệu.
+# - Chế độ 'incremental': lấy các mô hình đang dùng, cập nhật trên RECENT_DAYS ngày gần
+#   nhất (thêm cây hoặc refit lá) trong giới hạn thời gian, rồi so RMSE với mô hình của lần
+#   huấn luyện toàn bộ gần nhất trên HOLDOUT_HOURS giờ cuối (chỉ gồm dữ liệu mới sau phiên bản
+#   đang dùng, không dùng để cập nhật); yếu tố nào kém hơn thì quay về mô hình toàn bộ đó,
+#   nên các lần cập nhật nối tiếp không trôi xa dần khỏi mô hình toàn bộ.
+# - 'auto' (mặc định): tăng dần, nhưng huấn luyện lại toàn bộ sau mỗi FULL_RETRAIN_DAYS
+#   ngày, khi chưa có phiên bản nào hoặc khi danh sách feature đã đổi.
+# - --direct: huấn luyện thêm mô hình trực tiếp (một mô hình cho mọi tầm 1..72 giờ của mỗi
+#   yếu tố) để server dự báo 72 giờ trong một lần suy luận (FORECAST_MODE=direct); chỉ ở
+#   chế độ 'full', chế độ 'incremental' giữ lại mô hình trực tiếp của phiên bản trước.
+# Mỗi lần chạy ghi một phiên bản mới trong model_versions/ rồi mới chép ra thư mục server
+# đọc (model_store.save_version / publish_version).
 # ==============================================================================
 # Thêm các features phức tạp hơn (tuần hoàn, trung bình trượt) ***
 # ==============================================================================
+import argparse
+import os
+import time
+from datetime import datetime
+
 import pandas as pd
-import lightgbm as lgb
-import joblib
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_squared_error
-import numpy as np
+
+from model_store import (
+    TREES_FILENAME, VERSIONS_DIR, load_boosters, load_province_encoder, load_version_index,
+    load_version_metadata, publish_version, save_version
+)
+from history_store import HistoryStore
+from feature_engineering import build_direct_feature_columns, build_feature_columns
+from feature_store import FeatureStore
+from model_training import direct_samples, holdout_rmse, thread_plan, train_models, update_models
+
+FULL_RETRAIN_DAYS = int(os.environ.get('FULL_RETRAIN_DAYS', 7))
+RECENT_DAYS = int(os.environ.get('INCREMENTAL_RECENT_DAYS', 30))
+HOLDOUT_HOURS = int(os.environ.get('INCREMENTAL_HOLDOUT_HOURS', 24))
+TIME_BUDGET_SECONDS = float(os.environ.get('INCREMENTAL_TIME_BUDGET', 600))
+# Mô hình cập nhật được dùng nếu RMSE trên cửa sổ kiểm tra không quá mô hình cũ x (1 + dung sai)
+INCREMENTAL_TOLERANCE = float(os.environ.get('INCREMENTAL_TOLERANCE', 0.02))
+
+parser = argparse.ArgumentParser(description='Huấn luyện các mô hình dự báo thời tiết')
+parser.add_argument('--mode', choices=['auto', 'full', 'incremental'], default='auto')
+parser.add_argument('--method', choices=['continue', 'refit'], default='continue',
+                    help="continue: thêm cây trên dữ liệu gần đây; refit: chỉ tính lại giá trị lá")
+parser.add_argument('--recent-days', type=int, default=RECENT_DAYS)
+parser.add_argument('--holdout-hours', type=int, default=HOLDOUT_HOURS)
+parser.add_argument('--time-budget', type=float, default=TIME_BUDGET_SECONDS, help='Giây cho cả 5 mô hình')
+parser.add_argument('--direct', action='store_true', help='Huấn luyện thêm mô hình trực tiếp 72 giờ (chế độ full)')
+args = parser.parse_args()
 
 print("--- Bắt đầu quá trình huấn luyện mô hình ---")
+run_start = time.perf_counter()
 
 ELEMENTS = [
     'air_temperature',
@@ -20,10 +60,14 @@ ELEMENTS = [
     'wind_speed'
 ]
 
-# Đọc dữ liệu từ file
+# Đọc dữ liệu từ kho phân vùng; nếu kho chưa có thì đọc file CSV cũ
 input_filename = 'vietnam_weather_history.csv'
+history_store = HistoryStore()
 try:
-    df = pd.read_csv(input_filename, parse_dates=['time'])
+    if history_store.exists():
+        df = history_store.read()
+    else:
+        df = pd.read_csv(input_filename, parse_dates=['time'])
 except FileNotFoundError:
     print(f"Lỗi: Không tìm thấy file '{input_filename}'.")
     print("Vui lòng chạy file 'open_meteo_collector.py' trước.")
@@ -31,91 +75,162 @@ except FileNotFoundError:
 
 print("Đã tải dữ liệu thành công.")
 
-# 1. Tiền xử lý và tạo Feature Engineering 
+# 1. Tiền xử lý và tạo Feature Engineering
 # =================================================
 print("Đang tiền xử lý và tạo features...")
 
-df = df.sort_values(by=['province', 'time']).reset_index(drop=True)
-
-# Cập nhật cú pháp fillna theo phiên bản mới của pandas ---
-df.ffill(inplace=True) # Điền giá trị rỗng bằng giá trị phía trên
-df.bfill(inplace=True) # Điền giá trị rỗng bằng giá trị phía dưới
-
-# Thêm các đặc trưng tuần hoàn (Cyclical Features) ***
-# Giúp mô hình hiểu tính chu kỳ của thời gian
-df['hour_sin'] = np.sin(2 * np.pi * df['time'].dt.hour / 24)
-df['hour_cos'] = np.cos(2 * np.pi * df['time'].dt.hour / 24)
-df['day_of_year_sin'] = np.sin(2 * np.pi * df['time'].dt.dayofyear / 366)
-df['day_of_year_cos'] = np.cos(2 * np.pi * df['time'].dt.dayofyear / 366)
-df['month_sin'] = np.sin(2 * np.pi * df['time'].dt.month / 12)
-df['month_cos'] = np.cos(2 * np.pi * df['time'].dt.month / 12)
-
-# Thêm các đặc trưng trung bình trượt (Rolling Features) ***
-# Giúp mô hình có cái nhìn về xu hướng gần đây
-for element in ELEMENTS:
-    # Thêm các lag features (dữ liệu của các giờ trước đó)
-    for i in range(1, 4):
-        df[f'{element}_lag_{i}'] = df.groupby('province')[element].shift(i)
-        
-    # Thêm các rolling features
-    df[f'{element}_rolling_mean_6'] = df.groupby('province')[element].transform(lambda x: x.shift(1).rolling(window=6, min_periods=1).mean())
-    df[f'{element}_rolling_mean_24'] = df.groupby('province')[element].transform(lambda x: x.shift(1).rolling(window=24, min_periods=1).mean())
-    df[f'{element}_rolling_std_6'] = df.groupby('province')[element].transform(lambda x: x.shift(1).rolling(window=6, min_periods=1).std())
+# Sắp theo (tỉnh, giờ), điền chỗ thiếu theo từng tỉnh rồi thêm các đặc trưng tuần hoàn
+# (giờ, ngày trong năm, tháng) và lag/trung bình trượt (feature_engineering.py, server
+# dùng cùng module này khi dự báo). Kết quả được lưu trong feature_cache/: lần chạy sau
+# chỉ tải lại, dữ liệu có thêm giờ mới thì chỉ tính phần đuôi của từng tỉnh.
+df, sources = FeatureStore().build(df, ELEMENTS)
+print(f"Feature: {sources['hit']} tỉnh lấy từ cache, {sources['tail']} tỉnh tính thêm phần mới, "
+      f"{sources['full']} tỉnh tính lại toàn bộ.")
 
 df.dropna(inplace=True)
 print("Tạo features hoàn tất.")
 
-# 2. Huấn luyện các mô hình
+features = build_feature_columns(ELEMENTS)
+data_end = df['time'].max()
+
+# 2. Chọn chế độ huấn luyện
 # ========================
-features = [
-    'hour_sin', 'hour_cos', 'day_of_year_sin', 'day_of_year_cos', 'month_sin', 'month_cos'
-]
-for element in ELEMENTS:
-    for i in range(1, 4):
-        features.append(f'{element}_lag_{i}')
-    features.append(f'{element}_rolling_mean_6')
-    features.append(f'{element}_rolling_mean_24')
-    features.append(f'{element}_rolling_std_6')
-
-province_encoder = {name: i for i, name in enumerate(df['province'].unique())}
-df['province_encoded'] = df['province'].map(province_encoder)
-features.append('province_encoded')
-
-joblib.dump(province_encoder, 'province_encoder.joblib')
-print("Đã lưu bộ mã hóa tỉnh thành.")
-
-X = df[features]
-models = {}
-
-for target_element in ELEMENTS:
-    print(f"\n--- Huấn luyện mô hình cho: {target_element} ---")
-    y = df[target_element]
-    
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-    
-    lgbm = lgb.LGBMRegressor(
-        objective='regression_l1',
-        n_estimators=1000,
-        learning_rate=0.05,
-        num_leaves=31,
-        random_state=42,
-        n_jobs=-1
-    )
-    
-    lgbm.fit(
-        X_train, y_train,
-        eval_set=[(X_test, y_test)],
-        eval_metric='rmse',
-        callbacks=[lgb.early_stopping(100, verbose=False)]
-    )
-    
-    preds = lgbm.predict(X_test)
-    rmse = np.sqrt(mean_squared_error(y_test, preds))
-    print(f"RMSE trên tập test cho {target_element}: {rmse:.4f}")
-    
-    model_filename = f'model_{target_element}.joblib'
-    joblib.dump(lgbm, model_filename)
-    print(f"Đã lưu mô hình tại '{model_filename}'")
-    models[target_element] = lgbm
+index = load_version_index()
+current = load_version_metadata(index['current']) if index['current'] else None
+mode = args.mode
+if mode != 'full':
+    reason = None
+    if current is None:
+        reason = "chưa có phiên bản mô hình nào"
+    elif index['last_full'] is None:
+        reason = "chưa có phiên bản huấn luyện toàn bộ nào để so sánh"
+    elif current.get('features') != features:
+        reason = "danh sách feature đã đổi"
+    elif mode == 'auto':
+        last_full = load_version_metadata(index['last_full']) if index['last_full'] else None
+        age = None if last_full is None else datetime.now() - datetime.fromisoformat(last_full['created_at'])
+        if age is None or age.days >= FULL_RETRAIN_DAYS:
+            reason = f"đã quá {FULL_RETRAIN_DAYS} ngày kể từ lần huấn luyện lại toàn bộ"
+    if reason is None and pd.Timestamp(current['data_end']) >= data_end:
+        print(f"Không có dữ liệu mới kể từ phiên bản '{index['current']}' ({current['data_end']}).")
+        exit()
+    mode = 'full' if reason else 'incremental'
+    if reason:
+        print(f"Huấn luyện lại toàn bộ: {reason}.")
+print(f"Chế độ huấn luyện: {mode}")
+
+holdout_hours = args.holdout_hours
+if mode == 'incremental':
+    # Cửa sổ kiểm tra chỉ gồm dữ liệu mới sau phiên bản đang dùng (mô hình cũ chưa thấy):
+    # thu lại còn nhiều nhất một nửa số giờ mới, nửa còn lại để cập nhật
+    new_hours = int((data_end - pd.Timestamp(current['data_end'])) / pd.Timedelta(hours=1))
+    holdout_hours = min(holdout_hours, new_hours // 2)
+    if holdout_hours < 1:
+        print(f"Chỉ có {new_hours} giờ dữ liệu mới kể từ phiên bản '{index['current']}', "
+              f"chưa đủ để vừa cập nhật vừa kiểm tra.")
+        exit()
+holdout_start = data_end - pd.Timedelta(hours=holdout_hours - 1)
+
+targets = {element: df[element] for element in ELEMENTS}
+holdout = df['time'] >= holdout_start
+metadata = {'mode': mode, 'elements': ELEMENTS, 'features': features,
+            'data_end': data_end.isoformat(), 'rows': int(len(df)),
+            'holdout': {'start': holdout_start.isoformat(), 'end': data_end.isoformat()}}
+
+if mode == 'full':
+    # 3a. Huấn luyện lại toàn bộ
+    # ========================
+    province_encoder = {name: i for i, name in enumerate(df['province'].unique())}
+    df['province_encoded'] = df['province'].map(province_encoder)
+    X = df[features]
+
+    # Chia bin X một lần cho mọi yếu tố, huấn luyện song song các yếu tố (model_training.py)
+    def report(target_element, booster, rmse, elapsed):
+        print(f"\n--- Đã huấn luyện mô hình cho: {target_element} ({elapsed:.1f} giây, "
+              f"{booster.best_iteration} cây) ---")
+        print(f"RMSE trên tập test cho {target_element}: {rmse:.4f}")
+
+    workers, threads = thread_plan(len(ELEMENTS))
+    print(f"Huấn luyện {len(ELEMENTS)} mô hình, {workers} mô hình cùng lúc x {threads} luồng mỗi mô hình...")
+    training_start = time.perf_counter()
+    models, test_rmse = train_models(X, targets, on_done=report)
+    print(f"\nHuấn luyện xong trong {time.perf_counter() - training_start:.1f} giây.")
+    metadata['test_rmse'] = test_rmse
+    # Cửa sổ cuối nằm trong dữ liệu huấn luyện: chỉ để tham chiếu cho các lần cập nhật sau
+    metadata['holdout']['rmse'] = holdout_rmse(models, X[holdout], {e: y[holdout] for e, y in targets.items()})
+
+    direct_models = None
+    if args.direct:
+        # Mô hình trực tiếp: mẫu (giờ gốc, tầm dự báo) lấy từ cùng bảng feature
+        X_direct, direct_targets = direct_samples(df, features, ELEMENTS)
+        print(f"\nHuấn luyện mô hình trực tiếp 1..72 giờ trên {len(X_direct)} mẫu...")
+        training_start = time.perf_counter()
+        direct_models, direct_rmse = train_models(X_direct, direct_targets, on_done=report)
+        print(f"\nHuấn luyện mô hình trực tiếp xong trong {time.perf_counter() - training_start:.1f} giây.")
+        metadata['direct'] = {'features': build_direct_feature_columns(ELEMENTS), 'samples': int(len(X_direct)),
+                              'test_rmse': direct_rmse}
+else:
+    # 3b. Cập nhật tăng dần từ phiên bản đang dùng
+    # ========================
+    direct_models = None
+    if args.direct:
+        print("Chế độ 'incremental' không huấn luyện mô hình trực tiếp, giữ bản của phiên bản trước.")
+    province_encoder = load_province_encoder()
+    df['province_encoded'] = df['province'].map(province_encoder)
+    unknown = df['province_encoded'].isna()
+    if unknown.any():
+        print(f"Bỏ qua {df.loc[unknown, 'province'].nunique()} tỉnh chưa có trong bộ mã hóa "
+              f"(cần huấn luyện lại toàn bộ để thêm).")
+        df = df[~unknown]
+        holdout = holdout[~unknown]
+        targets = {element: df[element] for element in ELEMENTS}
+    X = df[features]
+    recent = ~holdout & (df['time'] >= holdout_start - pd.Timedelta(days=args.recent_days))
+    print(f"Cập nhật ({args.method}) trên {int(recent.sum())} dòng của {args.recent_days} ngày gần nhất, "
+          f"kiểm tra trên {int(holdout.sum())} dòng từ {holdout_start}...")
+
+    # Cập nhật tiếp từ mô hình đang dùng, so với mô hình của lần huấn luyện toàn bộ gần nhất
+    baseline = load_boosters(ELEMENTS, os.path.join(VERSIONS_DIR, index['last_full']))
+
+    def report(target_element, booster, changed, elapsed):
+        note = f"{booster.num_trees()} cây" if changed else "hết thời gian, giữ mô hình cũ"
+        print(f"--- {target_element}: {elapsed:.1f} giây, {note} ---")
+
+    candidate = update_models(load_boosters(ELEMENTS), X[recent], {e: y[recent] for e, y in targets.items()},
+                              method=args.method, time_budget=args.time_budget, on_done=report)
+    holdout_targets = {e: y[holdout] for e, y in targets.items()}
+    candidate_rmse = holdout_rmse(candidate, X[holdout], holdout_targets)
+    baseline_rmse = holdout_rmse(baseline, X[holdout], holdout_targets)
+
+    models, accepted = {}, {}
+    print(f"\nRMSE trên cửa sổ kiểm tra ({holdout_hours} giờ cuối), so với bản toàn bộ '{index['last_full']}':")
+    for element in ELEMENTS:
+        accepted[element] = candidate_rmse[element] <= baseline_rmse[element] * (1 + INCREMENTAL_TOLERANCE)
+        models[element] = candidate[element] if accepted[element] else baseline[element]
+        print(f"  {element:<22} toàn bộ {baseline_rmse[element]:8.4f}  cập nhật {candidate_rmse[element]:8.4f}  "
+              f"-> {'dùng bản cập nhật' if accepted[element] else 'dùng mô hình toàn bộ'}")
+    if not any(accepted.values()):
+        if index['current'] != index['last_full']:
+            publish_version(index['last_full'])
+            print(f"Không mô hình nào đạt, quay về phiên bản toàn bộ '{index['last_full']}'.")
+        else:
+            print("Không mô hình nào tốt hơn, giữ nguyên phiên bản hiện tại.")
+        exit()
+    metadata.update({'method': args.method, 'base_version': index['current'],
+                     'baseline_version': index['last_full'], 'recent_days': args.recent_days})
+    metadata['holdout'].update({'rmse': {e: candidate_rmse[e] if accepted[e] else baseline_rmse[e]
+                                         for e in ELEMENTS},
+                                'baseline_rmse': baseline_rmse, 'candidate_rmse': candidate_rmse,
+                                'accepted': accepted})
+
+# 4. Lưu phiên bản và đưa vào sử dụng
+# ========================
+metadata['seconds'] = round(time.perf_counter() - run_start, 1)
+version = save_version(models, province_encoder, features, metadata, direct_models=direct_models,
+                       direct_feature_names=build_direct_feature_columns(ELEMENTS),
+                       carry_from=index['current'] if mode == 'incremental' else None)
+publish_version(version)
+print(f"Đã lưu phiên bản '{version}' và chép ra thư mục server: '{TREES_FILENAME}', 'model_*.txt', "
+      f"'model_*.joblib', 'province_encoder.json'")
 
 print("\n--- HOÀN TẤT QUÁ TRÌNH HUẤN LUYỆN ---")
@@ -0,0 +1,179 @@
+# Mục đích: Suy luận cây quyết định bằng NumPy cho các mô hình LightGBM.
+# - Chuyển booster của mỗi model_{element}.joblib thành các mảng phẳng:
+#   feature chia nhánh, ngưỡng, nút con và giá trị lá.
+# - Dự báo cả 5 mô hình cùng lúc trên một ma trận feature, duyệt tất cả các
+#   cây theo từng tầng bằng phép toán vector, không qua lớp bọc sklearn.
+# - Kết quả khớp với LightGBM trong sai số dấu phẩy động (chỉ khác thứ tự cộng).
+# ==============================================================================
+import numpy as np
+
+# decision_type trong file mô hình LightGBM: bit 0 là nhánh phân loại,
+# bit 1 là default_left, bit 2-3 là cách xử lý giá trị thiếu (missing_type)
+_CATEGORICAL_MASK, _DEFAULT_LEFT_MASK = 1, 2
+_MISSING_NONE, _MISSING_ZERO, _MISSING_NAN = 0, 1, 2
+_ZERO_THRESHOLD = 1e-35
+_TREE_ARRAYS = {
+    'split_feature': np.int64, 'threshold': np.float64, 'decision_type': np.int64,
+    'left_child': np.int64, 'right_child': np.int64, 'leaf_value': np.float64,
+}
+# Các mảng được lưu bởi TreeEnsemble.save()
+_SAVED_ARRAYS = (
+    'node_feature', 'node_threshold', 'node_children', 'node_default_left',
+    'node_missing', 'leaf_value', 'leaf_model', 'roots',
+)
+
+
+def _booster_of(model):
+    return model.booster_ if hasattr(model, 'booster_') else model
+
+
+def _num_trees_used(model, booster):
+    # Giống LGBMRegressor.predict: dùng best_iteration nếu có early stopping
+    best_iteration = getattr(model, 'best_iteration_', None) or booster.best_iteration
+    total = booster.num_trees()
+    if best_iteration and best_iteration > 0:
+        return min(total, best_iteration * booster.num_model_per_iteration())
+    return total
+
+
+def _parse_trees(model_string, num_trees):
+    # Đọc các khối "Tree=..." trong model_to_string() (nhanh hơn nhiều so với dump_model)
+    trees = []
+    for block in model_string.split('\nTree=')[1:num_trees + 1]:
+        block = block.split('\nend of trees')[0]
+        tree = {}
+        for line in block.splitlines()[1:]:
+            key, _, value = line.partition('=')
+            if key == 'num_leaves':
+                tree['num_leaves'] = int(value)
+            elif key in _TREE_ARRAYS:
+                tree[key] = np.array(value.split(), dtype=np.float64).astype(_TREE_ARRAYS[key])
+        trees.append(tree)
+    return trees
+
+
+class TreeEnsemble:
+    """Nhiều mô hình LightGBM (hồi quy, chỉ có nhánh số) dưới dạng mảng phẳng.
+
+    Nút con được mã hóa như trong LightGBM: số >= 0 là chỉ số nút trong,
+    số âm -(lá + 1) là lá; các chỉ số được đánh lại liên tục cho mọi cây.
+    """
+
+    def __init__(self, models, feature_names=None):
+        self.names = list(models)
+        features, thresholds, children, decision_types = [], [], [], []
+        leaf_values, leaf_models, roots = [], [], []
+        n_nodes = n_leaves = 0
+
+        for model_index, name in enumerate(self.names):
+            booster = _booster_of(models[name])
+            if feature_names is None:
+                feature_names = booster.feature_name()
+            elif list(booster.feature_name()) != list(feature_names):
+                raise ValueError(f"Mô hình '{name}' dùng thứ tự feature khác các mô hình còn lại.")
+
+            for tree in _parse_trees(booster.model_to_string(), _num_trees_used(models[name], booster)):
+                values = tree['leaf_value']
+                if tree['num_leaves'] > 1:
+                    if (tree['decision_type'] & _CATEGORICAL_MASK).any():
+                        raise ValueError(f"Mô hình '{name}' có nhánh phân loại, chưa được hỗ trợ.")
+                    pair = np.stack([tree['left_child'], tree['right_child']], axis=1)
+                    # Đổi chỉ số cục bộ của cây sang chỉ số toàn cục
+                    children.append(np.where(pair >= 0, pair + n_nodes, pair - n_leaves))
+                    features.append(tree['split_feature'])
+                    thresholds.append(tree['threshold'])
+                    decision_types.append(tree['decision_type'])
+                    roots.append(n_nodes)
+                    n_nodes += len(pair)
+                else:
+                    roots.append(-(n_leaves + 1))
+                leaf_values.append(values)
+                leaf_models.append(np.full(len(values), model_index))
+                n_leaves += len(values)
+
+        def join(parts, dtype, shape=(0,)):
+            return np.concatenate(parts).astype(dtype) if parts else np.zeros(shape, dtype=dtype)
+
+        decision_types = join(decision_types, np.int64)
+        self.feature_names = list(feature_names)
+        self.node_feature = join(features, np.intp)
+        self.node_threshold = join(thresholds, np.float64)
+        self.node_children = join(children, np.intp, (0, 2))
+        self.node_default_left = (decision_types & _DEFAULT_LEFT_MASK) != 0
+        self.node_missing = ((decision_types >> 2) & 3).astype(np.int8)
+        self.leaf_value = join(leaf_values, np.float64)
+        self.leaf_model = join(leaf_models, np.intp)
+        self.roots = np.array(roots, dtype=np.intp)
+        # Khi mọi nút đều là missing_type 'None', NaN chỉ đơn giản được coi là 0
+        self._only_missing_none = not (self.node_missing != _MISSING_NONE).any()
+
+    def save(self, path):
+        """Lưu các mảng phẳng ra file .npz; TreeEnsemble.load() đọc lại mà không cần LightGBM."""
+        with open(path, 'wb') as f:
+            np.savez(f, names=np.array(self.names), feature_names=np.array(self.feature_names),
+                     **{name: getattr(self, name) for name in _SAVED_ARRAYS})
+
+    @classmethod
+    def load(cls, path):
+        ensemble = cls.__new__(cls)
+        with np.load(path, allow_pickle=False) as data:
+            ensemble.names = data['names'].tolist()
+            ensemble.feature_names = data['feature_names'].tolist()
+            for name in _SAVED_ARRAYS:
+                setattr(ensemble, name, data[name])
+        ensemble._only_missing_none = not (ensemble.node_missing != _MISSING_NONE).any()
+        return ensemble
+
+    @property
+    def num_trees(self):
+        return len(self.roots)
+
+    def predict(self, X):
+        """Ma trận (số dòng, số mô hình), cột theo thứ tự self.names."""
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[None, :]
+        n_rows, n_cols = X.shape
+        n_models = len(self.names)
+        if n_rows == 0 or not len(self.roots):
+            return np.zeros((n_rows, n_models))
+        if self._only_missing_none:
+            X = np.where(np.isnan(X), 0.0, X)
+        flat_x = X.ravel()
+
+        # Mỗi "làn" là một cặp (dòng, cây); chỉ giữ lại các làn chưa tới lá
+        codes = np.tile(self.roots, n_rows)
+        row_offset = np.repeat(np.arange(n_rows, dtype=np.intp) * n_cols, len(self.roots))
+        output_index = np.repeat(np.arange(n_rows, dtype=np.intp) * n_models, len(self.roots))
+        leaf_slots, leaf_codes = [], []
+
+        while codes.size:
+            at_leaf = codes < 0
+            if at_leaf.any():
+                leaf_slots.append(output_index[at_leaf])
+                leaf_codes.append(codes[at_leaf])
+                inner = ~at_leaf
+                codes, row_offset, output_index = codes[inner], row_offset[inner], output_index[inner]
+                if not codes.size:
+                    break
+            values = flat_x[row_offset + self.node_feature[codes]]
+            if self._only_missing_none:
+                go_right = values > self.node_threshold[codes]
+            else:
+                go_right = self._go_right(values, codes)
+            codes = self.node_children[codes, go_right.view(np.int8)]
+
+        leaves = -np.concatenate(leaf_codes) - 1
+        slots = np.concatenate(leaf_slots) + self.leaf_model[leaves]
+        totals = np.bincount(slots, weights=self.leaf_value[leaves], minlength=n_rows * n_models)
+        return totals.reshape(n_rows, n_models)
+
+    def _go_right(self, values, codes):
+        # Quy tắc NumericalDecision của LightGBM khi có giá trị thiếu
+        missing_type = self.node_missing[codes]
+        is_nan = np.isnan(values)
+        values = np.where(is_nan & (missing_type != _MISSING_NAN), 0.0, values)
+        is_missing = (((missing_type == _MISSING_ZERO) & (np.abs(values) <= _ZERO_THRESHOLD))
+                      | ((missing_type == _MISSING_NAN) & is_nan))
+        go_left = np.where(is_missing, self.node_default_left[codes], values <= self.node_threshold[codes])
+        return ~go_left
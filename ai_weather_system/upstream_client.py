@@ -0,0 +1,234 @@
+# Mục đích: Client HTTP dùng chung để gọi Open-Meteo (server.py và open_meteo_collector.py).
+# - Giữ kết nối (connection pooling) qua requests.Session, không bắt tay TLS lại mỗi lần.
+# - Mỗi lần gọi có hạn chót (deadline) tổng, tính cả các lần thử lại.
+# - Thử lại với backoff lũy thừa có jitter cho lỗi mạng, 429 và 5xx.
+# - Cầu dao (circuit breaker): lỗi liên tiếp quá ngưỡng thì ngừng gọi một lúc.
+# - Bộ đếm độ trễ và lỗi để theo dõi qua stats().
+# - Giới hạn tốc độ dùng chung giữa các luồng (token bucket), tạm dừng cả bucket khi gặp 429.
+# ==============================================================================
+import random
+import threading
+import time
+from collections import Counter, deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Cầu dao đang mở: không gửi request tới upstream."""
+
+
+class DeadlineExceededError(requests.exceptions.Timeout):
+    """Hết hạn chót của lần gọi (kể cả thời gian thử lại)."""
+
+
+class CircuitBreaker:
+    """Cầu dao ba trạng thái: đóng -> mở (sau N lỗi liên tiếp) -> nửa mở (thử 1 request)."""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+
+class TokenBucket:
+    """Giới hạn tốc độ: trung bình `rate` request/giây, dồn tối đa `capacity` request.
+
+    An toàn giữa các luồng; pause() chặn mọi luồng trong một khoảng thời gian
+    (ví dụ theo Retry-After của phản hồi 429).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = max(self._updated, time.monotonic() + seconds)
+
+    def acquire(self, timeout=None):
+        """Lấy một token, chờ nếu cần; trả về False nếu quá `timeout` giây."""
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated) * self.rate)
+                self._updated = max(self._updated, now)
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return True
+                wait = (1.0 - self._tokens) / self.rate + (self._updated - now)
+            if give_up_at is not None and now + wait > give_up_at:
+                return False
+            time.sleep(wait)
+
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    return float(value) if value and value.isdigit() else None
+
+
+class UpstreamClient:
+    """Client có pool kết nối, hạn chót, thử lại có jitter và cầu dao.
+
+    timeout: (connect, read) cho mỗi lần thử; deadline: tổng thời gian tối đa
+    của một lần gọi get()/get_json(). Lỗi ném ra đều là requests.RequestException.
+    """
+
+    def __init__(self, pool_size=10, timeout=(3.05, 15.0), deadline=30.0, retries=3,
+                 backoff=0.5, max_backoff=8.0, failure_threshold=5, reset_timeout=30.0,
+                 user_agent='DigitalMap-Weather/1.0', rate_limiter=None):
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = user_agent
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        self._latencies = deque(maxlen=1000)  # giây, các lần thử gần nhất
+
+    def _count(self, key, latency=None):
+        with self._lock:
+            self._counters[key] += 1
+            if latency is not None:
+                self._latencies.append(latency)
+
+    def _sleep_before_retry(self, attempt, response, expires_at):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = _retry_after(response)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if time.monotonic() + delay >= expires_at:
+            return False
+        time.sleep(delay)
+        return True
+
+    def get(self, url, params=None, deadline=None):
+        """GET có thử lại; trả về Response thành công (2xx) hoặc ném lỗi."""
+        expires_at = time.monotonic() + (self.deadline if deadline is None else deadline)
+        self._count('calls')
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter is not None and not self.rate_limiter.acquire(expires_at - time.monotonic()):
+                break
+            if not self.breaker.allow():
+                self._count('circuit_open')
+                raise CircuitOpenError(f"Cầu dao đang mở, tạm ngừng gọi {url}")
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                break
+            timeout = (min(self.timeout[0], remaining), min(self.timeout[1], remaining))
+            response = None
+            start = time.monotonic()
+            self._count('attempts')
+            try:
+                response = self.session.get(url, params=params, timeout=timeout)
+                latency = time.monotonic() - start
+                if response.status_code in RETRY_STATUSES:
+                    self._count(f'status_{response.status_code}', latency)
+                    raise requests.exceptions.HTTPError(
+                        f"{response.status_code} từ {url}", response=response
+                    )
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status not in RETRY_STATUSES:
+                    # Lỗi 4xx khác: lỗi của request, không thử lại và không tính vào cầu dao
+                    self._count(f'status_{status}', time.monotonic() - start)
+                    self._count('errors')
+                    self.breaker.record_success()
+                    raise
+                if status == 429:
+                    # Upstream vẫn hoạt động, chỉ yêu cầu chậm lại: không tính vào cầu dao,
+                    # và nếu có bucket thì mọi luồng cùng tạm dừng
+                    self.breaker.record_success()
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.pause(_retry_after(response) or self.backoff)
+                else:
+                    self.breaker.record_failure()
+                last_error = e
+            except requests.exceptions.RequestException as e:
+                self._count('timeouts' if isinstance(e, requests.exceptions.Timeout) else 'connection_errors',
+                            time.monotonic() - start)
+                self.breaker.record_failure()
+                last_error = e
+            else:
+                self._count('successes', latency)
+                self.breaker.record_success()
+                return response
+
+            if attempt == self.retries or not self._sleep_before_retry(attempt, response, expires_at):
+                break
+            self._count('retries')
+
+        self._count('errors')
+        if last_error is None or time.monotonic() >= expires_at:
+            self._count('deadline_exceeded')
+            raise DeadlineExceededError(f"Hết hạn chót khi gọi {url}") from last_error
+        raise last_error
+
+    def get_json(self, url, params=None, deadline=None):
+        return self.get(url, params=params, deadline=deadline).json()
+
+    def stats(self):
+        """Bộ đếm và độ trễ (ms) của các lần thử gần đây."""
+        with self._lock:
+            counters = dict(self._counters)
+            latencies = sorted(self._latencies)
+        latency = {}
+        if latencies:
+            def percentile(p):
+                return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+            latency = {
+                'count': len(latencies),
+                'mean_ms': round(sum(latencies) / len(latencies) * 1000, 1),
+                'p50_ms': percentile(0.50), 'p95_ms': percentile(0.95), 'max_ms': round(latencies[-1] * 1000, 1)
+            }
+        return {'counters': counters, 'latency': latency, 'circuit': self.breaker.state}
@@ -1,13 +1,22 @@
 # Nhiệm vụ: Đánh giá chất lượng mô hình từ dữ liệu trong /server-ai
+# - Kiểm tra lùi theo thời gian (rolling-origin): mỗi fold là một ngày (UTC); mô hình chỉ học
+#   các mẫu có nhãn trước ngày đó, rồi dự báo đệ quy 24 giờ như server từ mỗi giờ trong ngày.
+# - MAE nhiệt độ và độ chính xác tình trạng theo từng tầm dự báo (giờ thứ 1..LEAD_HOURS).
+# - Mẫu cửa sổ trượt tạo một lần cho mỗi thành phố rồi dùng lại cho mọi fold; các cặp
+#   (thành phố, fold) chạy song song trong ProcessPoolExecutor.
+# - Kết quả mỗi fold được lưu theo mã băm dữ liệu tới cuối fold: lần chạy sau chỉ tính các fold mới.
+# - Kết quả được ghi nối vào cuối file log (không đọc lại rồi ghi đè cả file). Log kiểm tra lùi
+#   tách khỏi evaluation_log.csv (MAE một bước trên tập chia ngẫu nhiên của cách đánh giá cũ)
+#   vì hai chỉ số không so sánh được với nhau.
 
 import pandas as pd
 import numpy as np
-from sklearn.ensemble import RandomForestRegressor, RandomForestClassifier
-from sklearn.preprocessing import LabelEncoder
-from sklearn.metrics import mean_absolute_error, accuracy_score
-from sklearn.model_selection import train_test_split
 import matplotlib.pyplot as plt
+import csv
+import json
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 import warnings
 
@@ -16,9 +25,26 @@ import warnings
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 SERVER_AI_DIR = os.path.join(SCRIPT_DIR, '..', 'server-ai')
 DATA_FILE = os.path.join(SERVER_AI_DIR, 'all_cities_weather_data.csv')
-LOG_FILE = os.path.join(SERVER_AI_DIR, 'evaluation_log.csv')
+BACKTEST_LOG_FILE = os.path.join(SERVER_AI_DIR, 'evaluation_backtest_log.csv')
+LEAD_LOG_FILE = os.path.join(SERVER_AI_DIR, 'evaluation_lead_log.csv')
 PLOT_FILE = os.path.join(SERVER_AI_DIR, 'model_performance_over_time.png')
+CACHE_DIR = os.environ.get('BACKTEST_CACHE_DIR', os.path.join(SERVER_AI_DIR, 'backtest_cache'))
 LAGS = 6
+LEAD_HOURS = int(os.environ.get('BACKTEST_LEAD_HOURS', 24))  # số giờ dự báo đệ quy như server
+MAX_FOLDS = int(os.environ.get('BACKTEST_FOLDS', 7))  # số ngày cuối được kiểm tra
+MIN_TRAIN_SAMPLES = 48
+BACKTEST_LOG_COLUMNS = ['evaluation_date', 'city_name', 'data_points', 'folds', 'lead_hours', 'mae', 'accuracy']
+LEAD_LOG_COLUMNS = ['evaluation_date', 'city_name', 'lead_hour', 'samples', 'mae', 'accuracy']
+# Giá trị gán cho giờ vừa dự báo theo tình trạng, như forecast_city của server-ai/server.py
+NEXT_PRECIP_CLOUD = {'Mưa': (0.5, 100.0), 'Nắng': (0.0, 10.0)}
+DEFAULT_PRECIP_CLOUD = (0.0, 60.0)
+
+# Gói dùng chung weather_common nằm ở thư mục gốc của dự án; mô hình dùng chung với server-ai
+sys.path.append(os.path.join(SCRIPT_DIR, '..'))
+sys.path.append(SERVER_AI_DIR)
+from weather_common import OBSERVATION_COLUMNS, sliding_window_samples
+from model_cache import data_fingerprint, fit_city_models, model_definition, worker_plan
+from forest_inference import FlatForest
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -37,25 +63,125 @@ def preprocess_met_df(df):
     df2["precip_1h"], df2['condition'] = df2["precip_1h"].fillna(0.0), df2['symbol_code'].apply(group_weather_condition_3_classes)
     return df2.dropna(subset=["temp", "rhum", "pres", "wind_speed", "cloud_frac"])
 
-def create_training_samples(df, lags):
-    X_list, y_temp_list, y_cond_list = [], [], []
-    # Đảm bảo có đủ dữ liệu để tạo ít nhất một mẫu
-    if len(df) <= lags:
-        return np.array([]), np.array([]), np.array([])
-        
-    for i in range(lags, len(df)):
-        past, target = df.iloc[i-lags:i], df.iloc[i]
-        feat = []
-        for j in range(lags):
-            feat.extend([past["temp"].iloc[j], past["rhum"].iloc[j], past["pres"].iloc[j], past["wind_speed"].iloc[j], past["cloud_frac"].iloc[j], past["precip_1h"].iloc[j]])
-        feat.extend([target["sin_hour"], target["cos_hour"], target["is_night"]])
-        X_list.append(feat)
-        y_temp_list.append(target["temp"])
-        y_cond_list.append(target["condition"])
-    return np.array(X_list), np.array(y_temp_list), np.array(y_cond_list)
+# --- KIỂM TRA LÙI ---
+def rollout_forecasts(reg, clf, windows, start_times, lead_hours=LEAD_HOURS):
+    """Dự báo đệ quy cho nhiều giờ gốc cùng lúc, như forecast_city của server-ai/server.py.
+
+    windows: (số giờ gốc, LAGS, số cột quan sát); start_times: giờ dự báo đầu tiên của mỗi giờ gốc.
+    Trả về (nhiệt độ, tình trạng), mỗi mảng dạng (số giờ gốc, lead_hours).
+    """
+    windows = windows.copy()
+    n = len(windows)
+    temps = np.empty((n, lead_hours))
+    conditions = np.empty((n, lead_hours), dtype=object)
+    temp_col, precip_col, cloud_col = (OBSERVATION_COLUMNS.index(c) for c in ('temp', 'precip_1h', 'cloud_frac'))
+    for step in range(lead_hours):
+        hours = (start_times + pd.Timedelta(hours=step)).hour.to_numpy()
+        time_features = np.column_stack([np.sin(2*np.pi*hours/24), np.cos(2*np.pi*hours/24), (hours < 6) | (hours > 18)])
+        X = np.nan_to_num(np.hstack([windows.reshape(n, -1), time_features]))
+        temps[:, step], conditions[:, step] = reg.predict(X), clf.predict(X)
+
+        new_entry = windows[:, -1].copy()
+        new_entry[:, temp_col] = temps[:, step]
+        precip_cloud = np.array([NEXT_PRECIP_CLOUD.get(c, DEFAULT_PRECIP_CLOUD) for c in conditions[:, step]])
+        new_entry[:, precip_col], new_entry[:, cloud_col] = precip_cloud[:, 0], precip_cloud[:, 1]
+        windows = np.concatenate([windows[:, 1:], new_entry[:, None]], axis=1)
+    return temps, conditions
+
+def run_fold(X_train, y_temp, y_cond, windows, start_times, actual_temp, actual_cond, n_jobs=1):
+    """Huấn luyện trên các mẫu trước fold rồi dự báo từ mọi giờ gốc của fold.
+
+    Trả về tổng sai số tuyệt đối, số lần đúng tình trạng và số mẫu có giá trị thực tế theo từng tầm.
+    """
+    models = fit_city_models(X_train, y_temp, y_cond, n_jobs=n_jobs)
+    reg = FlatForest(models['reg'])
+    clf = FlatForest(models['clf'], labels=models['le'].classes_[models['clf'].classes_])
+    temps, conditions = rollout_forecasts(reg, clf, windows, start_times, actual_temp.shape[1])
+    observed = ~np.isnan(actual_temp)
+    abs_error = np.where(observed, np.abs(temps - np.nan_to_num(actual_temp)), 0.0)
+    correct = observed & (conditions == actual_cond)
+    return {'abs_error': abs_error.sum(axis=0).tolist(), 'correct': correct.sum(axis=0).tolist(),
+            'count': observed.sum(axis=0).tolist()}
+
+def plan_folds(df_city, df_processed, X, targets, lags=LAGS, lead_hours=LEAD_HOURS, max_folds=MAX_FOLDS):
+    """Các fold (ngày UTC) của một thành phố: dữ liệu cho run_fold và khóa cache.
+
+    Mẫu `X`/`targets` (sliding_window_samples của cả bảng) được cắt theo thời điểm nhãn,
+    không tạo lại cho từng fold.
+    """
+    times = df_processed.index
+    target_times = targets.index
+    # Chọn các ngày đủ điều kiện trước (số mẫu huấn luyện, có giờ gốc), chỉ cắt dữ liệu
+    # và tính mã băm cho `max_folds` ngày cuối
+    days = times.floor('D').unique().sort_values()
+    train_counts = target_times.sort_values().searchsorted(days)
+    origin_days = set(times[lags:].floor('D'))
+    days = [day for day, n_train in zip(days, train_counts) if n_train >= MIN_TRAIN_SAMPLES and day in origin_days]
+    days = days[-max_folds:] if max_folds else []
+    values = df_processed[OBSERVATION_COLUMNS].to_numpy(dtype=np.float64)
+    # Giá trị thực tế theo giờ (bỏ các giờ không có trong dữ liệu)
+    actual = df_processed[['temp', 'condition']][~times.duplicated(keep='last')]
+    definition = dict(model_definition(lags), lead_hours=lead_hours, backtest=1)
+    folds = []
+    for day in days:
+        fold_end = day + pd.Timedelta(days=1)
+        train = target_times < day
+        # Giờ gốc p: cửa sổ là LAGS dòng trước p, dự báo bắt đầu ngay sau dòng p-1
+        origins = np.flatnonzero((times >= day) & (times < fold_end))
+        origins = origins[origins >= lags]
+        start_times = times[origins - 1] + pd.Timedelta(hours=1)
+        # Giờ cần so sánh của mỗi (giờ gốc, tầm), theo thứ tự giờ gốc rồi tầm
+        lead_times = start_times.repeat(lead_hours) + pd.to_timedelta(np.tile(np.arange(lead_hours), len(origins)), unit='h')
+        lookup = actual.reindex(lead_times)
+        window_index = origins[:, None] + np.arange(-lags, 0)
+        # Khóa: dữ liệu gốc tới hết giờ xa nhất được so sánh trong fold
+        key = data_fingerprint(df_city[df_city.index < fold_end + pd.Timedelta(hours=lead_hours)],
+                               dict(definition, day=str(day)))
+        folds.append((day, key, {
+            'X_train': X[train], 'y_temp': targets['temp'].to_numpy()[train],
+            'y_cond': targets['condition'].to_numpy()[train],
+            'windows': values[window_index], 'start_times': start_times,
+            'actual_temp': lookup['temp'].to_numpy(dtype=np.float64).reshape(len(origins), lead_hours),
+            'actual_cond': lookup['condition'].to_numpy().reshape(len(origins), lead_hours),
+        }))
+    return folds
+
+def load_cached_fold(key):
+    try:
+        with open(os.path.join(CACHE_DIR, f"{key}.json"), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def save_cached_fold(key, result):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+    os.replace(tmp_path, path)
+
+def append_rows(path, columns, rows):
+    """Ghi nối các dòng vào cuối file CSV; chỉ ghi dòng tiêu đề khi file chưa có."""
+    write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        if write_header:
+            writer.writeheader()
+        writer.writerows(rows)
+
+def summarize(result):
+    """(MAE, độ chính xác, số mẫu) từ tổng theo tầm của một hoặc nhiều fold."""
+    count = int(np.sum(result['count']))
+    if count == 0:
+        return np.nan, np.nan, 0
+    return float(np.sum(result['abs_error']) / count), float(np.sum(result['correct']) / count), count
+
+def merge_results(results):
+    return {name: np.sum([r[name] for r in results], axis=0).tolist() for name in ('abs_error', 'correct', 'count')}
 
 if __name__ == "__main__":
-    print("--- Bắt đầu Kịch bản Đánh giá Hiệu năng Mô hình ---")
+    print("--- Bắt đầu Kịch bản Đánh giá Hiệu năng Mô hình (kiểm tra lùi theo thời gian) ---")
 
     if not os.path.exists(DATA_FILE):
         print(f"LỖI: Không tìm thấy file dữ liệu '{DATA_FILE}'. Vui lòng chạy data_collector.py trước.")
@@ -63,76 +189,93 @@ if __name__ == "__main__":
 
     df_all = pd.read_csv(DATA_FILE, index_col='time', parse_dates=True)
     cities_in_data = df_all['city_name'].unique()
-    evaluation_results, today_str = [], datetime.now().strftime('%Y-%m-%d')
+    today_str = datetime.now().strftime('%Y-%m-%d')
 
+    # 1. Mẫu của mỗi thành phố tạo một lần, chia thành các fold; fold đã có kết quả lấy từ cache
+    fold_results, tasks, data_points = {}, {}, {}
     for city in cities_in_data:
-        print(f"\n-> Đang đánh giá cho: {city}")
         df_city = df_all[df_all['city_name'] == city]
         if len(df_city) < 50:
-            print(f"  CẢNH BÁO: Dữ liệu quá ít ({len(df_city)} dòng), bỏ qua.")
+            print(f"  CẢNH BÁO: Dữ liệu cho {city} quá ít ({len(df_city)} dòng), bỏ qua.")
             continue
-            
         df_processed = preprocess_met_df(df_city)
-        X, y_temp, y_cond = create_training_samples(df_processed, lags=LAGS)
-
-        # Kiểm tra nếu không tạo được mẫu nào
-        if X.shape[0] == 0:
-            print(f"  CẢNH BÁO: Không đủ dữ liệu để tạo mẫu huấn luyện sau khi xử lý, bỏ qua.")
+        X, targets = sliding_window_samples(df_processed, lags=LAGS)
+        folds = plan_folds(df_city, df_processed, X, targets)
+        if not folds:
+            print(f"  CẢNH BÁO: {city} chưa đủ dữ liệu cho fold nào, bỏ qua.")
             continue
+        data_points[city] = len(df_city)
+        for day, key, fold in folds:
+            cached = load_cached_fold(key)
+            if cached is not None:
+                fold_results[(city, day)] = cached
+            else:
+                tasks[(city, day)] = (key, fold)
+    print(f"{len(fold_results) + len(tasks)} fold ({len(data_points)} thành phố), "
+          f"{len(fold_results)} fold đã có kết quả, {len(tasks)} fold cần tính.")
 
-        if len(np.unique(y_cond)) < 2:
-             print(f"  CẢNH BÁO: Chỉ có 1 lớp tình trạng, không thể đánh giá độ chính xác.")
-             continue
-             
-        X = np.nan_to_num(X)
-        le = LabelEncoder()
-        y_cond_enc = le.fit_transform(y_cond)
-        
-        # *** SỬA LỖI TẠI ĐÂY ***
-        # Thử chia dữ liệu với stratify, nếu thất bại thì chia theo cách thông thường
-        try:
-            X_train, X_test, y_temp_train, y_temp_test, y_cond_train, y_cond_test = train_test_split(
-                X, y_temp, y_cond_enc, test_size=0.25, random_state=42, stratify=y_cond_enc)
-        except ValueError:
-            print(f"  CẢNH BÁO: Không thể chia dữ liệu theo stratify (số mẫu quá ít trong một lớp). Chuyển sang chia thông thường.")
-            X_train, X_test, y_temp_train, y_temp_test, y_cond_train, y_cond_test = train_test_split(
-                X, y_temp, y_cond_enc, test_size=0.25, random_state=42)
-
-        # Kiểm tra nếu tập test rỗng
-        if len(X_test) == 0:
-            print(f"  CẢNH BÁO: Tập kiểm tra rỗng, không thể đánh giá. Bỏ qua.")
+    # 2. Các fold còn lại chạy song song, chia đều số lõi cho các tiến trình
+    if tasks:
+        workers, threads = worker_plan(len(tasks))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_fold, n_jobs=threads, **fold): (task, key)
+                       for task, (key, fold) in tasks.items()}
+            for future in as_completed(futures):
+                task, key = futures[future]
+                fold_results[task] = future.result()
+                save_cached_fold(key, fold_results[task])
+
+    if not fold_results:
+        print("Không có fold nào để đánh giá. Kết thúc.")
+        exit()
+
+    # 3. Tổng hợp theo thành phố và theo tầm dự báo
+    evaluation_results, lead_rows, per_city = [], [], {}
+    for city in data_points:
+        results = [result for (c, _), result in sorted(fold_results.items(), key=lambda item: item[0][1]) if c == city]
+        if not results:
             continue
-        
-        reg = RandomForestRegressor(n_estimators=100, random_state=42).fit(X_train, y_temp_train)
-        clf = RandomForestClassifier(n_estimators=100, random_state=42, class_weight='balanced').fit(X_train, y_cond_train)
-        mae, acc = mean_absolute_error(y_temp_test, reg.predict(X_test)), accuracy_score(y_cond_test, clf.predict(X_test))
-        print(f"  MAE: {mae:.2f}°C, Độ chính xác: {acc:.2%}")
-        evaluation_results.append({'evaluation_date': today_str, 'city_name': city, 'data_points': len(df_city), 'mae': mae, 'accuracy': acc})
-
-    if evaluation_results:
-        new_log_df = pd.DataFrame(evaluation_results)
-        # Sửa lỗi concat nếu file log cũ không tồn tại
-        try:
-            log_df = pd.read_csv(LOG_FILE)
-            log_df = pd.concat([log_df, new_log_df], ignore_index=True)
-        except FileNotFoundError:
-            log_df = new_log_df
-
-        log_df.drop_duplicates(subset=['evaluation_date', 'city_name'], keep='last', inplace=True)
-        log_df.to_csv(LOG_FILE, index=False)
-        print(f"\nĐã lưu kết quả đánh giá vào file '{LOG_FILE}'.")
-        
-        print(f"Đang tạo biểu đồ và lưu vào '{PLOT_FILE}'...")
-        plt.style.use('seaborn-v0_8-whitegrid')
-        fig, ax = plt.subplots(figsize=(14, 8))
-        log_df['evaluation_date'] = pd.to_datetime(log_df['evaluation_date'])
-        for city_name, group in log_df.groupby('city_name'):
-            if len(group) > 1: ax.plot(group['evaluation_date'], group['accuracy'] * 100, marker='o', linestyle='-', label=city_name)
-        ax.set(title='Độ chính xác của Mô hình theo Thời gian', xlabel='Ngày Đánh giá', ylabel='Độ chính xác (%)')
-        ax.legend(title='Thành phố', bbox_to_anchor=(1.05, 1), loc='upper left')
-        ax.yaxis.set_major_formatter(plt.FuncFormatter('{:.0f}%'.format))
-        fig.autofmt_xdate()
-        plt.tight_layout(rect=[0, 0, 0.85, 1])
-        plt.savefig(PLOT_FILE)
-        plt.close()
-        print("Tạo biểu đồ hoàn tất.")
+        per_city[city] = merge_results(results)
+        mae, acc, count = summarize(per_city[city])
+        print(f"\n-> {city}: {len(results)} fold, {count} dự báo; MAE: {mae:.2f}°C, Độ chính xác: {acc:.2%}")
+        evaluation_results.append({'evaluation_date': today_str, 'city_name': city, 'data_points': data_points[city],
+                                   'folds': len(results), 'lead_hours': LEAD_HOURS, 'mae': mae, 'accuracy': acc})
+        for lead in range(LEAD_HOURS):
+            lead_result = {name: [values[lead]] for name, values in per_city[city].items()}
+            lead_mae, lead_acc, lead_count = summarize(lead_result)
+            if lead_count:
+                lead_rows.append({'evaluation_date': today_str, 'city_name': city, 'lead_hour': lead + 1,
+                                  'samples': lead_count, 'mae': lead_mae, 'accuracy': lead_acc})
+
+    overall = merge_results(list(per_city.values()))
+    print("\nTheo tầm dự báo (mọi thành phố):")
+    print(f"  {'giờ':>4}  {'số mẫu':>7}  {'MAE (°C)':>9}  {'độ chính xác':>13}")
+    for lead in range(LEAD_HOURS):
+        lead_mae, lead_acc, lead_count = summarize({name: [values[lead]] for name, values in overall.items()})
+        if lead_count:
+            print(f"  {lead + 1:>4}  {lead_count:>7}  {lead_mae:>9.2f}  {lead_acc:>13.2%}")
+
+    # 4. Ghi nối vào cuối các file log
+    append_rows(BACKTEST_LOG_FILE, BACKTEST_LOG_COLUMNS, evaluation_results)
+    append_rows(LEAD_LOG_FILE, LEAD_LOG_COLUMNS, lead_rows)
+    print(f"\nĐã ghi thêm kết quả đánh giá vào '{BACKTEST_LOG_FILE}' và '{LEAD_LOG_FILE}'.")
+
+    print(f"Đang tạo biểu đồ và lưu vào '{PLOT_FILE}'...")
+    log_df = pd.read_csv(BACKTEST_LOG_FILE)
+    # Chỉ so các lần chạy cùng số giờ dự báo
+    log_df = log_df[log_df['lead_hours'] == LEAD_HOURS].copy()
+    # Log chỉ được ghi nối: nhiều lần chạy trong một ngày thì lấy lần sau cùng
+    log_df.drop_duplicates(subset=['evaluation_date', 'city_name'], keep='last', inplace=True)
+    plt.style.use('seaborn-v0_8-whitegrid')
+    fig, ax = plt.subplots(figsize=(14, 8))
+    log_df['evaluation_date'] = pd.to_datetime(log_df['evaluation_date'])
+    for city_name, group in log_df.groupby('city_name'):
+        if len(group) > 1: ax.plot(group['evaluation_date'], group['accuracy'] * 100, marker='o', linestyle='-', label=city_name)
+    ax.set(title=f'Độ chính xác của Mô hình theo Thời gian (kiểm tra lùi, dự báo {LEAD_HOURS} giờ)', xlabel='Ngày Đánh giá', ylabel='Độ chính xác (%)')
+    ax.legend(title='Thành phố', bbox_to_anchor=(1.05, 1), loc='upper left')
+    ax.yaxis.set_major_formatter(plt.FuncFormatter('{:.0f}%'.format))
+    fig.autofmt_xdate()
+    plt.tight_layout(rect=[0, 0, 0.85, 1])
+    plt.savefig(PLOT_FILE)
+    plt.close()
+    print("Tạo biểu đồ hoàn tất.")
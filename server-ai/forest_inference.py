@@ -0,0 +1,79 @@
+# Nhiệm vụ: Suy luận nhanh cho RandomForest của từng thành phố (dự báo 24 bước, mỗi bước một dòng)
+# - Chuyển các cây của RandomForestRegressor/Classifier thành mảng phẳng: feature chia nhánh,
+#   ngưỡng, nút con và giá trị lá của mọi cây nối liền nhau.
+# - Duyệt tất cả các cây cùng lúc theo từng tầng bằng phép toán vector trên một luồng,
+#   không qua joblib (n_jobs=-1 khiến mỗi lần predict một dòng phải chia việc cho cả pool).
+# - Nhãn tình trạng thời tiết lấy thẳng từ bảng tra thay cho LabelEncoder.inverse_transform.
+# - Cùng phép so sánh (giá trị ép float32 như sklearn) và cùng thứ tự cộng nên kết quả khớp sklearn.
+# ==============================================================================
+import numpy as np
+
+
+class FlatForest:
+    """Một RandomForest (hồi quy hoặc phân loại) của scikit-learn dưới dạng mảng phẳng.
+
+    Nút lá trỏ về chính nó (ngưỡng +inf), nên sau `depth` bước mọi cây đều dừng ở lá.
+    Đầu vào không được có NaN (server đã gọi np.nan_to_num).
+    """
+
+    def __init__(self, forest, labels=None):
+        self.is_classifier = hasattr(forest, 'classes_')
+        features, thresholds, children, values, roots = [], [], [], [], []
+        n_nodes = depth = 0
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            is_leaf = tree.children_left < 0
+            local = np.arange(tree.node_count)
+            pair = np.stack([np.where(is_leaf, local, tree.children_left),
+                             np.where(is_leaf, local, tree.children_right)], axis=1)
+            children.append(pair + n_nodes)
+            features.append(np.where(is_leaf, 0, tree.feature))
+            thresholds.append(np.where(is_leaf, np.inf, tree.threshold))
+            if self.is_classifier:
+                # Như DecisionTreeClassifier.predict_proba: chuẩn hóa giá trị lá thành xác suất
+                proba = tree.value[:, 0, :forest.n_classes_]
+                normalizer = proba.sum(axis=1)[:, None]
+                normalizer[normalizer == 0.0] = 1.0
+                values.append(proba / normalizer)
+            else:
+                values.append(tree.value[:, 0, 0])
+            roots.append(n_nodes)
+            n_nodes += tree.node_count
+            depth = max(depth, tree.max_depth)
+
+        self.node_feature = np.concatenate(features).astype(np.intp)
+        self.node_threshold = np.concatenate(thresholds).astype(np.float64)
+        self.node_children = np.concatenate(children).astype(np.intp)
+        self.node_value = np.concatenate(values).astype(np.float64)
+        self.roots = np.array(roots, dtype=np.intp)
+        self.depth = depth
+        # Bảng tra nhãn theo chỉ số lớp (mặc định là classes_ của mô hình)
+        self.labels = np.asarray(forest.classes_ if labels is None else labels) if self.is_classifier else None
+
+    def _leaves(self, X):
+        # Mỗi "làn" là một cặp (dòng, cây); trả về nút lá, dạng (số dòng, số cây)
+        X = np.asarray(X, dtype=np.float32).astype(np.float64)  # sklearn so sánh trên float32
+        if X.ndim == 1:
+            X = X[None, :]
+        n_rows, n_cols = X.shape
+        flat_x = X.ravel()
+        codes = np.tile(self.roots, n_rows)
+        row_offset = np.repeat(np.arange(n_rows, dtype=np.intp) * n_cols, len(self.roots))
+        for _ in range(self.depth):
+            go_right = flat_x[row_offset + self.node_feature[codes]] > self.node_threshold[codes]
+            codes = self.node_children[codes, go_right.view(np.int8)]
+        return codes.reshape(n_rows, len(self.roots))
+
+    def _mean(self, X):
+        # Cộng lần lượt từng cây (cumsum) rồi chia, đúng thứ tự cộng của sklearn
+        leaf_values = self.node_value[self._leaves(X)]
+        return np.cumsum(leaf_values, axis=1)[:, -1] / len(self.roots)
+
+    def predict(self, X):
+        """Hồi quy: giá trị trung bình; phân loại: nhãn của lớp có xác suất trung bình lớn nhất."""
+        if self.is_classifier:
+            return self.labels[np.argmax(self._mean(X), axis=1)]
+        return self._mean(X)
+
+    def predict_proba(self, X):
+        return self._mean(X)
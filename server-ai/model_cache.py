@@ -0,0 +1,138 @@
+# Nhiệm vụ: Lưu mô hình của từng thành phố ra đĩa và huấn luyện song song cho server.py
+# - Khóa theo thành phố và dấu vân tay dữ liệu (mã băm các dòng dữ liệu của thành phố và
+#   định nghĩa mô hình): thành phố không đổi dữ liệu được tải lại ngay khi khởi động.
+# - Các thành phố cần huấn luyện lại chạy trong ProcessPoolExecutor với tổng số lõi cố định
+#   (TRAIN_CORES), chia đều cho các tiến trình.
+# ==============================================================================
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.ensemble import RandomForestRegressor, RandomForestClassifier
+from sklearn.preprocessing import LabelEncoder
+
+MODEL_CACHE_DIR = os.environ.get(
+    'MODEL_CACHE_DIR', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'model_cache')
+)
+INDEX_FILENAME = 'models.json'
+TRAIN_CORES = int(os.environ.get('TRAIN_CORES', 0))  # 0: dùng mọi lõi CPU
+N_ESTIMATORS = 100
+RANDOM_STATE = 42
+# Tăng khi đổi cách tiền xử lý, tạo mẫu hoặc huấn luyện
+MODEL_VERSION = 1
+
+
+def model_definition(lags):
+    return {'version': MODEL_VERSION, 'lags': lags, 'n_estimators': N_ESTIMATORS,
+            'random_state': RANDOM_STATE, 'sklearn': sklearn.__version__}
+
+
+def data_fingerprint(df_city, definition):
+    """Mã băm dữ liệu gốc của một thành phố (cả index thời gian) và định nghĩa mô hình."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(definition, sort_keys=True).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df_city, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def fit_city_models(X, y_temp, y_cond, n_jobs=-1):
+    """Huấn luyện mô hình nhiệt độ và tình trạng thời tiết cho một thành phố."""
+    X = np.nan_to_num(X)
+    le = LabelEncoder()
+    y_cond_enc = le.fit_transform(y_cond)
+    reg = RandomForestRegressor(n_estimators=N_ESTIMATORS, random_state=RANDOM_STATE, n_jobs=n_jobs).fit(X, y_temp)
+    clf = RandomForestClassifier(n_estimators=N_ESTIMATORS, random_state=RANDOM_STATE, class_weight='balanced',
+                                 n_jobs=n_jobs).fit(X, y_cond_enc)
+    return {'reg': reg, 'clf': clf, 'le': le}
+
+
+def worker_plan(n_cities, cores=None):
+    """(số tiến trình, số luồng cho mỗi mô hình) trong giới hạn `cores` lõi."""
+    cores = cores or TRAIN_CORES or os.cpu_count() or 1
+    workers = max(1, min(n_cities, cores))
+    return workers, max(1, cores // workers)
+
+
+def _write_atomic(path, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CityModelCache:
+    """Mô hình đã huấn luyện của các thành phố trong `directory` (mỗi thành phố một file joblib)."""
+
+    def __init__(self, directory=MODEL_CACHE_DIR):
+        self.directory = directory
+
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_FILENAME)
+
+    def _read_index(self):
+        try:
+            with open(self._index_path(), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def load(self, city, fingerprint):
+        """Mô hình đã lưu của thành phố nếu cùng dấu vân tay, ngược lại None."""
+        entry = self._read_index().get(city)
+        if not entry or entry['fingerprint'] != fingerprint:
+            return None
+        try:
+            return joblib.load(os.path.join(self.directory, entry['file']))
+        except (OSError, EOFError, ValueError) as e:
+            print(f"  CẢNH BÁO: Không tải được mô hình đã lưu của {city}: {e}")
+            return None
+
+    def save(self, city, fingerprint, models):
+        os.makedirs(self.directory, exist_ok=True)
+        slug = ''.join(c if c.isalnum() else '_' for c in city.lower())
+        filename = f"{slug}-{fingerprint}.joblib"
+        _write_atomic(os.path.join(self.directory, filename), lambda path: joblib.dump(models, path))
+        index = self._read_index()
+        old = index.get(city)
+        index[city] = {'file': filename, 'fingerprint': fingerprint}
+
+        def write_index(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(dict(sorted(index.items())), f, ensure_ascii=False, indent=2)
+        _write_atomic(self._index_path(), write_index)
+        # Xóa file cũ sau khi index đã trỏ sang file mới
+        if old and old['file'] != filename:
+            try:
+                os.remove(os.path.join(self.directory, old['file']))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def train(jobs, cores=None, on_done=None):
+        """Huấn luyện {thành phố: (X, y_temp, y_cond)}, trả về {thành phố: mô hình}.
+
+        `on_done(thành phố, mô hình)` được gọi khi từng thành phố xong (theo thứ tự hoàn thành).
+        """
+        workers, threads = worker_plan(len(jobs), cores)
+        results = {}
+        if workers == 1:
+            for city, (X, y_temp, y_cond) in jobs.items():
+                results[city] = fit_city_models(X, y_temp, y_cond, n_jobs=threads)
+                if on_done is not None:
+                    on_done(city, results[city])
+            return results
+        # 'spawn': server đang chạy nhiều luồng, fork có thể sao chép khóa đang bị giữ
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(fit_city_models, X, y_temp, y_cond, threads): city
+                       for city, (X, y_temp, y_cond) in jobs.items()}
+            for future in as_completed(futures):
+                city = futures[future]
+                results[city] = future.result()
+                if on_done is not None:
+                    on_done(city, results[city])
+        return results
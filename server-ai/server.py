@@ -1,14 +1,18 @@
 # Nhiệm vụ: Chạy máy chủ API, huấn luyện và cung cấp dự báo
+# Cửa sổ quan sát mới nhất của từng thành phố được giữ trong bộ nhớ (CityWindows), request không đọc file.
+# Mô hình được lưu theo thành phố và dữ liệu (model_cache.py): khởi động chỉ huấn luyện các thành phố
+# có dữ liệu mới (song song); khi file dữ liệu đổi, huấn luyện lại ở nền rồi thay mô hình đang phục vụ.
+# Dự báo 24 giờ duyệt cây bằng mảng phẳng trên một luồng (FOREST_INFERENCE, forest_inference.py).
 
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-from sklearn.ensemble import RandomForestRegressor, RandomForestClassifier
-from sklearn.preprocessing import LabelEncoder
 import os
-import math
+import sys
+import threading
+import time
 import warnings
 
 # --- CẤU HÌNH ---
@@ -16,6 +20,12 @@ import warnings
 SERVER_AI_DIR = os.path.dirname(os.path.realpath(__file__))
 DATA_FILE = os.path.join(SERVER_AI_DIR, 'all_cities_weather_data.csv')
 LAGS = 6
+# Chu kỳ (giây) kiểm tra file dữ liệu có thay đổi để cập nhật cửa sổ quan sát trong bộ nhớ
+DATA_POLL_SECONDS = float(os.environ.get('DATA_POLL_SECONDS', 30))
+# 'compact': duyệt cây bằng mảng phẳng trên một luồng (forest_inference.py); 'sklearn': gọi predict của mô hình
+FOREST_INFERENCE = os.environ.get('FOREST_INFERENCE', 'compact')
+# Huấn luyện lại ở nền khi file dữ liệu thay đổi
+AUTO_RETRAIN = os.environ.get('AUTO_RETRAIN', '1') == '1'
 
 TARGET_CITIES = {
     "Buon Ma Thuot": {"lat": 12.6683, "lon": 108.0435}, "Ca Mau": {"lat": 9.1768, "lon": 105.1531},
@@ -25,12 +35,27 @@ TARGET_CITIES = {
     "Lang Son": {"lat": 21.8524, "lon": 106.7589}, "Lao Cai": {"lat": 22.4848, "lon": 103.9515}
 }
 
+# Gói dùng chung weather_common nằm ở thư mục gốc của dự án
+sys.path.append(os.path.join(SERVER_AI_DIR, '..'))
+from weather_common import OBSERVATION_COLUMNS, LocationRegistry, sliding_window_samples
+
+from model_cache import CityModelCache, data_fingerprint, model_definition
+from forest_inference import FlatForest
+
+CITY_REGISTRY = LocationRegistry(TARGET_CITIES)
+model_cache = CityModelCache()
+
 warnings.filterwarnings("ignore", category=UserWarning)
 
 app = Flask(__name__)
 CORS(app)
 
-trained_models = {}
+# (mô hình theo thành phố, chỉ mục các thành phố đã có mô hình): thay cả cặp trong một lần gán
+serving_models = ({}, None)
+_training_lock = threading.Lock() # Mỗi lúc chỉ một lần huấn luyện (khởi động hoặc chạy nền)
+_retrain_lock = threading.Lock()
+_retrain_pending = None # Bảng dữ liệu mới nhất chờ huấn luyện lại
+_retrain_thread = None
 
 # CÁC HÀM XỬ LÝ DỮ LIỆU
 def group_weather_condition_3_classes(symbol_code):
@@ -47,85 +72,172 @@ def preprocess_met_df(df):
     df2["precip_1h"], df2['condition'] = df2["precip_1h"].fillna(0.0), df2['symbol_code'].apply(group_weather_condition_3_classes)
     return df2.dropna(subset=["temp", "rhum", "pres", "wind_speed", "cloud_frac"])
 
-def create_training_samples(df, lags):
-    X_list, y_temp_list, y_cond_list = [], [], []
-    for i in range(lags, len(df)):
-        past, target = df.iloc[i-lags:i], df.iloc[i]
-        feat = []
-        for j in range(lags):
-            feat.extend([past["temp"].iloc[j], past["rhum"].iloc[j], past["pres"].iloc[j], past["wind_speed"].iloc[j], past["cloud_frac"].iloc[j], past["precip_1h"].iloc[j]])
-        feat.extend([target["sin_hour"], target["cos_hour"], target["is_night"]])
-        X_list.append(feat)
-        y_temp_list.append(target["temp"])
-        y_cond_list.append(target["condition"])
-    return np.array(X_list), np.array(y_temp_list), np.array(y_cond_list)
-
-def train_all_models():
-    """Huấn luyện mô hình riêng cho từng thành phố."""
-    global trained_models
-    print("--- Bắt đầu quá trình huấn luyện đa mô hình ---")
-    if not os.path.exists(DATA_FILE):
-        print(f"LỖI: Không tìm thấy file dữ liệu '{DATA_FILE}'. Vui lòng chạy 'python scripts/data_collector.py' trước.")
+def data_file_signature(path=DATA_FILE):
+    """(mtime, kích thước) của file dữ liệu, None nếu chưa có file."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+class CityWindows:
+    """LAGS giờ quan sát cuối của từng thành phố, giữ trong bộ nhớ cho /api/predict_weather.
+
+    Request chỉ đọc bảng trong bộ nhớ, không đọc file. Một luồng nền kiểm tra
+    (mtime, kích thước) của file dữ liệu mỗi `poll_seconds` giây; file đổi thì đọc lại
+    một lần, thay cả bảng rồi gọi `on_change(bảng dữ liệu)` nếu có.
+    """
+    def __init__(self, path=DATA_FILE, lags=LAGS, poll_seconds=DATA_POLL_SECONDS, on_change=None):
+        self.path, self.lags, self.poll_seconds = path, lags, poll_seconds
+        self.on_change = on_change
+        self.signature = None
+        self._windows = {}
+        self._refresh_lock = threading.Lock()
+
+    def update(self, df_all, signature):
+        """Tính lại cửa sổ của mọi thành phố từ bảng dữ liệu đã đọc (`signature` của file lúc đọc)."""
+        windows = {}
+        for city, df_city in df_all.groupby('city_name', sort=False):
+            window = preprocess_met_df(df_city)[OBSERVATION_COLUMNS].iloc[-self.lags:]
+            windows[city] = window.to_dict('records')
+        # Thay cả bảng một lần: request đang chạy vẫn dùng bảng cũ trọn vẹn
+        self._windows, self.signature = windows, signature
+
+    def refresh(self):
+        """Đọc lại file nếu đã thay đổi; trả về True nếu bảng được cập nhật."""
+        with self._refresh_lock:
+            signature = data_file_signature(self.path)
+            if signature is None or signature == self.signature:
+                return False
+            try:
+                df_all = pd.read_csv(self.path, index_col='time', parse_dates=True)
+            except (ValueError, KeyError, pd.errors.ParserError) as e:
+                # File có thể đang được ghi dở (data_collector.py ghi đè cả file): giữ bảng cũ, thử lại lần sau
+                print(f"CẢNH BÁO: Chưa đọc được '{self.path}': {e}")
+                return False
+            if data_file_signature(self.path) != signature:
+                return False
+            self.update(df_all, signature)
+            print(f"--- Đã cập nhật cửa sổ quan sát cho {len(self._windows)} thành phố ---")
+        if self.on_change is not None:
+            self.on_change(df_all)
+        return True
+
+    def get(self, city):
+        """Bản sao danh sách LAGS bản ghi cuối của thành phố, None nếu chưa có dữ liệu."""
+        window = self._windows.get(city)
+        return None if window is None else list(window)
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"LỖI khi cập nhật cửa sổ quan sát: {e}")
+
+    def start(self):
+        threading.Thread(target=self._poll, name='city-windows', daemon=True).start()
+
+def train_all_models(df_all=None):
+    """Chuẩn bị mô hình riêng cho từng thành phố: tải bản đã lưu nếu dữ liệu không đổi, còn lại huấn luyện song song.
+
+    Bảng mô hình mới chỉ thay bảng đang phục vụ khi đã xong tất cả các thành phố.
+    """
+    global serving_models
+    with _training_lock:
+        print("--- Bắt đầu quá trình huấn luyện đa mô hình ---")
+        if df_all is None:
+            if not os.path.exists(DATA_FILE):
+                print(f"LỖI: Không tìm thấy file dữ liệu '{DATA_FILE}'. Vui lòng chạy 'python scripts/data_collector.py' trước.")
+                return
+            signature = data_file_signature()
+            df_all = pd.read_csv(DATA_FILE, index_col='time', parse_dates=True)
+            # Dùng luôn dữ liệu vừa đọc cho cửa sổ quan sát của /api/predict_weather
+            city_windows.update(df_all, signature)
+        cities_in_data = df_all['city_name'].unique()
+        print(f"Tìm thấy dữ liệu cho các thành phố: {', '.join(cities_in_data)}")
+
+        definition = model_definition(LAGS)
+        models, jobs, fingerprints = {}, {}, {}
+        for city in cities_in_data:
+            df_city = df_all[df_all['city_name'] == city]
+            if len(df_city) < 50:
+                print(f"  CẢNH BÁO: Dữ liệu cho {city} quá ít ({len(df_city)} dòng), bỏ qua.")
+                continue
+            fingerprints[city] = data_fingerprint(df_city, definition)
+            cached = model_cache.load(city, fingerprints[city])
+            if cached is not None:
+                models[city] = cached
+                print(f"-> {city}: dữ liệu không đổi, dùng mô hình đã lưu.")
+                continue
+            X, targets = sliding_window_samples(preprocess_met_df(df_city), lags=LAGS)
+            jobs[city] = (X, targets['temp'].to_numpy(), targets['condition'].to_numpy())
+
+        def on_done(city, city_models):
+            model_cache.save(city, fingerprints[city], city_models)
+            print(f"  Mô hình cho {city} đã sẵn sàng. Các lớp đã học: {city_models['le'].classes_}")
+
+        if jobs:
+            print(f"-> Đang huấn luyện {len(jobs)} thành phố: {', '.join(jobs)}")
+            models.update(model_cache.train(jobs, on_done=on_done))
+        # Thay mô hình và chỉ mục cùng lúc: request không thấy chỉ mục cũ đi với bảng mô hình mới
+        new_models = {city: attach_flat_forests(models[city]) for city in cities_in_data if city in models}
+        serving_models = (new_models, CITY_REGISTRY.subset(new_models))
+        print("\n--- Quá trình huấn luyện đa mô hình hoàn tất. Server sẵn sàng. ---")
+
+def retrain_in_background(df_all):
+    # Gọi từ luồng của CityWindows: chuyển việc huấn luyện sang luồng riêng để cửa sổ quan sát
+    # vẫn được cập nhật; server phục vụ bằng mô hình cũ trong lúc huấn luyện. Dữ liệu đổi
+    # trong lúc đang huấn luyện thì chỉ giữ bảng mới nhất cho lần kế tiếp.
+    global _retrain_pending, _retrain_thread
+    if not AUTO_RETRAIN:
         return
+    with _retrain_lock:
+        _retrain_pending = df_all
+        if _retrain_thread is None:
+            _retrain_thread = threading.Thread(target=_retrain_loop, name='retrain', daemon=True)
+            _retrain_thread.start()
 
-    df_all = pd.read_csv(DATA_FILE, index_col='time', parse_dates=True)
-    cities_in_data = df_all['city_name'].unique()
-    print(f"Tìm thấy dữ liệu cho các thành phố: {', '.join(cities_in_data)}")
-
-    for city in cities_in_data:
-        print(f"\n-> Đang xử lý và huấn luyện cho: {city}")
-        df_city = df_all[df_all['city_name'] == city]
-        if len(df_city) < 50:
-            print(f"  CẢNH BÁO: Dữ liệu cho {city} quá ít ({len(df_city)} dòng), bỏ qua.")
-            continue
-        df_processed = preprocess_met_df(df_city)
-        X, y_temp, y_cond = create_training_samples(df_processed, lags=LAGS)
-        X = np.nan_to_num(X)
-        le = LabelEncoder()
-        y_cond_enc = le.fit_transform(y_cond)
-
-        reg = RandomForestRegressor(n_estimators=100, random_state=42, n_jobs=-1).fit(X, y_temp)
-        clf = RandomForestClassifier(n_estimators=100, random_state=42, class_weight='balanced', n_jobs=-1).fit(X, y_cond_enc)
-        
-        trained_models[city] = {'reg': reg, 'clf': clf, 'le': le}
-        print(f"  Mô hình cho {city} đã sẵn sàng. Các lớp đã học: {le.classes_}")
-    print("\n--- Quá trình huấn luyện đa mô hình hoàn tất. Server sẵn sàng. ---")
-
-def find_nearest_city(lat, lon):
-    """Tìm thành phố gần nhất từ tọa độ cho trước."""
-    available_cities = {name: coords for name, coords in TARGET_CITIES.items() if name in trained_models}
-    if not available_cities: return None
-    
-    min_dist = float('inf')
-    nearest_city = None
-    for city_name, coords in available_cities.items():
-        dist = math.sqrt((lat - coords['lat'])**2 + (lon - coords['lon'])**2)
-        if dist < min_dist:
-            min_dist, nearest_city = dist, city_name
+def _retrain_loop():
+    global _retrain_pending, _retrain_thread
+    while True:
+        with _retrain_lock:
+            df_all, _retrain_pending = _retrain_pending, None
+            if df_all is None:
+                _retrain_thread = None
+                return
+        try:
+            train_all_models(df_all)
+        except Exception as e:
+            print(f"LỖI khi huấn luyện lại ở nền: {e}")
+
+city_windows = CityWindows(on_change=retrain_in_background)
+
+def find_nearest_city(lat, lon, registry=None):
+    """Tìm thành phố (đã có mô hình) gần nhất từ tọa độ cho trước, theo khoảng cách haversine."""
+    registry = serving_models[1] if registry is None else registry
+    if not registry: return None
+    nearest_city, _ = registry.nearest_one(lat, lon)
     return nearest_city
 
-@app.route('/api/predict_weather', methods=['GET'])
-def predict_weather():
-    lat_str, lon_str = request.args.get('lat'), request.args.get('lon')
-    if not lat_str or not lon_str: return jsonify({"error": "Vui lòng cung cấp 'lat' và 'lon'"}), 400
-    
-    nearest_city = find_nearest_city(float(lat_str), float(lon_str))
-    if not nearest_city: return jsonify({"error": f"Không có mô hình nào được huấn luyện cho khu vực lân cận"}), 500
+def attach_flat_forests(city_models):
+    """Thêm bản mảng phẳng của hai mô hình (FlatForest) cho đường suy luận 'compact'."""
+    le, clf = city_models['le'], city_models['clf']
+    city_models['reg_flat'] = FlatForest(city_models['reg'])
+    # Bảng tra: chỉ số lớp của mô hình -> tên tình trạng thời tiết
+    city_models['clf_flat'] = FlatForest(clf, labels=le.classes_[clf.classes_])
+    return city_models
 
-    models = trained_models[nearest_city]
+def forecast_city(models, window_data, start_time, steps=24, engine=None):
+    """Dự báo đệ quy `steps` giờ từ cửa sổ LAGS giờ quan sát cuối (danh sách bản ghi, sẽ bị thay đổi)."""
+    compact = (engine or FOREST_INFERENCE) == 'compact' and 'reg_flat' in models
     reg_model, clf_model, le = models['reg'], models['clf'], models['le']
-    
-    df_all = pd.read_csv(DATA_FILE, index_col='time', parse_dates=True)
-    df_city = df_all[df_all['city_name'] == nearest_city]
-    df_processed = preprocess_met_df(df_city)
-    initial_window_df = df_processed.iloc[-LAGS:]
-    window_data = initial_window_df[['temp', 'rhum', 'pres', 'wind_speed', 'cloud_frac', 'precip_1h']].to_dict('records')
-    
-    forecast_results, current_time = [], datetime.now().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
-    for _ in range(24):
+    forecast_results, current_time = [], start_time
+    for _ in range(steps):
         current_hour = current_time.hour
         time_features = [np.sin(2*np.pi*current_hour/24), np.cos(2*np.pi*current_hour/24), 1 if (current_hour<6 or current_hour>18) else 0]
-        
+
         feat = []
         for item in window_data:
             feat.extend([item["temp"], item["rhum"], item["pres"], item["wind_speed"], item["cloud_frac"], item["precip_1h"]])
@@ -133,9 +245,13 @@ def predict_weather():
         feat_arr = np.array(feat).reshape(1, -1)
         feat_arr = np.nan_to_num(feat_arr)
 
-        predicted_temp = reg_model.predict(feat_arr)[0]
-        predicted_cond_enc = clf_model.predict(feat_arr)[0]
-        predicted_condition = le.inverse_transform([predicted_cond_enc])[0]
+        if compact:
+            predicted_temp = models['reg_flat'].predict(feat_arr)[0]
+            predicted_condition = models['clf_flat'].predict(feat_arr)[0]
+        else:
+            predicted_temp = reg_model.predict(feat_arr)[0]
+            predicted_cond_enc = clf_model.predict(feat_arr)[0]
+            predicted_condition = le.inverse_transform([predicted_cond_enc])[0]
 
         forecast_results.append({"time": current_time.isoformat(), "temp": round(predicted_temp, 1), "condition": predicted_condition})
 
@@ -148,10 +264,29 @@ def predict_weather():
         new_entry.update({'temp': predicted_temp, 'precip_1h': next_precip, 'cloud_frac': next_cloud})
         window_data.append(new_entry)
         current_time += timedelta(hours=1)
-        
+    return forecast_results
+
+@app.route('/api/predict_weather', methods=['GET'])
+def predict_weather():
+    lat_str, lon_str = request.args.get('lat'), request.args.get('lon')
+    if not lat_str or not lon_str: return jsonify({"error": "Vui lòng cung cấp 'lat' và 'lon'"}), 400
+    
+    # Đọc cặp (mô hình, chỉ mục) một lần cho cả request
+    models_by_city, registry = serving_models
+    nearest_city = find_nearest_city(float(lat_str), float(lon_str), registry)
+    if not nearest_city: return jsonify({"error": f"Không có mô hình nào được huấn luyện cho khu vực lân cận"}), 500
+
+    models = models_by_city.get(nearest_city)
+    if not models: return jsonify({"error": f"Mô hình cho {nearest_city} đang được cập nhật, vui lòng thử lại"}), 503
+    window_data = city_windows.get(nearest_city)
+    if not window_data: return jsonify({"error": f"Chưa có dữ liệu quan sát cho {nearest_city}"}), 503
+
+    start_time = datetime.now().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    forecast_results = forecast_city(models, window_data, start_time)
     return jsonify({"city_name": nearest_city, "lat": lat_str, "lon": lon_str, "forecast": forecast_results})
 
 if __name__ == "__main__":
     train_all_models()
+    city_windows.start()
     # Chạy server, lắng nghe trên port 5001 để tránh xung đột với server.js
     app.run(debug=True, port=5001)
\ No newline at end of file
@@ -10,6 +10,11 @@ import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 import warnings
 import os # Thêm thư viện os để kiểm tra sự tồn tại của tệp
+import sys
+
+# Gói dùng chung weather_common nằm ở thư mục gốc của dự án
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from weather_common import sliding_window_samples
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -186,34 +191,16 @@ if __name__ == "__main__":
 
     # 2. Xây dựng features và labels cho cả hai mô hình
     lags = 5 # Tăng lags để mô hình học được nhiều hơn từ chuỗi thời gian dài hơn
-    X_list, y_temp_list, y_cond_list = [], [], []
-
-    # Sử dụng df_combined để tạo mẫu
-    for i in range(lags, len(df_combined) - 1):
-        past = df_combined.iloc[i - lags : i]
-        feat = []
-        for j in range(lags):
-            feat.extend([
-                past["temp"].iloc[j],
-                past["rhum"].iloc[j],
-                past["pres"].iloc[j],
-                past["wind_speed"].iloc[j],
-                past["cloud_frac"].iloc[j],
-                past["precip_1h"].iloc[j]
-            ])
-        feat.extend([df_combined["sin_hour"].iloc[i], df_combined["cos_hour"].iloc[i], df_combined["is_night"].iloc[i]])
-        
-        X_list.append(feat)
-        y_temp_list.append(df_combined["temp"].iloc[i+1])
-        y_cond_list.append(df_combined["condition"].iloc[i+1])
+    # Sử dụng df_combined để tạo mẫu: cửa sổ `lags` giờ, feature thời gian của giờ ngay sau
+    # cửa sổ, nhãn là giờ kế tiếp nữa (horizon=2)
+    X, targets = sliding_window_samples(df_combined, lags, horizon=2, time_horizon=1)
 
-    if not X_list:
+    if not len(X):
         print("\nLỖI: Không tạo được mẫu huấn luyện nào. Dữ liệu có thể quá ít hoặc không liên tục.")
         exit()
 
-    X = np.array(X_list)
-    y_temp = np.array(y_temp_list)
-    y_cond = np.array(y_cond_list)
+    y_temp = targets["temp"].to_numpy()
+    y_cond = targets["condition"].to_numpy()
     X = np.nan_to_num(X) # Xử lý các giá trị NaN còn sót lại
 
     # 3. Mã hóa label và chia dữ liệu train/test
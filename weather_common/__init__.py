@@ -0,0 +1,5 @@
+# Mục đích: Các thành phần dùng chung cho ai_weather_system, server-ai và scripts.
+# ==============================================================================
+from .lazy_imports import force_import, lazy_import
+from .locations import LocationRegistry, haversine_km
+from .samples import OBSERVATION_COLUMNS, TIME_COLUMNS, sample_positions, sliding_window_samples
@@ -0,0 +1,29 @@
+# Mục đích: Trì hoãn import các thư viện nặng (pandas, pytz, ...) tới lần dùng đầu tiên.
+# - Module trả về đứng sẵn trong sys.modules; mã của nó chỉ chạy khi truy cập
+#   thuộc tính đầu tiên, nên tiến trình khởi động nhanh hơn.
+# - importlib.util.LazyLoader của Python 3.11 chưa an toàn khi nhiều luồng cùng
+#   truy cập lần đầu: nên gọi force_import() dưới khóa trước khi dùng song song.
+# ==============================================================================
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Trả về module `name`, chỉ thực sự import khi dùng tới lần đầu."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def force_import(module):
+    # Truy cập một thuộc tính để chạy mã của module nếu nó còn đang chờ
+    getattr(module, '__name__')
+    return module
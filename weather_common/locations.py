@@ -0,0 +1,75 @@
+# Mục đích: Sổ đăng ký địa điểm dự báo có chỉ mục không gian.
+# - Tìm địa điểm gần nhất theo khoảng cách haversine (km) thay cho vòng lặp
+#   Python tính khoảng cách phẳng theo độ.
+# - Chỉ mục là cây KD trên vector đơn vị 3D: khoảng cách dây cung đơn điệu theo
+#   khoảng cách trên mặt cầu nên điểm gần nhất trùng với điểm gần nhất haversine.
+# - Tra cứu theo lô: hàng nghìn điểm trong một lần gọi, không có vòng lặp Python.
+# - Chỉ import SciPy và dựng cây ở lần tra cứu đầu tiên để khởi động nhanh.
+# ==============================================================================
+import threading
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _unit_vectors(lats, lons):
+    lat, lon = np.radians(lats), np.radians(lons)
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+class LocationRegistry:
+    """Danh sách địa điểm {tên: {"lat": ..., "lon": ...}} kèm chỉ mục tìm gần nhất."""
+
+    def __init__(self, locations):
+        self.names = np.array(list(locations), dtype=object)
+        self.lats = np.array([info['lat'] for info in locations.values()], dtype=np.float64)
+        self.lons = np.array([info['lon'] for info in locations.values()], dtype=np.float64)
+        self._tree = None
+        self._tree_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def subset(self, names):
+        keep = set(names)
+        return LocationRegistry({
+            name: {'lat': lat, 'lon': lon}
+            for name, lat, lon in zip(self.names, self.lats, self.lons) if name in keep
+        })
+
+    def _get_tree(self):
+        with self._tree_lock:
+            if self._tree is None:
+                from scipy.spatial import cKDTree
+                self._tree = cKDTree(_unit_vectors(self.lats, self.lons))
+            return self._tree
+
+    def nearest(self, lats, lons, max_distance_km=None):
+        """Tra cứu theo lô. Trả về (mảng tên, mảng khoảng cách km).
+
+        Điểm xa hơn max_distance_km (nếu có) nhận tên None và khoảng cách NaN.
+        """
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        if not len(self.names):
+            return np.full(len(lats), None, dtype=object), np.full(len(lats), np.nan)
+        _, index = self._get_tree().query(_unit_vectors(lats, lons))
+        distances = haversine_km(lats, lons, self.lats[index], self.lons[index])
+        names = self.names[index]
+        if max_distance_km is not None:
+            too_far = distances > max_distance_km
+            names = np.where(too_far, None, names)
+            distances = np.where(too_far, np.nan, distances)
+        return names, distances
+
+    def nearest_one(self, lat, lon):
+        names, distances = self.nearest([lat], [lon])
+        return names[0], float(distances[0])
@@ -0,0 +1,59 @@
+# Mục đích: Tạo mẫu huấn luyện dạng cửa sổ trượt (lag) cho server-ai, scripts/evaluate_models.py
+# và src/components/WeatherAI.py.
+# - Mỗi mẫu: giá trị `lags` giờ liên tiếp (cũ trước, mỗi giờ đủ các cột quan sát)
+#   rồi feature thời gian của một giờ sau cửa sổ; nhãn là giờ thứ `horizon` sau cửa sổ.
+# - Dùng sliding_window_view của NumPy cho cả bảng trong một lần thay cho vòng lặp
+#   df.iloc[i-lags:i] và .iloc[j] cho từng ô; cùng thứ tự cột và cùng giá trị như cũ.
+# - Có thể chia nhóm (ví dụ theo thành phố): cửa sổ và nhãn không vượt qua ranh giới nhóm.
+# ==============================================================================
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+OBSERVATION_COLUMNS = ['temp', 'rhum', 'pres', 'wind_speed', 'cloud_frac', 'precip_1h']
+TIME_COLUMNS = ['sin_hour', 'cos_hour', 'is_night']
+TARGET_COLUMNS = ['temp', 'condition']
+
+
+def sample_positions(n_rows, lags, horizon=1, group_codes=None):
+    """Vị trí dòng đầu của các cửa sổ hợp lệ (theo thứ tự dòng).
+
+    Cửa sổ bắt đầu ở s gồm các dòng s..s+lags-1, nhãn ở dòng s+lags+horizon-1;
+    với `group_codes` (mã nhóm theo dòng, các nhóm liền khối) thì cả hai phải cùng nhóm.
+    """
+    starts = np.arange(max(n_rows - lags - horizon + 1, 0))
+    if group_codes is not None and len(starts):
+        group_codes = np.asarray(group_codes)
+        starts = starts[group_codes[starts] == group_codes[starts + lags + horizon - 1]]
+    return starts
+
+
+def sliding_window_samples(df, lags, horizon=1, time_horizon=None, group_column=None,
+                           value_columns=OBSERVATION_COLUMNS, time_columns=TIME_COLUMNS,
+                           target_columns=TARGET_COLUMNS):
+    """Ma trận feature và nhãn từ bảng đã tiền xử lý, sắp theo thời gian (trong từng nhóm).
+
+    Feature của mẫu: `value_columns` của `lags` giờ trong cửa sổ (giờ cũ nhất trước),
+    rồi `time_columns` của giờ thứ `time_horizon` sau cửa sổ (mặc định giờ của nhãn).
+    Trả về (X, DataFrame nhãn gồm `target_columns` và cột nhóm nếu có, giữ index của
+    các dòng nhãn); các mẫu theo thứ tự nhóm xuất hiện rồi theo thứ tự dòng trong nhóm.
+    """
+    time_horizon = horizon if time_horizon is None else time_horizon
+    if group_column is not None:
+        # Gom mỗi nhóm thành một khối liền, giữ thứ tự dòng trong nhóm
+        codes = df[group_column].factorize()[0]
+        order = np.argsort(codes, kind='stable')
+        df, codes = df.iloc[order], codes[order]
+    else:
+        codes = None
+
+    n_values = len(value_columns) * lags
+    starts = sample_positions(len(df), lags, max(horizon, time_horizon), codes)
+    X = np.empty((len(starts), n_values + len(time_columns)), dtype=np.float64)
+    if len(starts):
+        values = df[value_columns].to_numpy(dtype=np.float64)
+        windows = sliding_window_view(values, lags, axis=0)  # (số cửa sổ, số cột, lags)
+        X[:, :n_values] = windows[starts].transpose(0, 2, 1).reshape(len(starts), n_values)
+        X[:, n_values:] = df[time_columns].to_numpy(dtype=np.float64)[starts + lags + time_horizon - 1]
+    columns = list(target_columns) + ([group_column] if group_column is not None else [])
+    targets = df[columns].iloc[starts + lags + horizon - 1]
+    return X, targets